@@ -633,7 +633,8 @@ setup_python_environment() {
     if sudo -u "$ZOPLOG_USER" ./venv/bin/pip install \
         scapy \
         PyMySQL \
-        mysql-connector-python; then
+        mysql-connector-python \
+        cryptography; then
         log_success "Python dependencies installed via pip"
     else
         log_warning "Pip installation failed, trying with system packages..."
@@ -1129,6 +1130,9 @@ ExecStart=$ZOPLOG_HOME/zoplog/python-logger/venv/bin/python logger.py
 Restart=always
 RestartSec=10
 TimeoutStartSec=60
+# /run/zoplog holds the logger -> block reader attribution socket, shared by both services
+RuntimeDirectory=zoplog
+RuntimeDirectoryPreserve=yes
 
 # Security settings with necessary capabilities for packet capture
 NoNewPrivileges=no
@@ -1170,6 +1174,11 @@ ExecStart=$ZOPLOG_HOME/zoplog/python-logger/venv/bin/python nft_blocklog_reader.
 Restart=always
 RestartSec=10
 TimeoutStartSec=60
+# /run/zoplog holds the logger -> block reader attribution socket, shared by both services
+RuntimeDirectory=zoplog
+RuntimeDirectoryPreserve=yes
+# /var/lib/zoplog keeps the journal cursor the reader resumes from
+StateDirectory=zoplog
 
 # Security settings
 NoNewPrivileges=yes
@@ -0,0 +1,24 @@
+-- Migration: Create per-minute traffic rollup tables
+-- Created: 2025-10-05
+-- Description: Per-minute request and block counts maintained by the logger and
+-- the block-log reader, so dashboards do not scan packet_logs/blocked_events.
+-- Populate history with: python-logger/rollup_backfill.py
+
+-- Allowed requests per minute, type and method (written with each packet_logs batch)
+CREATE TABLE IF NOT EXISTS `packet_log_minutes` (
+  `minute` datetime NOT NULL,
+  `type` enum('HTTP','HTTPS') NOT NULL,
+  `method` enum('GET','POST','PUT','DELETE','HEAD','OPTIONS','PATCH','CONNECT','TRACE','PROPFIND','PROPPATCH','MKCOL','COPY','MOVE','LOCK','UNLOCK','N/A','TLS_CLIENTHELLO') NOT NULL DEFAULT 'N/A',
+  `requests` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  PRIMARY KEY (`minute`, `type`, `method`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_uca1400_ai_ci;
+
+-- Blocked events per minute and direction. `targets` counts distinct
+-- (wan_ip_id, 30-second window) pairs, the dashboard's de-duplicated block count.
+CREATE TABLE IF NOT EXISTS `blocked_event_minutes` (
+  `minute` datetime NOT NULL,
+  `direction` enum('IN','OUT','FWD') NOT NULL,
+  `events` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  `targets` int(10) UNSIGNED NOT NULL DEFAULT 0,
+  PRIMARY KEY (`minute`, `direction`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_uca1400_ai_ci;
@@ -0,0 +1,45 @@
+-- Migration: Connection-summary columns and request count views
+-- Created: 2025-10-08
+-- Description: With request_coalesce_window set, the logger stores identical
+-- requests seen within the window as one packet_logs row: packet_timestamp is
+-- the first request, last_timestamp the last one and hit_count their number.
+-- Rows written one per request keep hit_count = 1. Dashboards count requests
+-- with SUM(hit_count) (or the views below) instead of COUNT(*).
+
+ALTER TABLE `packet_logs`
+  ADD COLUMN IF NOT EXISTS `hit_count` int(10) UNSIGNED NOT NULL DEFAULT 1 AFTER `type`,
+  ADD COLUMN IF NOT EXISTS `last_timestamp` datetime DEFAULT NULL AFTER `hit_count`;
+
+-- One readable row per packet_logs row (a single request or a summary)
+CREATE OR REPLACE VIEW `packet_log_details` AS
+SELECT p.id,
+       p.packet_timestamp AS first_seen,
+       COALESCE(p.last_timestamp, p.packet_timestamp) AS last_seen,
+       p.hit_count,
+       src_ip.ip_address AS src_ip, p.src_port,
+       dst_ip.ip_address AS dst_ip, p.dst_port,
+       src_mac.mac_address AS src_mac, dst_mac.mac_address AS dst_mac,
+       p.method, p.type, d.domain, path.path
+FROM packet_logs p
+LEFT JOIN ip_addresses src_ip ON p.src_ip_id = src_ip.id
+LEFT JOIN ip_addresses dst_ip ON p.dst_ip_id = dst_ip.id
+LEFT JOIN mac_addresses src_mac ON p.src_mac_id = src_mac.id
+LEFT JOIN mac_addresses dst_mac ON p.dst_mac_id = dst_mac.id
+LEFT JOIN domains d ON p.domain_id = d.id
+LEFT JOIN paths path ON p.path_id = path.id;
+
+-- Requests per domain, counting every hit of summary rows
+CREATE OR REPLACE VIEW `domain_request_counts` AS
+SELECT p.domain_id, d.domain,
+       SUM(p.hit_count) AS requests,
+       MAX(COALESCE(p.last_timestamp, p.packet_timestamp)) AS last_seen
+FROM packet_logs p
+JOIN domains d ON p.domain_id = d.id
+GROUP BY p.domain_id, d.domain;
+
+-- Requests per user agent (HTTP only; TLS requests carry no user agent)
+CREATE OR REPLACE VIEW `user_agent_request_counts` AS
+SELECT p.user_agent_id, ua.user_agent, SUM(p.hit_count) AS requests
+FROM packet_logs p
+JOIN user_agents ua ON p.user_agent_id = ua.id
+GROUP BY p.user_agent_id, ua.user_agent;
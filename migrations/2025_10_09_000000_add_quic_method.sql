@@ -0,0 +1,11 @@
+-- Migration: Add the QUIC request method
+-- Created: 2025-10-09
+-- Description: The logger stores SNIs read from QUIC Initial packets with
+-- method 'QUIC'. Neither packet_logs nor packet_log_minutes allowed that
+-- value, so under strict sql_mode every batch holding a QUIC row failed.
+
+ALTER TABLE `packet_logs`
+  MODIFY COLUMN `method` enum('GET','POST','PUT','DELETE','HEAD','OPTIONS','PATCH','CONNECT','TRACE','PROPFIND','PROPPATCH','MKCOL','COPY','MOVE','LOCK','UNLOCK','N/A','TLS_CLIENTHELLO','QUIC') DEFAULT 'N/A';
+
+ALTER TABLE `packet_log_minutes`
+  MODIFY COLUMN `method` enum('GET','POST','PUT','DELETE','HEAD','OPTIONS','PATCH','CONNECT','TRACE','PROPFIND','PROPPATCH','MKCOL','COPY','MOVE','LOCK','UNLOCK','N/A','TLS_CLIENTHELLO','QUIC') NOT NULL DEFAULT 'N/A';
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Background batched database writer for ZopLog.
+
+Producers (the packet capture callback) hand rows to a bounded queue and
+return immediately. A writer thread collects rows until either the batch size
+or the flush interval is reached, then calls a flush function with all of
+them inside one transaction, so MariaDB pays for a single commit per batch
+instead of one per packet.
+
+When the queue is full new rows are dropped and counted rather than blocking
+capture. On connection loss, lock wait timeouts and deadlocks the pending
+batch is kept and retried with exponential backoff; only a batch rejected for
+its data (a value out of range or not allowed by the column) is replayed row
+by row, so the one bad row is dropped and its neighbours are stored.
+"""
+
+import queue
+import threading
+import time
+from typing import Callable, List, Optional
+
+import pymysql as mariadb
+
+from db_pool import is_connection_error, is_data_error, is_transient_error
+import zoplog_log as log
+
+_STOP = object()
+
+
+class BatchWriter:
+    """Bounded-queue writer that flushes rows in one transaction per batch.
+
+    flush_batch(cursor, rows) performs the SQL for a list of rows; the writer
+    owns the connection, commit/rollback, retries and shutdown drain. If
+    given, on_commit(result) is called with flush_batch's return value once
+    the batch is committed.
+    """
+
+    def __init__(self, db_config: dict, flush_batch: Callable, name: str = "batch-writer",
+                 queue_size: int = 10000, batch_size: int = 200, flush_interval: float = 1.0,
+                 observe_commit: Optional[Callable[[float], None]] = None,
+                 wrap_cursor: Optional[Callable] = None,
+                 on_commit: Optional[Callable] = None):
+        self.db_config = db_config
+        self.flush_batch = flush_batch
+        self.on_commit = on_commit
+        # Optional instrumentation: commit latency callback and cursor wrapper (see metrics.py)
+        self.observe_commit = observe_commit
+        self.wrap_cursor = wrap_cursor
+        self.name = name
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._conn = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        # Counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.reconnects = 0
+        self.last_commit_seconds = 0.0
+
+    # --- Producer side ---
+
+    def submit(self, row) -> bool:
+        """Queue a row for writing. Returns False (and counts a drop) if the queue is full."""
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "queue_capacity": self._queue.maxsize,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+            "reconnects": self.reconnects,
+            "last_commit_seconds": self.last_commit_seconds,
+        }
+
+    # --- Writer side ---
+
+    def _connection(self):
+        if not self._conn or (hasattr(self._conn, 'open') and not self._conn.open):
+            self._conn = mariadb.connect(**self.db_config)
+        return self._conn
+
+    def _close(self):
+        try:
+            if self._conn:
+                self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    def _write(self, rows: List) -> None:
+        conn = self._connection()
+        cur = conn.cursor()
+        try:
+            result = self.flush_batch(self.wrap_cursor(cur) if self.wrap_cursor else cur, rows)
+            started = time.perf_counter()
+            conn.commit()
+            self.last_commit_seconds = time.perf_counter() - started
+            if self.observe_commit:
+                self.observe_commit(self.last_commit_seconds)
+        finally:
+            cur.close()
+        if self.on_commit and result is not None:
+            try:
+                self.on_commit(result)
+            except Exception as e:
+                log.limited(log.ERROR, (self.name, "callback"), "%s: commit callback failed: %s", self.name, e)
+
+    def _flush(self, rows: List):
+        """Write one batch, holding it through connection loss and lock conflicts."""
+        backoff = 0.5
+        while True:
+            try:
+                self._write(rows)
+                self.written += len(rows)
+                self.batches += 1
+                return
+            except Exception as e:
+                if is_data_error(e):
+                    self._rollback()
+                    if len(rows) == 1:
+                        log.limited(log.ERROR, (self.name, "drop"), "%s: dropping row after data error: %s", self.name, e)
+                        self.failed += 1
+                        return
+                    # Isolate the bad row(s) so the rest of the batch is still stored
+                    log.limited(log.WARNING, (self.name, "batch"), "%s: data error, writing %d rows individually: %s",
+                                self.name, len(rows), e)
+                    for row in rows:
+                        self._flush([row])
+                    return
+                # Lost connection, lock wait timeout, deadlock or anything else: hold the batch
+                if is_connection_error(e):
+                    self._close()
+                    self.reconnects += 1
+                    reason = "database connection lost"
+                else:
+                    self._rollback()
+                    reason = "lock conflict" if is_transient_error(e) else "write failed"
+                if self._stopping and backoff > 8:
+                    log.error("%s: %s during shutdown, discarding %d rows: %s", self.name, reason, len(rows), e)
+                    self.failed += len(rows)
+                    return
+                log.limited(log.ERROR, (self.name, "hold"), "%s: %s, holding %d rows (retrying in %.1fs): %s",
+                            self.name, reason, len(rows), backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _rollback(self):
+        try:
+            if self._conn:
+                self._conn.rollback()
+        except Exception:
+            self._close()
+
+    def _run(self):
+        batch: List = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                break
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+        # Drain whatever is still queued before exiting
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = []
+        if batch:
+            self._flush(batch)
+        self._close()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30.0):
+        """Flush queued rows and stop the writer thread."""
+        if not self._thread:
+            return
+        self._stopping = True
+        # Blocking put: the stop marker must get in even if the queue is full
+        self._queue.put(_STOP)
+        self._thread.join(timeout=timeout)
+        if self._thread.is_alive():
+            log.error("%s: shutdown timed out with %d rows still queued", self.name, self._queue.qsize())
+        self._thread = None
+
+
+class AdaptiveBatchSize:
+    """Batch size that follows measured write latency.
+
+    After each batch, update(rows, seconds) estimates the cost per row and
+    moves the size towards the number of rows that fit in target_seconds:
+    on fast storage batches grow (fewer commits per row), on a slow SD card
+    or a busy server they shrink so one transaction never stalls ingest for
+    long. Growth is limited to doubling per batch; the estimate is smoothed
+    so one slow fsync does not collapse the size.
+    """
+
+    def __init__(self, initial: int = 100, minimum: int = 10, maximum: int = 5000,
+                 target_seconds: float = 0.5):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.target_seconds = max(0.01, float(target_seconds))
+        self.size = min(self.maximum, max(self.minimum, int(initial)))
+        self.seconds_per_row: Optional[float] = None
+
+    def update(self, rows: int, seconds: float) -> int:
+        # Small batches are dominated by the fixed commit cost; learn from full ones
+        if rows <= 0 or rows < self.size // 2:
+            return self.size
+        per_row = max(seconds, 1e-6) / rows
+        if self.seconds_per_row is None:
+            self.seconds_per_row = per_row
+        else:
+            self.seconds_per_row = 0.7 * self.seconds_per_row + 0.3 * per_row
+        wanted = int(self.target_seconds / self.seconds_per_row)
+        self.size = min(self.maximum, max(self.minimum, min(wanted, self.size * 2)))
+        return self.size
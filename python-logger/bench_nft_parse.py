@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+ZopLog nftables log line parser microbenchmark and regression check.
+
+Checks parse_log_line() (nft_log_parser.py) against the corpus of kernel log
+lines in nft_log_corpus.jsonl - one {"line": ..., "expect": {...} or null}
+object per line, where "message" is only compared when given - and then
+times it over the corpus, next to the parser it replaced (prefix search,
+prefix re-spacing and a dict of every key=value pair) as a baseline.
+
+Exits non-zero if a corpus line is parsed differently than expected, so it
+can run before a release:
+
+Usage:
+    python3 bench_nft_parse.py [--corpus nft_log_corpus.jsonl] [--passes 20000]
+        [--check-only] [--json result.json]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from nft_log_parser import parse_log_line
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nft_log_corpus.jsonl")
+
+# --- Baseline: the parser before nft_log_parser.py ---
+
+_LEGACY_PREFIXES = (
+    "ZOPLOG-BLOCKLIST-IN", "ZOPLOG-BLOCKLIST-OUT", "ZOPLOG-BLOCKLIST-FWD",
+    "ZOPLOG-BLOCKLIST-ININ", "ZOPLOG-BLOCKLIST-INOUT", "ZOPLOG-BLOCKLIST-OUTIN", "ZOPLOG-BLOCKLIST-OUTOUT",
+    "ZOPLOG-BLOCKLIST-FWDIN", "ZOPLOG-BLOCKLIST-FWDOUT",
+)
+_legacy_kv_re = re.compile(r"\b([A-Z]+)=([^\s]+)")
+
+
+def _legacy_normalize(msg: str) -> str:
+    for pref in _LEGACY_PREFIXES:
+        i = msg.find(pref)
+        if i != -1:
+            j = i + len(pref)
+            if j < len(msg) and msg[j] != ' ':
+                msg = msg[:j] + ' ' + msg[j:]
+    return msg
+
+
+def legacy_parse(line: str):
+    line = _legacy_normalize(line)
+    found = None
+    for pref in _LEGACY_PREFIXES:
+        if pref in line:
+            found = pref
+            break
+    if not found:
+        return None
+    line = _legacy_normalize(line)
+    direction = "IN" if found.startswith("ZOPLOG-BLOCKLIST-IN") else \
+        "OUT" if found.startswith("ZOPLOG-BLOCKLIST-OUT") else "FWD"
+    fields = {}
+    for match in _legacy_kv_re.finditer(line):
+        if match.group(1) not in fields:
+            fields[match.group(1)] = match.group(2)
+    return direction, fields
+
+# --- Check ---
+
+
+def load_corpus(path: str) -> List[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def check(corpus: List[dict]) -> List[str]:
+    """Differences between parse_log_line() and the corpus expectations."""
+    failures = []
+    for number, case in enumerate(corpus, 1):
+        record = parse_log_line(case["line"])
+        expect = case["expect"]
+        if expect is None or record is None:
+            if (expect is None) != (record is None):
+                failures.append(f"line {number}: expected {'no record' if expect is None else 'a record'}")
+            continue
+        for field, value in expect.items():
+            got = getattr(record, field)
+            if got != value:
+                failures.append(f"line {number}: {field} = {got!r}, expected {value!r}")
+    return failures
+
+# --- Timing ---
+
+
+def time_parser(parse: Callable, lines: List[str], passes: int) -> Dict[str, float]:
+    started = time.perf_counter()
+    for _ in range(passes):
+        for line in lines:
+            parse(line)
+    seconds = time.perf_counter() - started
+    parsed = passes * len(lines)
+    return {"lines": parsed, "seconds": seconds, "lines_per_second": parsed / seconds,
+            "us_per_line": seconds * 1e6 / parsed}
+
+
+def run(args) -> Optional[dict]:
+    corpus = load_corpus(args.corpus)
+    failures = check(corpus)
+    for failure in failures:
+        print(f"MISMATCH {failure}")
+    print(f"Corpus: {len(corpus)} lines, {len(failures)} mismatch(es)")
+    if failures:
+        return None
+    if args.check_only:
+        return {}
+    lines = [case["line"] for case in corpus]
+    return {
+        "corpus_lines": len(lines),
+        "compiled": time_parser(parse_log_line, lines, args.passes),
+        "baseline": time_parser(legacy_parse, lines, args.passes),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the ZopLog nftables log line parser")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="JSON lines corpus of kernel log lines")
+    parser.add_argument("--passes", type=int, default=20000, help="Times the corpus is parsed for timing")
+    parser.add_argument("--check-only", action="store_true", help="Only check the corpus, do not time")
+    parser.add_argument("--json", help="Write the result as JSON to this file ('-' for stdout)")
+    args = parser.parse_args()
+    args.passes = max(1, args.passes)
+
+    result = run(args)
+    if result is None:
+        sys.exit(1)
+    if not result:
+        return
+    if args.json == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    for name in ("compiled", "baseline"):
+        r = result[name]
+        print(f"{name:<10} {r['lines_per_second']:>12,.0f} lines/s  {r['us_per_line']:6.2f} us/line")
+    print(f"Speed-up: {result['baseline']['us_per_line'] / result['compiled']['us_per_line']:.2f}x")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Result written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
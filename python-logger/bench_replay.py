@@ -0,0 +1,593 @@
+#!/usr/bin/env python3
+"""
+ZopLog packet logger replay benchmark.
+
+Replays one or more pcap files through the logger's packet handler (the same
+packet_from_frame() -> make_packet_handler() path live capture runs, on
+frames of the mmap'd file as capture reads views of its ring) and reports
+throughput, time per stage and per-packet latency. No interface, MariaDB
+server or nft permissions are needed unless asked for:
+
+    --db stub      record statements, answer lookups with no rows (default)
+    --db sqlite    run the logger's SQL against SQLite (in memory, or --sqlite-path)
+    --db mariadb   use the configured MariaDB database (writes real rows!)
+
+    --nft record   render nft transactions without running nft (default)
+    --nft PATH     run PATH as the nft binary (e.g. a fake that logs its input)
+
+Stages: dissect (frame decoding and payload copy), parse (HTTP/TLS/QUIC parsing and flow
+reassembly), db (time inside cursor calls), nft (queueing set additions and
+applying them at the end) and other (whatever remains of the handler).
+
+Use --json to write a machine-readable result (includes the git commit) so
+runs can be compared across commits.
+
+Usage:
+    python3 bench_replay.py capture.pcap [more.pcap ...] [--repeat 3]
+        [--realtime] [--db stub|sqlite|mariadb] [--writer] [--no-flow-state]
+        [--blocklist domains.txt] [--whitelist domains.txt] [--json result.json]
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+from array import array
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import logger
+from batch_writer import BatchWriter
+from db_pool import ConnectionPool
+from nft_updater import NftSetUpdater
+from tpacket_capture import PcapFileSource
+from zoplog_config import load_settings_config
+import zoplog_log
+
+
+# --- Stage timing ---
+
+class StageTimer:
+    """Accumulates wall time and call counts per stage."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+
+    def add(self, stage: str, elapsed: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def wrap(self, stage: str, fn):
+        perf = time.perf_counter
+        add = self.add
+
+        def timed(*args, **kwargs):
+            started = perf()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                add(stage, perf() - started)
+        return timed
+
+
+class TimedCursor:
+    """Cursor proxy that books every database call under the 'db' stage."""
+
+    def __init__(self, cursor, timer: StageTimer):
+        self._cursor = cursor
+        self._timer = timer
+
+    def _timed(self, name, *args):
+        started = time.perf_counter()
+        try:
+            return getattr(self._cursor, name)(*args)
+        finally:
+            self._timer.add("db", time.perf_counter() - started)
+
+    def execute(self, *args):
+        return self._timed("execute", *args)
+
+    def executemany(self, *args):
+        return self._timed("executemany", *args)
+
+    def fetchone(self):
+        return self._timed("fetchone")
+
+    def fetchall(self):
+        return self._timed("fetchall")
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+# --- Database backends ---
+
+class StubCursor:
+    """Records statements; INSERTs get stable fake ids, SELECTs return no rows."""
+
+    def __init__(self, backend: "StubBackend"):
+        self.backend = backend
+        self.lastrowid = 0
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.backend.count(sql)
+        if params and sql.lstrip().upper().startswith("INSERT"):
+            self.lastrowid = self.backend.ids.setdefault((sql, params[0]), len(self.backend.ids) + 1)
+        self.rowcount = 1
+
+    def executemany(self, sql, rows):
+        self.backend.count(sql, len(rows))
+        self.rowcount = len(rows)
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class StubConnection:
+    open = True
+
+    def __init__(self, backend: "StubBackend"):
+        self.backend = backend
+
+    def cursor(self, *args):
+        return StubCursor(self.backend)
+
+    def commit(self):
+        self.backend.count("COMMIT")
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+
+class StubBackend:
+    name = "stub"
+
+    def __init__(self):
+        self.ids: Dict[tuple, int] = {}
+        self.statements: Dict[str, int] = {}
+
+    def count(self, sql: str, rows: int = 1):
+        words = sql.split()
+        kind = words[0].upper() if words else "?"
+        table = next((w for w in words[1:4] if w.upper() not in ("INTO", "FROM", "1", "DISTINCT")), "")
+        key = f"{kind} {table}".strip()
+        self.statements[key] = self.statements.get(key, 0) + rows
+
+    def connect(self):
+        return StubConnection(self)
+
+    def report(self) -> dict:
+        return {"statements": dict(sorted(self.statements.items()))}
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ip_addresses (id INTEGER PRIMARY KEY, ip_address TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS mac_addresses (id INTEGER PRIMARY KEY, mac_address TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS domains (id INTEGER PRIMARY KEY, domain TEXT NOT NULL UNIQUE, ip_id INTEGER);
+CREATE TABLE IF NOT EXISTS paths (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS user_agents (id INTEGER PRIMARY KEY, user_agent TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS accept_languages (id INTEGER PRIMARY KEY, accept_language TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS domain_ip_addresses (
+    id INTEGER PRIMARY KEY, domain_id INTEGER NOT NULL, ip_address_id INTEGER NOT NULL,
+    first_seen TEXT, last_seen TEXT, blocked_count INTEGER NOT NULL DEFAULT 0,
+    allowed_count INTEGER NOT NULL DEFAULT 0, UNIQUE (domain_id, ip_address_id));
+CREATE TABLE IF NOT EXISTS packet_logs (
+    id INTEGER PRIMARY KEY, packet_timestamp TEXT NOT NULL, src_ip_id INTEGER, src_port INTEGER,
+    dst_ip_id INTEGER, dst_port INTEGER, method TEXT, domain_id INTEGER, path_id INTEGER,
+    user_agent_id INTEGER, accept_language_id INTEGER, type TEXT, src_mac_id INTEGER, dst_mac_id INTEGER,
+    hit_count INTEGER NOT NULL DEFAULT 1, last_timestamp TEXT);
+CREATE TABLE IF NOT EXISTS packet_log_minutes (
+    minute TEXT NOT NULL, type TEXT NOT NULL, method TEXT NOT NULL, requests INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (minute, type, method));
+CREATE TABLE IF NOT EXISTS blocklists (id INTEGER PRIMARY KEY, active TEXT NOT NULL DEFAULT 'active', updated_at TEXT);
+CREATE TABLE IF NOT EXISTS blocklist_domains (id INTEGER PRIMARY KEY, blocklist_id INTEGER NOT NULL, domain TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS idx_blocklist_domains_domain ON blocklist_domains (domain);
+CREATE TABLE IF NOT EXISTS whitelists (id INTEGER PRIMARY KEY, active TEXT NOT NULL DEFAULT 'active', updated_at TEXT);
+CREATE TABLE IF NOT EXISTS whitelist_domains (id INTEGER PRIMARY KEY, whitelist_id INTEGER NOT NULL, domain TEXT NOT NULL);
+"""
+
+# INSERT ... ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id) as used by get_or_insert()
+_UPSERT_ID_RE = re.compile(
+    r"^\s*INSERT INTO (\w+) \((\w+)\) VALUES \(%s\)\s+ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID\(id\)\s*$")
+
+
+def mysql_to_sqlite(sql: str) -> str:
+    """Translate the MariaDB dialect used by logger.py to SQLite."""
+    sql = sql.replace("%s", "?")
+    sql = re.sub(r"DATE_SUB\(NOW\(\), INTERVAL (\d+) HOUR\)", r"datetime('now', '-\1 hours')", sql)
+    sql = sql.replace("NOW()", "datetime('now')")
+    sql = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", sql)
+    return sql.replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT DO UPDATE SET")
+
+
+class SqliteCursor:
+    def __init__(self, conn: sqlite3.Connection):
+        self._cur = conn.cursor()
+        self.lastrowid = 0
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    def execute(self, sql, params=()):
+        m = _UPSERT_ID_RE.match(sql)
+        if m:
+            table, column = m.groups()
+            self._cur.execute(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", params)
+            self._cur.execute(f"SELECT id FROM {table} WHERE {column} = ?", params)
+            self.lastrowid = self._cur.fetchone()[0]
+            return
+        self._cur.execute(mysql_to_sqlite(sql), params or ())
+        self.lastrowid = self._cur.lastrowid
+
+    def executemany(self, sql, rows):
+        self._cur.executemany(mysql_to_sqlite(sql), rows)
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def close(self):
+        self._cur.close()
+
+
+class SqliteConnection:
+    open = True
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def cursor(self, *args):
+        return SqliteCursor(self._conn)
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteBackend:
+    name = "sqlite"
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SQLITE_SCHEMA)
+
+    def seed_lists(self, blocklist: List[str], whitelist: List[str]):
+        """Mirror the preloaded lists so the SQL fallbacks see the same data."""
+        cur = self._conn.cursor()
+        if blocklist:
+            cur.execute("INSERT OR IGNORE INTO blocklists (id, active) VALUES (1, 'active')")
+            cur.executemany("INSERT INTO blocklist_domains (blocklist_id, domain) VALUES (1, ?)",
+                            [(d,) for d in blocklist])
+        if whitelist:
+            cur.execute("INSERT OR IGNORE INTO whitelists (id, active) VALUES (1, 'active')")
+            cur.executemany("INSERT INTO whitelist_domains (whitelist_id, domain) VALUES (1, ?)",
+                            [(d,) for d in whitelist])
+        self._conn.commit()
+
+    def connect(self):
+        return SqliteConnection(self._conn)
+
+    def report(self) -> dict:
+        cur = self._conn.cursor()
+        counts = {}
+        for table in ("packet_logs", "domains", "ip_addresses", "domain_ip_addresses"):
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            counts[table] = cur.fetchone()[0]
+        return {"rows": counts}
+
+
+class MariaDBBackend:
+    name = "mariadb"
+
+    def connect(self):
+        return logger.mariadb.connect(**logger.DB_CONFIG)
+
+    def report(self) -> dict:
+        return {}
+
+
+def install_backend(backend, timer: StageTimer):
+    """Route the logger's connection pool through the backend and the db timer."""
+    logger.db_pool = ConnectionPool({}, name="bench-db", size=1, write_size=1,
+                                    connect=lambda autocommit: backend.connect(),
+                                    wrap_cursor=lambda cur: TimedCursor(cur, timer))
+
+
+class BenchBatchWriter(BatchWriter):
+    """BatchWriter whose connection comes from the benchmark backend."""
+
+    def __init__(self, backend, timer: StageTimer, **kwargs):
+        super().__init__({}, logger.write_packet_logs, name="bench-writer", **kwargs)
+        self.backend = backend
+        self.timer = timer
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = self.backend.connect()
+        return self._conn
+
+    def _write(self, rows):
+        started = time.perf_counter()
+        try:
+            super()._write(rows)
+        finally:
+            self.timer.add("db_writer", time.perf_counter() - started)
+
+
+class RecordingNftUpdater(NftSetUpdater):
+    """Renders transactions like the real updater but never runs nft."""
+
+    def __init__(self, **kwargs):
+        super().__init__(nft_binary="nft", **kwargs)
+        self.scripts = 0
+        self.script_bytes = 0
+
+    def _run_nft(self, script: str):
+        self.scripts += 1
+        self.script_bytes += len(script)
+        self.transactions += 1
+        return True, ""
+
+
+# --- Replay ---
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def read_domain_file(path: Optional[str]) -> List[str]:
+    if not path:
+        return []
+    domains = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                # Accept hosts-file lines ("0.0.0.0 ads.example.com") as well as bare domains
+                domains.append(line.split()[-1].lower().rstrip("."))
+    return domains
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError, OSError):
+        return None
+
+
+def run(args) -> dict:
+    timer = StageTimer()
+    settings = load_settings_config()
+    settings["log_level"] = "INFO"
+    zoplog_log.configure(settings["log_level"])
+
+    logger.configure_id_caches(settings)
+    logger.configure_decision_cache(settings)
+    logger.configure_flow_table(settings)
+    if args.no_flow_state:
+        settings["flow_state_max_flows"] = 0
+    logger.configure_flow_states(settings)
+    logger.configure_dns_cache(settings)
+    logger.configure_quic_parser(settings)
+
+    if args.db == "stub":
+        backend = StubBackend()
+    elif args.db == "sqlite":
+        backend = SqliteBackend(args.sqlite_path)
+    else:
+        backend = MariaDBBackend()
+    install_backend(backend, timer)
+
+    blocklist = read_domain_file(args.blocklist)
+    whitelist = read_domain_file(args.whitelist)
+    if args.db != "mariadb":
+        # Offline runs answer list lookups from memory, as a running logger does
+        logger.blocklist_index.preload(1, blocklist)
+        logger.whitelist_matcher.preload(whitelist)
+        if isinstance(backend, SqliteBackend):
+            backend.seed_lists(blocklist, whitelist)
+    else:
+        logger.blocklist_index.refresh()
+        logger.whitelist_matcher.refresh()
+
+    if args.nft == "record":
+        updater = RecordingNftUpdater(element_timeout=settings.get("firewall_rule_timeout", 10800))
+    else:
+        updater = NftSetUpdater(nft_binary=args.nft, element_timeout=settings.get("firewall_rule_timeout", 10800))
+    # Not started: additions are applied in one timed flush at the end
+    logger._nft_updater = updater
+
+    writer = None
+    if args.writer:
+        writer = BenchBatchWriter(backend, timer,
+                                  queue_size=settings.get("writer_queue_size", 10000),
+                                  batch_size=settings.get("writer_batch_size", 200),
+                                  flush_interval=settings.get("writer_flush_interval", 1.0))
+        logger._packet_writer = writer
+        writer.start()
+    else:
+        logger._packet_writer = None
+    settings["request_coalesce_window"] = args.coalesce_window
+    logger.start_request_coalescer(settings)
+
+    # Time the stages by wrapping the module-level functions the handlers call
+    logger.parse_http_request = timer.wrap("parse", logger.parse_http_request)
+    logger.parse_sni_from_bytes = timer.wrap("parse", logger.parse_sni_from_bytes)
+    logger.flow_table.feed = timer.wrap("parse", logger.flow_table.feed)
+    if logger.quic_parser is not None:
+        logger.quic_parser.extract_client_hello = timer.wrap("parse", logger.quic_parser.extract_client_hello)
+    logger._process_dns_packet = timer.wrap("parse", logger._process_dns_packet)
+    logger.ipset_add_ip = timer.wrap("nft", logger.ipset_add_ip)
+
+    handler = logger.make_packet_handler(settings)
+    packet_from_frame = logger.packet_from_frame
+    perf = time.perf_counter
+    latencies = array("d")
+    counts = {"frames": 0, "packets": 0}
+
+    link = [None]
+
+    def on_frame(frame, ts):
+        started = perf()
+        packet = packet_from_frame(frame, ts, link[0])
+        dissected = perf()
+        timer.add("dissect", dissected - started)
+        counts["frames"] += 1
+        if packet is not None:
+            counts["packets"] += 1
+            handler(packet)
+        finished = perf()
+        timer.add("handler", finished - dissected)
+        latencies.append(finished - started)
+
+    started = perf()
+    for _ in range(args.repeat):
+        for path in args.pcaps:
+            source = PcapFileSource(path, realtime=args.realtime)
+            link[0] = source.link_type
+            try:
+                while not source.eof:
+                    source.read(on_frame)
+            finally:
+                source.close()
+    replay_seconds = perf() - started
+
+    flush_started = perf()
+    updater.flush()
+    timer.add("nft", perf() - flush_started)
+    coalescer = logger._request_coalescer
+    coalescer_stats = coalescer.stats() if coalescer is not None else None
+    logger.stop_request_coalescer()
+    if writer is not None:
+        writer.stop()
+    elapsed = perf() - started
+
+    ordered = sorted(latencies)
+    frames = counts["frames"]
+    stage_seconds = dict(timer.seconds)
+    handler_seconds = stage_seconds.pop("handler", 0.0)
+    inner = sum(stage_seconds.get(s, 0.0) for s in ("parse", "db", "nft"))
+    stage_seconds["other"] = max(0.0, handler_seconds - inner)
+    stages = {
+        name: {
+            "seconds": round(seconds, 6),
+            "calls": timer.calls.get(name, 0),
+            "us_per_frame": round(seconds / frames * 1e6, 3) if frames else 0.0,
+        }
+        for name, seconds in sorted(stage_seconds.items())
+    }
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "pcaps": [os.path.abspath(p) for p in args.pcaps],
+        "repeat": args.repeat,
+        "realtime": args.realtime,
+        "db": backend.name,
+        "writer": bool(args.writer),
+        "coalesce_window": args.coalesce_window,
+        "frames": frames,
+        "packets": counts["packets"],
+        "replay_seconds": round(replay_seconds, 6),
+        "elapsed_seconds": round(elapsed, 6),
+        "frames_per_second": round(frames / replay_seconds, 1) if replay_seconds else 0.0,
+        "stages": stages,
+        "latency_us": {
+            "p50": round(percentile(ordered, 0.50) * 1e6, 3),
+            "p90": round(percentile(ordered, 0.90) * 1e6, 3),
+            "p99": round(percentile(ordered, 0.99) * 1e6, 3),
+            "max": round((ordered[-1] if ordered else 0.0) * 1e6, 3),
+        },
+        "backend": backend.report(),
+        "nft": updater.stats(),
+        "decision_cache": logger.decision_cache_stats(),
+        "id_caches": logger.id_cache_stats(),
+        "flow_table": logger.flow_table.stats(),
+        "flow_state": logger.flow_states.stats(),
+        "coalescer": coalescer_stats,
+    }
+
+
+def print_summary(result: dict):
+    print(f"Replayed {result['frames']} frames ({result['packets']} TCP/UDP packets) "
+          f"in {result['replay_seconds']:.3f}s: {result['frames_per_second']:.0f} frames/s "
+          f"[db={result['db']}{', batched writer' if result['writer'] else ''}]")
+    lat = result["latency_us"]
+    print(f"Latency per frame: p50={lat['p50']:.1f}us p90={lat['p90']:.1f}us "
+          f"p99={lat['p99']:.1f}us max={lat['max']:.1f}us")
+    print("Stage          seconds      calls   us/frame")
+    for name, stage in result["stages"].items():
+        print(f"{name:<12} {stage['seconds']:>9.3f} {stage['calls']:>10} {stage['us_per_frame']:>10.2f}")
+    fs = result["flow_state"]
+    print(f"Flow states: {fs['skipped']} of {fs['lookups']} TCP payload segments skipped without parsing "
+          f"({fs['flows']} connections tracked)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay pcap files through the ZopLog packet logger and measure it")
+    parser.add_argument("pcaps", nargs="+", help="Classic pcap files (Ethernet or raw IP) to replay")
+    parser.add_argument("--repeat", type=int, default=1, help="Replay the files this many times")
+    parser.add_argument("--realtime", action="store_true", help="Pace frames to the original capture timing")
+    parser.add_argument("--db", choices=("stub", "sqlite", "mariadb"), default="stub", help="Database backend")
+    parser.add_argument("--sqlite-path", default=":memory:", help="SQLite database file for --db sqlite")
+    parser.add_argument("--writer", action="store_true", help="Write packet logs through the batched background writer")
+    parser.add_argument("--coalesce-window", type=float, default=0.0,
+                        help="Connection-summary window in seconds (0 = one row per request)")
+    parser.add_argument("--no-flow-state", action="store_true",
+                        help="Parse every TCP segment (disable the per-connection classification state)")
+    parser.add_argument("--nft", default="record", help="'record' (default) or the nft binary to run")
+    parser.add_argument("--blocklist", help="File of blocked domains (one per line, hosts format accepted)")
+    parser.add_argument("--whitelist", help="File of whitelisted domains")
+    parser.add_argument("--json", help="Write the result as JSON to this file ('-' for stdout)")
+    args = parser.parse_args()
+    args.repeat = max(1, args.repeat)
+
+    result = run(args)
+    if args.json == "-":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        return
+    print_summary(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Result written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+blocked_count bookkeeping for the block-log reader.
+
+Every block event used to run an UPDATE of domain_ip_addresses whose
+duplicate check (no count for the same source/destination pair within five
+seconds) was two correlated subqueries over blocked_events, a cost that grew
+with the table. The check is now a sliding window in memory keyed on
+(src_ip_id, dst_ip_id), and the increments are summed per
+(domain_id, ip_address_id) and written every flush_interval seconds as one
+batched upsert.
+
+The protocol matches BlockedMinuteRollup: add() per event, write(cursor)
+inside the caller's transaction, then committed() or discard(). Counts that
+were not written yet survive a rollback; only the current batch is undone.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+BLOCKED_COUNT_UPSERT = """
+    INSERT INTO domain_ip_addresses (domain_id, ip_address_id, blocked_count, last_seen)
+    VALUES (%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE blocked_count = blocked_count + VALUES(blocked_count),
+                            last_seen = GREATEST(last_seen, VALUES(last_seen))
+"""
+
+DUPLICATE_WINDOW_SECONDS = 5.0
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+
+class BlockedCounts:
+    """Duplicate-suppressed blocked_count increments between flushes."""
+
+    def __init__(self, window: float = DUPLICATE_WINDOW_SECONDS, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.window = max(0.0, float(window))
+        self.flush_interval = max(0.0, float(flush_interval))
+        # (src_ip_id, dst_ip_id) -> time of its last counted event, oldest first
+        self._last_counted: "OrderedDict[Tuple[int, int], float]" = OrderedDict()
+        # (domain_id, ip_address_id) -> [count, latest event time]
+        self._pending: Dict[Tuple[int, int], list] = {}
+        # Same for the batch in progress, plus what it changed in the window
+        self._batch: Dict[Tuple[int, int], list] = {}
+        self._undo: List[Tuple[Tuple[int, int], Optional[float]]] = []
+        self._written = False
+        self._next_flush = time.monotonic() + self.flush_interval
+        # Counters
+        self.counted = 0
+        self.suppressed = 0
+        self.flushes = 0
+
+    def add(self, src_ip_id: Optional[int], dst_ip_id: Optional[int], domain_id: Optional[int],
+            ip_address_id: Optional[int], when: float) -> bool:
+        """Count one block event unless the pair was counted within the window; returns whether it was."""
+        if not domain_id or not ip_address_id:
+            return False
+        pair = (src_ip_id, dst_ip_id)
+        last = self._last_counted
+        previous = last.get(pair)
+        if previous is not None and 0 <= when - previous < self.window:
+            self.suppressed += 1
+            return False
+        last.pop(pair, None)
+        last[pair] = when
+        self._undo.append((pair, previous))
+        while last:
+            oldest = next(iter(last.values()))
+            if when - oldest < self.window:
+                break
+            last.popitem(last=False)
+        entry = self._batch.setdefault((domain_id, ip_address_id), [0, when])
+        entry[0] += 1
+        entry[1] = max(entry[1], when)
+        return True
+
+    def due(self) -> bool:
+        return bool(self._pending or self._batch) and time.monotonic() >= self._next_flush
+
+    def write(self, cursor, force: bool = False):
+        """Upsert the pending increments if the flush interval has passed (or force)."""
+        if not force and not self.due():
+            return
+        rows: Dict[Tuple[int, int], list] = {key: list(entry) for key, entry in self._pending.items()}
+        for key, (count, when) in self._batch.items():
+            entry = rows.setdefault(key, [0, when])
+            entry[0] += count
+            entry[1] = max(entry[1], when)
+        if not rows:
+            return
+        # Sorted to keep lock order stable across concurrent writers
+        cursor.executemany(BLOCKED_COUNT_UPSERT, [
+            (domain_id, ip_id, count, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when)))
+            for (domain_id, ip_id), (count, when) in sorted(rows.items())
+        ])
+        self._written = True
+
+    def committed(self):
+        if self._written:
+            self._pending.clear()
+            self._next_flush = time.monotonic() + self.flush_interval
+            self.flushes += 1
+        else:
+            for key, (count, when) in self._batch.items():
+                entry = self._pending.setdefault(key, [0, when])
+                entry[0] += count
+                entry[1] = max(entry[1], when)
+        self.counted += sum(count for count, _ in self._batch.values())
+        self._batch.clear()
+        self._undo.clear()
+        self._written = False
+
+    def discard(self):
+        """Undo the batch in progress after a rollback so its events count again if retried."""
+        last = self._last_counted
+        for pair, previous in reversed(self._undo):
+            if previous is None:
+                last.pop(pair, None)
+            else:
+                last[pair] = previous
+        self._batch.clear()
+        self._undo.clear()
+        self._written = False
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pairs": len(self._last_counted),
+            "pending": len(self._pending) + len(self._batch),
+            "counted": self.counted,
+            "suppressed": self.suppressed,
+            "flushes": self.flushes,
+        }
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+In-memory index of active blocklist domains for the ZopLog packet logger.
+
+The logger checks every HTTP Host, TLS SNI and QUIC hostname against the
+active blocklists. Running a blocklist_domains JOIN blocklists query for each
+of them is the main latency on large lists, so this module keeps a hostname ->
+(blocklist_id, blocklist_domain_id) map in process memory instead.
+
+The index is refreshed by a background thread using a cheap per-blocklist
+signature (active flag, updated_at, row count and max row id). Only the
+blocklists whose signature changed are reloaded, and the hosts of each list
+are kept in a set of their own, so adding, toggling or reloading one list
+costs time in proportion to that list, never to the whole index.
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import pymysql as mariadb
+import pymysql.cursors
+
+import zoplog_log as log
+
+# Entries are packed as (blocklist_id << 32) | blocklist_domain_id. Hosts that
+# appear in a single list (the common case) store one int, hosts that appear
+# in several lists store a tuple of packed ints.
+_ID_BITS = 32
+_ID_MASK = (1 << _ID_BITS) - 1
+
+SIGNATURE_QUERY = (
+    "SELECT bl.id, bl.active, bl.updated_at, COUNT(bd.id), MAX(bd.id) "
+    "FROM blocklists bl "
+    "LEFT JOIN blocklist_domains bd ON bd.blocklist_id = bl.id AND bl.active = 'active' "
+    "GROUP BY bl.id, bl.active, bl.updated_at"
+)
+
+DOMAINS_QUERY = "SELECT id, domain FROM blocklist_domains WHERE blocklist_id = %s"
+
+
+def _pack(blocklist_id: int, blocklist_domain_id: int) -> int:
+    return (int(blocklist_id) << _ID_BITS) | (int(blocklist_domain_id) & _ID_MASK)
+
+
+def _unpack(packed: int) -> Tuple[int, int]:
+    return packed >> _ID_BITS, packed & _ID_MASK
+
+
+def _normalize_domain(domain) -> str:
+    if isinstance(domain, bytes):
+        domain = domain.decode('utf-8', errors='ignore')
+    return (domain or "").strip().lower().rstrip('.')
+
+
+class BlocklistIndex:
+    """Hostname -> [(blocklist_id, blocklist_domain_id)] map for active blocklists.
+
+    Reads are lock-free dict probes from the capture thread; all mutations
+    happen on the single refresh thread.
+    """
+
+    def __init__(self, db_config: dict, refresh_interval: float = 30.0):
+        self.db_config = db_config
+        self.refresh_interval = refresh_interval
+        self.loaded = False
+        self.version = 0  # bumped whenever the set of blocked hosts changes
+        self._index: Dict[str, object] = {}
+        # blocklist_id -> hosts it contributes to _index
+        self._list_hosts: Dict[int, Set[str]] = {}
+        self._signatures: Dict[int, tuple] = {}
+        self._conn = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    # --- Lookups (capture thread) ---
+
+    def lookup(self, host: str) -> List[Tuple[int, int]]:
+        """Return (blocklist_id, blocklist_domain_id) pairs for an exact host match."""
+        value = self._index.get(host)
+        if value is None:
+            return []
+        if isinstance(value, int):
+            return [_unpack(value)]
+        return [_unpack(v) for v in value]
+
+    def blocklist_ids(self, host: str) -> List[int]:
+        """Return the distinct blocklist IDs containing an exact match of host."""
+        return sorted({bl_id for bl_id, _ in self.lookup(host)})
+
+    # --- Index mutation (refresh thread) ---
+
+    def _set_entry(self, host: str, blocklist_id: int, packed: int):
+        value = self._index.get(host)
+        if value is None:
+            self._index[host] = packed
+            return
+        if isinstance(value, int):
+            if value >> _ID_BITS == blocklist_id:
+                self._index[host] = packed
+            else:
+                self._index[host] = (value, packed)
+            return
+        kept = tuple(v for v in value if v >> _ID_BITS != blocklist_id)
+        self._index[host] = kept + (packed,)
+
+    def _drop_entry(self, host: str, blocklist_id: int):
+        value = self._index.get(host)
+        if value is None:
+            return
+        if isinstance(value, int):
+            if value >> _ID_BITS == blocklist_id:
+                del self._index[host]
+            return
+        kept = tuple(v for v in value if v >> _ID_BITS != blocklist_id)
+        if not kept:
+            del self._index[host]
+        elif len(kept) == 1:
+            self._index[host] = kept[0]
+        else:
+            self._index[host] = kept
+
+    def _remove_blocklist(self, blocklist_id: int) -> int:
+        hosts = self._list_hosts.pop(blocklist_id, set())
+        for host in hosts:
+            self._drop_entry(host, blocklist_id)
+        return len(hosts)
+
+    def _load_blocklist(self, conn, blocklist_id: int) -> int:
+        """Stream one blocklist's rows and swap them in without a gap for existing hosts."""
+        fresh: Dict[str, int] = {}
+        cur = conn.cursor(pymysql.cursors.SSCursor)
+        try:
+            cur.execute(DOMAINS_QUERY, (blocklist_id,))
+            for bd_id, domain in cur:
+                host = _normalize_domain(domain)
+                if host:
+                    fresh[host] = _pack(blocklist_id, bd_id)
+        finally:
+            cur.close()
+
+        for host, packed in fresh.items():
+            self._set_entry(host, blocklist_id, packed)
+        for host in self._list_hosts.get(blocklist_id, ()):
+            if host not in fresh:
+                self._drop_entry(host, blocklist_id)
+        self._list_hosts[blocklist_id] = set(fresh)
+        return len(fresh)
+
+    def preload(self, blocklist_id: int, hosts) -> int:
+        """Load hosts as one blocklist without a database (offline replay and benchmarks).
+
+        Synthetic blocklist_domain ids are assigned in order, starting at 1.
+        """
+        with self._lock:
+            count = 0
+            listed = self._list_hosts.setdefault(int(blocklist_id), set())
+            for bd_id, host in enumerate(hosts, start=1):
+                host = _normalize_domain(host)
+                if host:
+                    self._set_entry(host, int(blocklist_id), _pack(blocklist_id, bd_id))
+                    listed.add(host)
+                    count += 1
+            self.version += 1
+            self.loaded = True
+            return count
+
+    # --- Refresh ---
+
+    def _connection(self):
+        if not self._conn or (hasattr(self._conn, 'open') and not self._conn.open):
+            self._conn = mariadb.connect(**self.db_config)
+        return self._conn
+
+    def refresh(self) -> bool:
+        """Reconcile the index with the database. Returns True if anything changed."""
+        with self._lock:
+            conn = self._connection()
+            # Each refresh must see the latest committed blocklist changes
+            conn.commit()
+            cur = conn.cursor()
+            try:
+                cur.execute(SIGNATURE_QUERY)
+                rows = cur.fetchall()
+            finally:
+                cur.close()
+
+            current = {}
+            for bl_id, active, updated_at, count, max_id in rows:
+                if active == 'active':
+                    current[int(bl_id)] = (str(updated_at), int(count or 0), int(max_id or 0))
+
+            changed = False
+            for bl_id in [b for b in self._signatures if b not in current]:
+                removed = self._remove_blocklist(bl_id)
+                del self._signatures[bl_id]
+                log.info("Blocklist index: dropped blocklist %s (%d domains)", bl_id, removed)
+                changed = True
+
+            for bl_id, signature in current.items():
+                if self._signatures.get(bl_id) == signature:
+                    continue
+                started = time.time()
+                count = self._load_blocklist(conn, bl_id)
+                conn.commit()
+                self._signatures[bl_id] = signature
+                log.info("Blocklist index: loaded blocklist %s (%d domains) in %.1fs", bl_id, count, time.time() - started)
+                changed = True
+
+            if changed:
+                self.version += 1
+            self.loaded = True
+            return changed
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                log.limited(log.WARNING, "blocklist-refresh", "Blocklist index refresh failed: %s", e)
+                try:
+                    if self._conn:
+                        self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None
+            self._stop.wait(self.refresh_interval)
+
+    def start(self):
+        """Load the index and keep it in sync from a daemon thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="blocklist-index", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        try:
+            if self._conn:
+                self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
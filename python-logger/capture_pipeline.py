@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Capture/worker pipeline for the ZopLog packet logger.
+
+The capture thread only reads frames from the interface and places them on
+a bounded per-worker queue; SNI/DNS parsing, database lookups and firewall
+updates all happen in a pool of worker threads. A slow query or nft call
+therefore delays one worker instead of stalling capture. The logger queues
+dissected packets rather than raw frames: frames of the TPACKET_V3 ring are
+only valid during the capture callback, and decoding their headers there
+lets it copy just the payload bytes a worker will use.
+
+Items are assigned to workers by a hash of the flow so per-flow ordering is
+kept: TCP uses the symmetric 4-tuple (both directions land on the same
+worker), UDP DNS/QUIC uses the client address so a DNS answer is always
+processed before the QUIC flow that depends on it. flow_shard() computes it
+for raw Ethernet frames, packet_shard() for dissected packets.
+"""
+
+import queue
+import select
+import socket
+import struct
+import threading
+import time
+from typing import Callable, List, Optional
+
+from dissector import LINK_RAW_IP, interface_link_type
+from packet_fanout import join_fanout
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+VLAN_TPIDS = (0x8100, 0x88A8)
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+UDP_SERVER_PORTS = (53, 443)
+
+# getsockopt(SOL_PACKET, PACKET_STATISTICS) -> struct tpacket_stats
+SOL_PACKET = 263
+PACKET_STATISTICS = 6
+
+_STOP = object()
+
+
+def flow_shard(frame: bytes, workers: int) -> int:
+    """Pick a worker for an Ethernet frame so that related packets share it."""
+    if workers <= 1:
+        return 0
+    try:
+        off = 12
+        etype = (frame[off] << 8) | frame[off + 1]
+        off += 2
+        while etype in VLAN_TPIDS:
+            etype = (frame[off + 2] << 8) | frame[off + 3]
+            off += 4
+        if etype == ETH_P_IP:
+            ihl = (frame[off] & 0x0F) * 4
+            proto = frame[off + 9]
+            src = frame[off + 12:off + 16]
+            dst = frame[off + 16:off + 20]
+            l4 = off + ihl
+        elif etype == ETH_P_IPV6:
+            proto = frame[off + 6]
+            src = frame[off + 8:off + 24]
+            dst = frame[off + 24:off + 40]
+            l4 = off + 40
+        else:
+            return 0
+        sport, dport = struct.unpack_from("!HH", frame, l4)
+    except (IndexError, struct.error):
+        return 0
+
+    if proto == IPPROTO_UDP:
+        # DNS answers come from :53 and QUIC goes to :443 - key on the client
+        if sport in UDP_SERVER_PORTS:
+            return hash(dst) % workers
+        return hash(src) % workers
+    a, b = (src, sport), (dst, dport)
+    return hash((a, b) if a <= b else (b, a)) % workers
+
+
+def packet_shard(packet, workers: int) -> int:
+    """flow_shard() for a dissected packet (see dissector.Packet)."""
+    if workers <= 1:
+        return 0
+    if packet.proto == IPPROTO_UDP:
+        if packet.sport in UDP_SERVER_PORTS:
+            return hash(packet.dst_ip) % workers
+        return hash(packet.src_ip) % workers
+    a, b = (packet.src_ip, packet.sport), (packet.dst_ip, packet.dport)
+    return hash((a, b) if a <= b else (b, a)) % workers
+
+
+class CapturePipeline:
+    """Bounded per-worker queues drained by a pool of handler threads.
+
+    Items are raw frames by default; pass shard=packet_shard to queue
+    dissected packets instead.
+    """
+
+    def __init__(self, handle_frame: Callable, workers: int = 2, queue_size: int = 4096,
+                 on_worker_exit: Optional[Callable] = None, shard: Callable = flow_shard):
+        self.handle_frame = handle_frame
+        self.shard = shard
+        self.on_worker_exit = on_worker_exit
+        self.workers = max(1, int(workers))
+        per_worker = max(1, int(queue_size) // self.workers)
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self._threads: List[threading.Thread] = []
+        # Counters
+        self.received = 0
+        self.userspace_drops = 0
+        self.handler_errors = 0
+
+    def submit(self, frame: bytes, ts: float) -> bool:
+        self.received += 1
+        q = self._queues[self.shard(frame, self.workers)]
+        try:
+            q.put_nowait((frame, ts))
+        except queue.Full:
+            self.userspace_drops += 1
+            return False
+        return True
+
+    def queue_depths(self) -> List[int]:
+        return [q.qsize() for q in self._queues]
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "received": self.received,
+            "queue_depth": sum(self.queue_depths()),
+            "queue_depths": self.queue_depths(),
+            "userspace_drops": self.userspace_drops,
+            "handler_errors": self.handler_errors,
+        }
+
+    def _worker(self, q: queue.Queue):
+        try:
+            while True:
+                item = q.get()
+                if item is _STOP:
+                    return
+                frame, ts = item
+                try:
+                    self.handle_frame(frame, ts)
+                except Exception:
+                    self.handler_errors += 1
+        finally:
+            if self.on_worker_exit:
+                try:
+                    self.on_worker_exit()
+                except Exception:
+                    pass
+
+    def start(self):
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._worker, args=(q,), name=f"capture-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 10.0):
+        """Let workers finish the frames already queued, then stop them."""
+        for q in self._queues:
+            q.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(timeout=max(0.0, deadline - time.monotonic()))
+        self._threads = []
+
+
+class ScapyL2Source:
+    """Raw frames from a scapy L2 listen socket (the default, portable backend).
+
+    Only recv_raw() is used, so no scapy dissection happens on the capture
+    thread - except on interfaces whose framing the dissector cannot read
+    (the "any" pseudo-interface, for one), where scapy decodes the link layer
+    and the frames are handed on as raw IP packets.
+    """
+
+    def __init__(self, interface: str, bpf_filter: Optional[str] = None, fanout_group: Optional[int] = None):
+        import scapy.all as scapy
+        self.link_type = interface_link_type(interface)
+        self._ip_layers = None
+        if self.link_type is None:
+            self.link_type = LINK_RAW_IP
+            self._ip_layers = (scapy.IP, scapy.IPv6)
+        self._sock = scapy.conf.L2listen(iface=interface, filter=bpf_filter)
+        raw = getattr(self._sock, "ins", None)
+        self._raw = raw if isinstance(raw, socket.socket) else None
+        self.kernel_packets = 0
+        self.kernel_drops = 0
+        self.fanout_mode = None
+        if fanout_group is not None:
+            if self._raw is None:
+                self.close()
+                raise OSError("scapy listen socket is not an AF_PACKET socket; cannot join a fanout group")
+            self.fanout_mode = join_fanout(self._raw, fanout_group)
+
+    def read(self, on_frame: Callable, timeout: float) -> int:
+        ready, _, _ = select.select([self._sock], [], [], timeout)
+        if not ready:
+            return 0
+        cls, frame, ts = self._sock.recv_raw()
+        if frame and self._ip_layers is not None:
+            frame = self._network_layer(cls, frame)
+        if not frame:
+            return 0
+        on_frame(frame, ts if ts is not None else time.time())
+        return 1
+
+    def _network_layer(self, cls, frame: bytes) -> Optional[bytes]:
+        """The IP packet of a frame, with the link layer decoded by scapy."""
+        try:
+            layers = cls(frame)
+        except Exception:
+            return None
+        for ip_layer in self._ip_layers:
+            ip = layers.getlayer(ip_layer)
+            if ip is not None:
+                return bytes(ip)
+        return None
+
+    def update_kernel_stats(self) -> None:
+        """Accumulate PACKET_STATISTICS (the kernel resets them on every read)."""
+        if self._raw is None:
+            return
+        try:
+            raw = self._raw.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8)
+            packets, drops = struct.unpack("II", raw[:8])
+            self.kernel_packets += packets
+            self.kernel_drops += drops
+        except (OSError, struct.error):
+            pass
+
+    def close(self) -> None:
+        try:
+            self._sock.close()
+        except Exception:
+            pass
+
+
+def run_capture(source, on_frame: Callable, stop_event: threading.Event,
+                stats_interval: float = 60.0, report: Optional[Callable] = None):
+    """Feed frames from a capture source to on_frame(frame, ts) until stopped.
+
+    A source provides read(on_frame, timeout) -> frames read,
+    update_kernel_stats() and close(); it may set eof = True when exhausted.
+    """
+    next_report = time.monotonic() + stats_interval
+    while not stop_event.is_set() and not getattr(source, "eof", False):
+        source.read(on_frame, 1.0)
+        if time.monotonic() >= next_report:
+            next_report = time.monotonic() + stats_interval
+            source.update_kernel_stats()
+            if report:
+                report()
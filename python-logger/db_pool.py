@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Shared MariaDB connection pool for the ZopLog services.
+
+A PyMySQL connection must not be used by two threads at once, so instead
+of one global connection every database call checks a connection out for
+the length of one session and returns it afterwards. Read and write
+sessions come from separate bounded sets of connections:
+
+  - read sessions run in autocommit, so every query sees the latest
+    committed data and no snapshot is held open between lookups;
+  - write sessions run one transaction, committed when the session ends
+    and rolled back if it raises.
+
+On checkout a connection idle for longer than idle_timeout (or older than
+max_lifetime) is closed and replaced, and one idle for longer than
+ping_interval is pinged first. A connection that fails with a
+connection-class error is discarded instead of returned. run(), fetchone()
+and fetchall() retry such failures with exponential backoff, so callers no
+longer match "server has gone away" strings themselves.
+
+One-shot tools that need a single connection use connect() for the same
+connect-with-retry behaviour.
+
+Usage:
+    pool = ConnectionPool(load_database_config())
+    rows = pool.fetchall("SELECT id FROM blocklists WHERE active = %s", ("active",))
+    with pool.session(write=True) as cur:
+        cur.execute("UPDATE ...")
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import pymysql as mariadb
+except ImportError:
+    import mysql.connector as mariadb
+
+# Client/server error codes that mean the connection itself is unusable
+CONNECTION_ERRORS = {2002, 2003, 2006, 2013, 2014, 2045, 2055, 1927}
+# Lock wait timeout and deadlock: the transaction was rolled back, retrying it can succeed
+TRANSIENT_ERRORS = {1205, 1213}
+# Values the server rejects whenever they are written (bad NULL, out of range,
+# truncated, invalid value, too long); retrying the same row always fails
+DATA_ERRORS = {1048, 1264, 1265, 1292, 1366, 1406}
+
+READ, WRITE = "read", "write"
+
+
+def error_code(e: Exception) -> Optional[int]:
+    """Server/client error number of a driver exception (None for other exceptions)."""
+    if not isinstance(e, mariadb.Error):
+        return None
+    code = getattr(e, "errno", None)
+    if code is None and e.args and isinstance(e.args[0], int):
+        code = e.args[0]
+    return code
+
+
+def is_connection_error(e: Exception) -> bool:
+    if isinstance(e, mariadb.InterfaceError):
+        return True
+    if isinstance(e, mariadb.OperationalError):
+        return error_code(e) in CONNECTION_ERRORS
+    return False
+
+
+def is_transient_error(e: Exception) -> bool:
+    return error_code(e) in TRANSIENT_ERRORS
+
+
+def is_data_error(e: Exception) -> bool:
+    return isinstance(e, mariadb.DataError) or error_code(e) in DATA_ERRORS
+
+
+def connect(db_config: dict, autocommit: bool = False, retries: int = 3,
+            backoff: float = 0.5, max_backoff: float = 8.0):
+    """Open one connection, retrying connection-class errors with exponential backoff."""
+    delay = backoff
+    for attempt in range(retries + 1):
+        try:
+            return mariadb.connect(**dict(db_config, autocommit=autocommit))
+        except Exception as e:
+            if attempt >= retries or not is_connection_error(e):
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, max_backoff)
+
+
+class PoolTimeout(Exception):
+    """No connection of the requested kind became free within the checkout timeout."""
+
+
+class _Slots:
+    """Idle connections and the checkout limit for one session kind."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.available = threading.BoundedSemaphore(size)
+        # [connection, opened at, last used] (monotonic seconds), most recently used last
+        self.idle: List[list] = []
+
+
+class ConnectionPool:
+    """Bounded pool handing out read and write sessions on separate connections."""
+
+    def __init__(self, db_config: dict, size: int = 4, write_size: Optional[int] = None,
+                 checkout_timeout: float = 5.0, ping_interval: float = 1.0,
+                 idle_timeout: float = 300.0, max_lifetime: float = 3600.0,
+                 retries: int = 2, backoff: float = 0.25, max_backoff: float = 4.0,
+                 name: str = "db-pool", connect: Optional[Callable[[bool], Any]] = None,
+                 wrap_cursor: Optional[Callable] = None,
+                 observe_commit: Optional[Callable[[float], None]] = None):
+        self.db_config = db_config
+        self.name = name
+        self.checkout_timeout = max(0.0, float(checkout_timeout))
+        self.ping_interval = max(0.0, float(ping_interval))
+        self.idle_timeout = max(0.0, float(idle_timeout))
+        self.max_lifetime = max(0.0, float(max_lifetime))
+        self.retries = max(0, int(retries))
+        self.backoff = max(0.0, float(backoff))
+        self.max_backoff = max(self.backoff, float(max_backoff))
+        # connect(autocommit) -> connection; replaced by benchmarks with other backends
+        self._connect = connect or (lambda autocommit: mariadb.connect(**dict(db_config, autocommit=autocommit)))
+        # Optional instrumentation: cursor wrapper and commit latency callback (see metrics.py)
+        self.wrap_cursor = wrap_cursor
+        self.observe_commit = observe_commit
+        size = max(1, int(size))
+        self._slots = {READ: _Slots(size), WRITE: _Slots(max(1, int(write_size or size)))}
+        self._lock = threading.Lock()
+        # Counters
+        self.opened = 0
+        self.reused = 0
+        self.recycled = 0
+        self.ping_failures = 0
+        self.discarded = 0
+        self.retried = 0
+        self.timeouts = 0
+
+    # --- Checkout / checkin ---
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _take_idle(self, slots: _Slots) -> Optional[list]:
+        """Pop a healthy idle connection, closing stale or dead ones on the way."""
+        while True:
+            with self._lock:
+                if not slots.idle:
+                    return None
+                entry = slots.idle.pop()
+            now = time.monotonic()
+            if (self.idle_timeout and now - entry[2] > self.idle_timeout) or \
+                    (self.max_lifetime and now - entry[1] > self.max_lifetime):
+                self._close(entry[0])
+                self.recycled += 1
+                continue
+            if now - entry[2] >= self.ping_interval:
+                try:
+                    entry[0].ping(reconnect=False)
+                except Exception:
+                    self._close(entry[0])
+                    self.ping_failures += 1
+                    continue
+            self.reused += 1
+            return entry
+
+    def _checkout(self, kind: str) -> list:
+        slots = self._slots[kind]
+        if not slots.available.acquire(timeout=self.checkout_timeout):
+            self.timeouts += 1
+            raise PoolTimeout(f"{self.name}: no {kind} connection free after {self.checkout_timeout}s")
+        try:
+            entry = self._take_idle(slots)
+            if entry is None:
+                now = time.monotonic()
+                entry = [self._connect(kind == READ), now, now]
+                self.opened += 1
+            return entry
+        except BaseException:
+            slots.available.release()
+            raise
+
+    def _checkin(self, kind: str, entry: list, broken: bool):
+        slots = self._slots[kind]
+        try:
+            if broken:
+                self._close(entry[0])
+                self.discarded += 1
+            else:
+                entry[2] = time.monotonic()
+                with self._lock:
+                    slots.idle.append(entry)
+        finally:
+            slots.available.release()
+
+    # --- Sessions ---
+
+    @contextmanager
+    def session(self, write: bool = False):
+        """Check out a connection and yield a cursor on it.
+
+        A write session commits when the block exits normally and rolls
+        back if it raises. Connections that failed with a connection-class
+        error are closed instead of returned to the pool.
+        """
+        kind = WRITE if write else READ
+        entry = self._checkout(kind)
+        conn = entry[0]
+        broken = False
+        try:
+            cur = conn.cursor()
+            try:
+                yield self.wrap_cursor(cur) if self.wrap_cursor else cur
+                if write:
+                    started = time.perf_counter()
+                    conn.commit()
+                    if self.observe_commit:
+                        self.observe_commit(time.perf_counter() - started)
+            finally:
+                try:
+                    cur.close()
+                except Exception:
+                    pass
+        except BaseException as e:
+            broken = is_connection_error(e)
+            if write and not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            self._checkin(kind, entry, broken)
+
+    def run(self, fn: Callable, write: bool = False, retries: Optional[int] = None):
+        """Return fn(cursor) run in a session, retrying connection-class errors.
+
+        A failed write session is rolled back before the retry, so fn is
+        run again from the start of a fresh transaction.
+        """
+        retries = self.retries if retries is None else retries
+        delay = self.backoff
+        attempt = 0
+        while True:
+            try:
+                with self.session(write) as cur:
+                    return fn(cur)
+            except Exception as e:
+                if attempt >= retries or not is_connection_error(e):
+                    raise
+                attempt += 1
+                self.retried += 1
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def fetchone(self, sql: str, params: tuple = ()):
+        def query(cur):
+            cur.execute(sql, params)
+            return cur.fetchone()
+        return self.run(query)
+
+    def fetchall(self, sql: str, params: tuple = ()):
+        def query(cur):
+            cur.execute(sql, params)
+            return cur.fetchall()
+        return self.run(query)
+
+    def close(self):
+        """Close the idle connections; the pool reconnects on the next checkout."""
+        for slots in self._slots.values():
+            with self._lock:
+                idle, slots.idle = slots.idle, []
+            for entry in idle:
+                self._close(entry[0])
+
+    def stats(self) -> Dict[str, int]:
+        stats = {}
+        for kind, slots in self._slots.items():
+            stats[f"{kind}_idle"] = len(slots.idle)
+            stats[f"{kind}_capacity"] = slots.size
+        stats.update({
+            "opened": self.opened,
+            "reused": self.reused,
+            "recycled": self.recycled,
+            "ping_failures": self.ping_failures,
+            "discarded": self.discarded,
+            "retried": self.retried,
+            "timeouts": self.timeouts,
+        })
+        return stats
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+TTL cache of block/allow verdicts for (hostname, destination IP) pairs.
+
+A browser opens several parallel connections to the same host within
+milliseconds, and each ClientHello used to repeat the whitelist check, the
+blocklist lookup and the 24-hour shared-IP query. The first connection's
+verdict - whitelisted, allowed, or blocked with the matched
+(blocklist_id, blocklist_domain_id) pairs - is stored here and reused by the
+following ones until it expires.
+
+Allowed verdicts (negative entries) get their own, usually shorter, TTL.
+Every entry records the generation (blocklist index and whitelist matcher
+versions) it was computed under; when either changes, older entries are
+treated as misses, so toggling a list takes effect immediately.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+# Verdict kinds
+WHITELISTED = "whitelisted"
+ALLOWED = "allowed"
+BLOCKED = "blocked"
+
+
+class Verdict:
+    __slots__ = ("kind", "matches")
+
+    def __init__(self, kind: str, matches: Tuple[Tuple[int, int], ...] = ()):
+        self.kind = kind
+        self.matches = matches
+
+
+class DecisionCache:
+    """Bounded LRU of verdicts with separate TTLs for block and allow decisions."""
+
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 30.0, maxsize: int = 16384):
+        self.ttl = max(0.0, float(ttl))
+        self.negative_ttl = max(0.0, float(negative_ttl))
+        self.maxsize = max(0, int(maxsize))
+        self._data: "OrderedDict[Tuple[str, str], Tuple[float, Hashable, Verdict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, host: str, dst_ip: str, generation: Hashable) -> Optional[Verdict]:
+        key = (host, dst_ip)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, entry_generation, verdict = entry
+            if entry_generation != generation or expires <= now:
+                del self._data[key]
+                if entry_generation != generation:
+                    self.invalidated += 1
+                else:
+                    self.expired += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            if verdict.kind != BLOCKED:
+                self.negative_hits += 1
+            return verdict
+
+    def put(self, host: str, dst_ip: str, generation: Hashable, verdict: Verdict):
+        ttl = self.ttl if verdict.kind == BLOCKED else self.negative_ttl
+        if self.maxsize == 0 or ttl <= 0:
+            return
+        key = (host, dst_ip)
+        with self._lock:
+            data = self._data
+            data.pop(key, None)
+            data[key] = (time.monotonic() + ttl, generation, verdict)
+            if len(data) > self.maxsize:
+                data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "invalidated": self.invalidated,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Minimal raw-bytes protocol dissector for the ZopLog packet logger.
+
+Decodes only what the logger needs from a captured frame: MAC addresses,
+IPv4/IPv6 addresses (through VLAN tags and IPv6 extension headers), TCP/UDP
+ports and payload, DNS answer records, and the HTTP request line plus the
+Host, User-Agent and Accept-Language headers. Everything else is skipped, so
+a frame costs a handful of struct reads instead of building a scapy layer
+stack, and TCP segments are never test-dissected as HTTP.
+
+dissect() reads a memoryview of the capture ring as well as bytes, so a
+frame is decoded in place; Packet.detach() then copies only the payload a
+handler still needs (or nothing) before the ring slot is handed back.
+"""
+
+import socket
+import struct
+from typing import List, Optional, Tuple
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+VLAN_TPIDS = (0x8100, 0x88A8, 0x9100)
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+# IPv6 extension headers that may precede the transport header
+IPV6_EXT_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+DNS_TYPE_A = 1
+DNS_TYPE_CNAME = 5
+DNS_TYPE_AAAA = 28
+
+# Link-layer framing of the frames handed to dissect()
+LINK_ETHERNET = "ethernet"
+LINK_RAW_IP = "raw-ip"
+
+ARPHRD_ETHER = 1
+# AF_PACKET gives loopback frames a zeroed Ethernet header
+ARPHRD_LOOPBACK = 772
+# tunnel, tunnel6, PPP, rawip, sit, ipgre, none (tun): frames carry no link header
+RAW_IP_ARPHRDS = frozenset((768, 769, 512, 519, 776, 778, 65534))
+
+_U16 = struct.Struct("!H")
+_PORTS = struct.Struct("!HH")
+_TCP_SEQ = struct.Struct("!I")
+_DNS_HDR = struct.Struct("!HHHHHH")
+_RR_FIXED = struct.Struct("!HHIH")
+
+
+class Packet:
+    """Decoded view of one captured frame.
+
+    After detach() payload holds only the bytes that were kept (possibly
+    none), while payload_len stays the payload length on the wire.
+    """
+
+    __slots__ = ("time", "frame", "src_mac", "dst_mac", "src_ip", "dst_ip", "proto",
+                 "sport", "dport", "tcp_flags", "seq", "payload_offset", "payload_end")
+
+    def __init__(self):
+        self.tcp_flags = 0
+        self.seq = 0
+
+    @property
+    def payload(self) -> bytes:
+        return self.frame[self.payload_offset:self.payload_end]
+
+    @property
+    def payload_len(self) -> int:
+        return self.payload_end - self.payload_offset
+
+    def detach(self, keep_payload: bool):
+        """Stop referencing the frame buffer, copying the payload only if keep_payload."""
+        self.frame = bytes(self.frame[self.payload_offset:self.payload_end]) if keep_payload else b""
+        self.payload_end -= self.payload_offset
+        self.payload_offset = 0
+
+    @property
+    def is_tcp(self) -> bool:
+        return self.proto == IPPROTO_TCP
+
+    @property
+    def is_udp(self) -> bool:
+        return self.proto == IPPROTO_UDP
+
+
+def _mac(frame: bytes, off: int) -> str:
+    return frame[off:off + 6].hex(":")
+
+
+def link_type(arphrd: int) -> Optional[str]:
+    """The framing of an interface's frames from its ARPHRD type; None if dissect() cannot read it."""
+    if arphrd in (ARPHRD_ETHER, ARPHRD_LOOPBACK):
+        return LINK_ETHERNET
+    if arphrd in RAW_IP_ARPHRDS:
+        return LINK_RAW_IP
+    return None
+
+
+def interface_link_type(interface: str) -> Optional[str]:
+    """link_type() of a network interface, read from sysfs; None if it is unknown or unsupported."""
+    try:
+        with open(f"/sys/class/net/{interface}/type") as f:
+            return link_type(int(f.read()))
+    except (OSError, ValueError):
+        return None
+
+
+def dissect(frame, ts: float, link: str = LINK_ETHERNET) -> Optional[Packet]:
+    """Decode a frame (bytes or memoryview) carrying TCP or UDP; None for anything else."""
+    try:
+        n = len(frame)
+        if link == LINK_ETHERNET:
+            off = 12
+            etype = (frame[off] << 8) | frame[off + 1]
+            off += 2
+            while etype in VLAN_TPIDS:
+                etype = (frame[off + 2] << 8) | frame[off + 3]
+                off += 4
+        else:
+            off = 0
+            version = frame[0] >> 4
+            etype = ETH_P_IP if version == 4 else ETH_P_IPV6 if version == 6 else None
+
+        if etype == ETH_P_IP:
+            ihl = (frame[off] & 0x0F) * 4
+            total_len = (frame[off + 2] << 8) | frame[off + 3]
+            # Only the first fragment carries the transport header
+            if ((frame[off + 6] & 0x1F) << 8) | frame[off + 7]:
+                return None
+            proto = frame[off + 9]
+            src_ip = socket.inet_ntoa(frame[off + 12:off + 16])
+            dst_ip = socket.inet_ntoa(frame[off + 16:off + 20])
+            end = min(n, off + total_len) if total_len else n
+            off += ihl
+        elif etype == ETH_P_IPV6:
+            payload_len = (frame[off + 4] << 8) | frame[off + 5]
+            proto = frame[off + 6]
+            src_ip = socket.inet_ntop(socket.AF_INET6, frame[off + 8:off + 24])
+            dst_ip = socket.inet_ntop(socket.AF_INET6, frame[off + 24:off + 40])
+            off += 40
+            end = min(n, off + payload_len) if payload_len else n
+            while proto in IPV6_EXT_HEADERS or proto == IPV6_FRAGMENT:
+                if proto == IPV6_FRAGMENT:
+                    if (_U16.unpack_from(frame, off + 2)[0] & 0xFFF8) != 0:
+                        return None
+                    proto = frame[off]
+                    off += 8
+                else:
+                    proto, hdr_len = frame[off], (frame[off + 1] + 1) * 8
+                    off += hdr_len
+        else:
+            return None
+
+        if proto == IPPROTO_TCP:
+            sport, dport = _PORTS.unpack_from(frame, off)
+            pkt = Packet()
+            pkt.seq = _TCP_SEQ.unpack_from(frame, off + 4)[0]
+            pkt.tcp_flags = frame[off + 13]
+            payload_offset = off + ((frame[off + 12] >> 4) * 4)
+        elif proto == IPPROTO_UDP:
+            sport, dport = _PORTS.unpack_from(frame, off)
+            pkt = Packet()
+            payload_offset = off + 8
+        else:
+            return None
+    except (IndexError, struct.error, OSError, ValueError):
+        return None
+
+    pkt.time = ts
+    pkt.frame = frame
+    if link == LINK_ETHERNET:
+        pkt.dst_mac = _mac(frame, 0)
+        pkt.src_mac = _mac(frame, 6)
+    else:
+        pkt.dst_mac = pkt.src_mac = None
+    pkt.src_ip = src_ip
+    pkt.dst_ip = dst_ip
+    pkt.proto = proto
+    pkt.sport = sport
+    pkt.dport = dport
+    pkt.payload_offset = min(payload_offset, end)
+    pkt.payload_end = end
+    return pkt
+
+
+# --- HTTP ---
+
+HTTP_METHODS = frozenset((
+    b"GET", b"POST", b"PUT", b"DELETE", b"HEAD", b"OPTIONS", b"PATCH", b"CONNECT", b"TRACE",
+    b"PROPFIND", b"PROPPATCH", b"MKCOL", b"COPY", b"MOVE", b"LOCK", b"UNLOCK",
+))
+_MAX_METHOD_LEN = 10
+
+
+class HttpRequest:
+    __slots__ = ("method", "path", "host", "user_agent", "accept_language")
+
+
+def _text(value: bytes) -> Optional[str]:
+    return value.decode("utf-8", errors="ignore") if value else None
+
+
+def looks_like_http_request(payload) -> bool:
+    """Whether a payload (bytes or memoryview) starts with an HTTP method and a space."""
+    head = bytes(payload[:_MAX_METHOD_LEN + 1])
+    sp = head.find(b" ")
+    return sp > 0 and head[:sp] in HTTP_METHODS
+
+
+def parse_http_request(payload: bytes) -> Optional[HttpRequest]:
+    """Parse an HTTP/1.x request line and the Host/User-Agent/Accept-Language headers."""
+    sp = payload.find(b" ", 0, _MAX_METHOD_LEN + 1)
+    if sp <= 0 or payload[:sp] not in HTTP_METHODS:
+        return None
+    eol = payload.find(b"\r\n")
+    line = payload[:eol] if eol != -1 else payload
+    parts = line.split(b" ")
+    if len(parts) < 3 or not parts[-1].startswith(b"HTTP/"):
+        return None
+
+    req = HttpRequest()
+    req.method = parts[0].decode("ascii")
+    req.path = _text(parts[1])
+    req.host = req.user_agent = req.accept_language = None
+    if eol == -1:
+        return req
+    head_end = payload.find(b"\r\n\r\n", eol)
+    headers = payload[eol + 2:head_end if head_end != -1 else len(payload)]
+    for header in headers.split(b"\r\n"):
+        colon = header.find(b":")
+        if colon <= 0:
+            continue
+        name = header[:colon].strip().lower()
+        if name == b"host":
+            req.host = _text(header[colon + 1:].strip())
+        elif name == b"user-agent":
+            req.user_agent = _text(header[colon + 1:].strip())
+        elif name == b"accept-language":
+            req.accept_language = _text(header[colon + 1:].strip())
+    return req
+
+
+# --- DNS ---
+
+def _read_name(msg: bytes, off: int) -> Tuple[str, int]:
+    """Read a (possibly compressed) domain name; returns (name, offset after it)."""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = msg[off]
+        if length == 0:
+            off += 1
+            break
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = off + 2
+            off = ((length & 0x3F) << 8) | msg[off + 1]
+            jumps += 1
+            if jumps > 16:
+                raise ValueError("DNS name compression loop")
+            continue
+        labels.append(msg[off + 1:off + 1 + length].decode("ascii", errors="ignore"))
+        off += 1 + length
+    return ".".join(labels).lower(), (end if end is not None else off)
+
+
+def parse_dns_answers(payload: bytes) -> List[Tuple[str, int, int, str]]:
+    """Return (name, type, ttl, data) for the A, AAAA and CNAME answers of a DNS response.
+
+    data is the address for A/AAAA records and the target name for CNAMEs.
+    Queries yield an empty list; malformed messages yield the records read so far.
+    """
+    answers = []
+    try:
+        _, flags, qdcount, ancount, _, _ = _DNS_HDR.unpack_from(payload, 0)
+        if not flags & 0x8000 or not ancount:
+            return answers
+        off = 12
+        for _ in range(qdcount):
+            _, off = _read_name(payload, off)
+            off += 4
+        for _ in range(ancount):
+            name, off = _read_name(payload, off)
+            rtype, _, ttl, rdlen = _RR_FIXED.unpack_from(payload, off)
+            off += 10
+            if rtype == DNS_TYPE_A and rdlen == 4:
+                answers.append((name, rtype, ttl, socket.inet_ntoa(payload[off:off + 4])))
+            elif rtype == DNS_TYPE_AAAA and rdlen == 16:
+                answers.append((name, rtype, ttl, socket.inet_ntop(socket.AF_INET6, payload[off:off + 16])))
+            elif rtype == DNS_TYPE_CNAME:
+                target, _ = _read_name(payload, off)
+                answers.append((name, rtype, ttl, target))
+            off += rdlen
+    except (IndexError, struct.error, ValueError, OSError):
+        # Keep the records decoded before a truncated or malformed one
+        pass
+    return answers
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Bounded DNS correlation cache for QUIC hostname inference.
+
+QUIC ClientHellos are encrypted, so the logger attributes a QUIC flow to the
+name the client last resolved to the server address. DNS answers are stored
+as (client IP, server IP) -> queried name, where CNAME chains are followed
+back to the name the client actually asked for (www.example.com rather than
+the CDN's edge name).
+
+Entries live for the record TTL, clamped to a configurable range, and the
+cache is capped in size (least recently used entries are evicted). Expiry is
+driven by a one-second timing wheel, so each call only touches entries that
+actually expired instead of sweeping the whole cache.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from dissector import DNS_TYPE_A, DNS_TYPE_AAAA, DNS_TYPE_CNAME
+
+MAX_CNAME_DEPTH = 16
+
+
+def address_names(answers: Iterable[Tuple[str, int, int, str]]) -> List[Tuple[str, str, int]]:
+    """Map parsed DNS answers to (address, queried name, ttl).
+
+    Each A/AAAA owner name is walked back through the CNAME records of the same
+    response to the name that was queried; the TTL is the smallest along the chain.
+    """
+    answers = list(answers)
+    alias_of: Dict[str, Tuple[str, int]] = {}
+    for name, rtype, ttl, data in answers:
+        if rtype == DNS_TYPE_CNAME and data:
+            alias_of[data] = (name, ttl)
+
+    result = []
+    for name, rtype, ttl, data in answers:
+        if rtype not in (DNS_TYPE_A, DNS_TYPE_AAAA) or not name or not data:
+            continue
+        origin = name
+        for _ in range(MAX_CNAME_DEPTH):
+            parent = alias_of.get(origin)
+            if parent is None:
+                break
+            origin, cname_ttl = parent
+            ttl = min(ttl, cname_ttl)
+        result.append((data, origin, ttl))
+    return result
+
+
+class ExpiringCache:
+    """Size-capped LRU whose entries expire individually via a timing wheel."""
+
+    def __init__(self, name: str, maxsize: int, min_ttl: float = 0.0, max_ttl: float = 3600.0):
+        self.name = name
+        self.maxsize = max(0, int(maxsize))
+        self.min_ttl = max(0.0, float(min_ttl))
+        self.max_ttl = max(self.min_ttl, float(max_ttl))
+        # key -> (expires, value)
+        self._data: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        # whole second -> keys expiring in it
+        self._wheel: Dict[int, Set[Hashable]] = {}
+        self._wheel_tick: Optional[int] = None
+        self._lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _expire(self, now: float):
+        tick = int(now)
+        if self._wheel_tick is None:
+            self._wheel_tick = tick
+            return
+        if tick <= self._wheel_tick:
+            return
+        wheel, data = self._wheel, self._data
+        if tick - self._wheel_tick > len(wheel):
+            # Sparse wheel after an idle period: visit only the occupied seconds
+            due = sorted(t for t in wheel if t <= tick)
+        else:
+            due = range(self._wheel_tick + 1, tick + 1)
+        for t in due:
+            for key in wheel.pop(t, ()):
+                del data[key]
+                self.expired += 1
+        self._wheel_tick = tick
+
+    def _unschedule(self, key: Hashable, expires: float):
+        slot = self._wheel.get(int(expires) + 1)
+        if slot is not None:
+            slot.discard(key)
+
+    def put(self, key: Hashable, value, ttl: Optional[float] = None):
+        if self.maxsize == 0:
+            return
+        ttl = self.max_ttl if ttl is None else min(max(float(ttl), self.min_ttl), self.max_ttl)
+        now = time.monotonic()
+        expires = now + ttl
+        with self._lock:
+            self._expire(now)
+            data = self._data
+            old = data.pop(key, None)
+            if old is not None:
+                self._unschedule(key, old[0])
+            data[key] = (expires, value)
+            # Scheduled one second late so the entry has expired when its slot comes up
+            self._wheel.setdefault(int(expires) + 1, set()).add(key)
+            while len(data) > self.maxsize:
+                evicted, (evicted_expires, _) = data.popitem(last=False)
+                self._unschedule(evicted, evicted_expires)
+                self.evictions += 1
+
+    def get(self, key: Hashable):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def discard(self, key: Hashable):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._unschedule(key, entry[0])
+
+    def expire(self):
+        """Drop expired entries; get() and put() do this as they go."""
+        with self._lock:
+            self._expire(time.monotonic())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._wheel.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
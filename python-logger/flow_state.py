@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Per-connection classification state for the TCP handler.
+
+Only the first payload of a connection says anything the logger cares
+about: an HTTP request line or a TLS ClientHello. Remembering what the first
+payload was lets every later segment of the connection - the bulk of a
+video stream or a download - skip HTTP parsing, SNI extraction and the
+reassembly table entirely:
+
+  PENDING     a ClientHello is being reassembled; segments go to the flow table
+  CLASSIFIED  the ClientHello was seen; nothing more to do
+  HTTP        plain HTTP; only new request lines (keep-alive) are looked for
+  IGNORED     neither HTTP nor TLS (server responses, mid-stream, other protocols)
+
+Entries are removed on SYN/FIN/RST and expire after `ttl` seconds without
+traffic (PENDING ones after `pending_ttl`). Expiry is amortised: every
+sweep interval a slice of the table is walked oldest-first, dropping idle
+entries and moving active ones to the back, so a full pass takes about a
+quarter of the TTL. When max_flows is reached the oldest entries are evicted.
+"""
+
+import threading
+from itertools import islice
+from typing import Dict, Hashable, Optional
+
+PENDING, CLASSIFIED, HTTP, IGNORED = 0, 1, 2, 3
+
+STATE_NAMES = {PENDING: "pending", CLASSIFIED: "classified", HTTP: "http", IGNORED: "ignored"}
+
+DEFAULT_TTL = 300.0
+DEFAULT_MAX_FLOWS = 131072
+SWEEP_INTERVAL = 1.0
+
+
+class FlowStateTable:
+    """Bounded connection -> classification state map with idle expiry."""
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_flows: int = DEFAULT_MAX_FLOWS,
+                 pending_ttl: float = 3.0):
+        self.ttl = max(1.0, float(ttl))
+        self.pending_ttl = max(0.1, float(pending_ttl))
+        # 0 disables the table: get() always misses and set() stores nothing
+        self.max_flows = max(0, int(max_flows))
+        # key -> [state, last seen]; insertion order approximates age
+        self._flows: Dict[Hashable, list] = {}
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        # Counters
+        self.lookups = 0
+        self.skipped = 0
+        self.expired = 0
+        self.evicted = 0
+        self.closed = 0
+
+    def __len__(self) -> int:
+        return len(self._flows)
+
+    def get(self, key: Hashable, now: float) -> Optional[int]:
+        """State of a connection (None if unknown or expired); refreshes its idle timer."""
+        self.lookups += 1
+        entry = self._flows.get(key)
+        if entry is None:
+            return None
+        state = entry[0]
+        if now - entry[1] > (self.pending_ttl if state == PENDING else self.ttl):
+            if self._flows.pop(key, None) is not None:
+                self.expired += 1
+            return None
+        entry[1] = now
+        if state == CLASSIFIED or state == IGNORED:
+            self.skipped += 1
+        return state
+
+    def peek(self, key: Hashable) -> Optional[int]:
+        """State of a connection without refreshing or counting it (the capture thread's check)."""
+        entry = self._flows.get(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key: Hashable, state: int, now: float):
+        if not self.max_flows:
+            return
+        flows = self._flows
+        with self._lock:
+            entry = flows.get(key)
+            if entry is not None:
+                entry[0] = state
+                entry[1] = now
+                return
+            if now >= self._next_sweep:
+                self._next_sweep = now + SWEEP_INTERVAL
+                self._sweep(now, len(flows) * SWEEP_INTERVAL * 4 // self.ttl + 64)
+            if len(flows) >= self.max_flows:
+                self._sweep(now, 1024)
+                while len(flows) >= self.max_flows:
+                    flows.pop(next(iter(flows)), None)
+                    self.evicted += 1
+            flows[key] = [state, now]
+
+    def _sweep(self, now: float, budget: int):
+        """Walk up to budget entries oldest-first: drop idle ones, move active ones to the back."""
+        flows = self._flows
+        for key in list(islice(flows, int(budget))):
+            entry = flows.pop(key, None)
+            if entry is None:
+                continue
+            if now - entry[1] > (self.pending_ttl if entry[0] == PENDING else self.ttl):
+                self.expired += 1
+            else:
+                flows[key] = entry
+
+    def discard(self, key: Hashable):
+        """Forget a connection (SYN/FIN/RST)."""
+        if self._flows.pop(key, None) is not None:
+            self.closed += 1
+
+    def stats(self) -> dict:
+        states = dict.fromkeys(STATE_NAMES.values(), 0)
+        for entry in list(self._flows.values()):
+            states[STATE_NAMES[entry[0]]] += 1
+        return {
+            "flows": len(self._flows),
+            "lookups": self.lookups,
+            "skipped": self.skipped,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "closed": self.closed,
+            **states,
+        }
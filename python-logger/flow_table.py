@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+TCP flow table for reassembling TLS ClientHellos that span several segments.
+
+Only flows whose first payload byte looks like a TLS handshake record are
+admitted, so bulk transfers, plain-text protocols and SYN scans never take a
+slot. Segments are placed by TCP sequence number relative to the first
+payload byte, so retransmissions and out-of-order arrival are handled. As
+soon as the first TLS record is complete, feed() hands the bytes back and the
+flow leaves the table.
+
+Idle flows expire through a hashed timing wheel: each tick only the keys in
+the current slot are examined, so expiry costs O(expired) instead of a scan
+of every flow. A global byte budget (and flow count cap) bounds memory; when
+it is exceeded the flows closest to expiry are evicted first.
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+TLS_HANDSHAKE = 0x16
+SEQ_MOD = 1 << 32
+
+DEFAULT_TTL = 3.0
+DEFAULT_TICK = 0.25
+# A ClientHello fits in one TLS record of at most 16 KiB plus its header
+DEFAULT_MAX_FLOW_BYTES = 16384 + 5
+DEFAULT_BYTE_BUDGET = 8 << 20
+DEFAULT_MAX_FLOWS = 65536
+
+
+class FlowEntry:
+    __slots__ = ("isn", "needed", "data", "pending", "pending_bytes", "slot", "expires")
+
+    def __init__(self, isn: int, needed: int):
+        self.isn = isn
+        self.needed = needed
+        self.data = bytearray()
+        # Out-of-order segments: offset -> bytes
+        self.pending: Optional[Dict[int, bytes]] = None
+        self.pending_bytes = 0
+        self.slot = 0
+        self.expires = 0
+
+
+def looks_like_tls_handshake(payload) -> bool:
+    """First bytes of a TLS handshake record: type 0x16, version 3.x."""
+    return len(payload) >= 3 and payload[0] == TLS_HANDSHAKE and payload[1] == 3
+
+
+class FlowTable:
+    """Bounded, timer-wheel expired table of partial TLS handshakes."""
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_flow_bytes: int = DEFAULT_MAX_FLOW_BYTES,
+                 byte_budget: int = DEFAULT_BYTE_BUDGET, max_flows: int = DEFAULT_MAX_FLOWS,
+                 tick: float = DEFAULT_TICK):
+        self.ttl = max(tick, float(ttl))
+        self.tick = float(tick)
+        self.max_flow_bytes = max(5, int(max_flow_bytes))
+        self.byte_budget = max(self.max_flow_bytes, int(byte_budget))
+        self.max_flows = max(1, int(max_flows))
+        self._flows: Dict[Tuple, FlowEntry] = {}
+        # One slot per tick of the TTL, plus one so a scheduled slot is never the current one
+        self._wheel: List[Set[Tuple]] = [set() for _ in range(int(self.ttl / self.tick) + 2)]
+        self._current_tick: Optional[int] = None
+        self._lock = threading.Lock()
+        self.bytes = 0
+        # Counters
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.expired = 0
+        self.evicted = 0
+        self.out_of_order = 0
+
+    def __len__(self) -> int:
+        return len(self._flows)
+
+    def __contains__(self, key: Tuple) -> bool:
+        return key in self._flows
+
+    # --- Timing wheel ---
+
+    def _schedule(self, key: Tuple, entry: FlowEntry, now_tick: int):
+        wheel = self._wheel
+        wheel[entry.slot].discard(key)
+        entry.expires = now_tick + int(self.ttl / self.tick) + 1
+        entry.slot = entry.expires % len(wheel)
+        wheel[entry.slot].add(key)
+
+    def _remove(self, key: Tuple) -> Optional[FlowEntry]:
+        entry = self._flows.pop(key, None)
+        if entry is not None:
+            self._wheel[entry.slot].discard(key)
+            self.bytes -= len(entry.data) + entry.pending_bytes
+        return entry
+
+    def _advance(self, now_tick: int):
+        """Expire the flows of every slot passed since the last call."""
+        wheel = self._wheel
+        if self._current_tick is None:
+            self._current_tick = now_tick
+            return
+        start = self._current_tick + 1
+        # After a long idle period everything is stale; one revolution covers it
+        if now_tick - start >= len(wheel):
+            start = now_tick - len(wheel) + 1
+        for t in range(start, now_tick + 1):
+            slot = wheel[t % len(wheel)]
+            if not slot:
+                continue
+            for key in [k for k in slot if self._flows[k].expires <= now_tick]:
+                self._remove(key)
+                self.expired += 1
+        self._current_tick = max(self._current_tick, now_tick)
+
+    def _evict(self, needed_bytes: int, needed_flows: int):
+        """Evict the flows closest to expiry until the budget has room."""
+        wheel = self._wheel
+        t = self._current_tick + 1
+        for _ in range(len(wheel)):
+            if self.bytes + needed_bytes <= self.byte_budget and len(self._flows) + needed_flows <= self.max_flows:
+                return
+            for key in list(wheel[t % len(wheel)]):
+                self._remove(key)
+                self.evicted += 1
+                if self.bytes + needed_bytes <= self.byte_budget and len(self._flows) + needed_flows <= self.max_flows:
+                    return
+            t += 1
+
+    # --- Public API ---
+
+    def feed(self, key: Tuple, seq: int, payload, now: Optional[float] = None) -> Optional[bytearray]:
+        """Add a TCP segment; returns the first TLS record once it is complete.
+
+        The returned buffer belongs to the caller; the flow has been removed.
+        Segments of flows that were never admitted are ignored.
+        """
+        now_tick = int((time.monotonic() if now is None else now) / self.tick)
+        size = len(payload)
+        with self._lock:
+            if self._current_tick is None or now_tick > self._current_tick:
+                self._advance(now_tick)
+
+            entry = self._flows.get(key)
+            if entry is None:
+                if not looks_like_tls_handshake(payload) or size < 5:
+                    self.rejected += 1
+                    return None
+                record_len = (payload[3] << 8) | payload[4]
+                entry = FlowEntry(seq, min(5 + record_len, self.max_flow_bytes))
+                if size >= entry.needed:
+                    self.completed += 1
+                    return bytearray(payload[:entry.needed])
+                self._evict(size, 1)
+                self._flows[key] = entry
+                self.admitted += 1
+                offset = 0
+            else:
+                offset = (seq - entry.isn) % SEQ_MOD
+
+            data = entry.data
+            have = len(data)
+            if offset > have:
+                # Hole before this segment: keep it until the gap is filled
+                if offset < entry.needed and (entry.pending is None or offset not in entry.pending):
+                    if entry.pending is None:
+                        entry.pending = {}
+                    chunk = bytes(payload[:entry.needed - offset])
+                    self._evict(len(chunk), 0)
+                    if key not in self._flows:
+                        return None
+                    entry.pending[offset] = chunk
+                    entry.pending_bytes += len(chunk)
+                    self.bytes += len(chunk)
+                    self.out_of_order += 1
+                self._schedule(key, entry, now_tick)
+                return None
+
+            # In order (or a retransmission overlapping what we have)
+            if offset + size > have:
+                self._evict(min(offset + size, entry.needed) - have, 0)
+                if key not in self._flows:
+                    return None
+                self.bytes += self._append(entry, payload[have - offset:])
+            self._schedule(key, entry, now_tick)
+
+            if len(entry.data) >= entry.needed:
+                self._remove(key)
+                self.completed += 1
+                del entry.data[entry.needed:]
+                return entry.data
+            return None
+
+    def _append(self, entry: FlowEntry, chunk) -> int:
+        """Append in-order bytes and any pending segments they make contiguous."""
+        data = entry.data
+        before = len(data) + entry.pending_bytes
+        data += chunk[:entry.needed - len(data)]
+        pending = entry.pending
+        while pending:
+            have = len(data)
+            ready = [off for off in pending if off <= have]
+            if not ready:
+                break
+            for off in ready:
+                seg = pending.pop(off)
+                entry.pending_bytes -= len(seg)
+                if off + len(seg) > have:
+                    data += seg[have - off:entry.needed - off]
+                    have = len(data)
+        return len(data) + entry.pending_bytes - before
+
+    def discard(self, key: Tuple):
+        """Forget a flow (e.g. on FIN/RST)."""
+        with self._lock:
+            self._remove(key)
+
+    def expire(self, now: Optional[float] = None):
+        """Expire idle flows; feed() does this too, so call it only when traffic is idle."""
+        now_tick = int((time.monotonic() if now is None else now) / self.tick)
+        with self._lock:
+            if self._current_tick is None or now_tick > self._current_tick:
+                self._advance(now_tick)
+
+    def stats(self) -> dict:
+        return {
+            "flows": len(self._flows),
+            "bytes": self.bytes,
+            "byte_budget": self.byte_budget,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "out_of_order": self.out_of_order,
+        }
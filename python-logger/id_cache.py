@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Bounded LRU caches mapping dimension values to their database ids.
+
+The packet logger normalizes IPs, MACs, domains, paths, user agents and
+accept languages into lookup tables. Those values repeat constantly (same LAN
+devices, same browsers), so caching value -> id in front of the
+INSERT ... ON DUPLICATE KEY UPDATE round-trip avoids most of them.
+
+Ids can disappear when log_cleanup.py removes orphaned rows. Callers detect
+that through a foreign key violation and drop the affected caches.
+"""
+
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+# Default capacity per lookup table
+DEFAULT_ID_CACHE_SIZES = {
+    "ip_addresses": 8192,
+    "mac_addresses": 1024,
+    "domains": 8192,
+    "paths": 8192,
+    "user_agents": 1024,
+    "accept_languages": 256,
+}
+
+
+class LRUCache:
+    """Small OrderedDict-backed LRU with hit/miss counters."""
+
+    __slots__ = ("name", "maxsize", "hits", "misses", "evictions", "_data")
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.maxsize = max(0, int(maxsize))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: "OrderedDict[Hashable, int]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[int]:
+        value = self._data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: int):
+        if self.maxsize == 0 or value is None:
+            return
+        data = self._data
+        if key in data:
+            data.move_to_end(key)
+        data[key] = value
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
+def build_id_caches(sizes: Optional[Dict[str, int]] = None) -> Dict[str, LRUCache]:
+    """Create one cache per lookup table, overriding default sizes from settings."""
+    merged = dict(DEFAULT_ID_CACHE_SIZES)
+    if sizes:
+        merged.update({k: int(v) for k, v in sizes.items() if k in merged})
+    return {table: LRUCache(table, size) for table, size in merged.items()}
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+IP -> domain attributions shared by the logger and the block-log reader.
+
+The block-log reader attributes a block event to the domain most recently
+seen for the WAN address, which took a query on domain_ip_addresses per
+batch of events. The logger already knows the answer: whenever its
+packet-log writer commits a batch it has just upserted the (domain, address)
+pairs the reader would find. It now sends them, after the commit, to the
+reader as Unix datagrams of text lines:
+
+    <ip address> <domain_id> <ip_address_id>
+
+The reader keeps them in an AttributionMap (LRU with a TTL) and only asks
+the database about addresses the map does not know; those answers are kept
+in the map too. Sending never blocks the logger: datagrams the reader is not
+there for, or has no buffer room for, are dropped and counted, and the
+reader falls back to the database.
+"""
+
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from ipaddress import ip_address
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import zoplog_log as log
+
+DEFAULT_SOCKET = "/run/zoplog/attribution.sock"
+DEFAULT_SIZE = 65536
+DEFAULT_TTL = 600.0
+# Keep datagrams well below the default socket buffer
+MAX_DATAGRAM = 8192
+
+
+def encode(attributions: Iterable[Tuple[str, int, int]]) -> Iterable[bytes]:
+    """Datagrams carrying (ip, domain_id, ip_id) attributions, one per line."""
+    chunk = []
+    size = 0
+    for ip, domain_id, ip_id in attributions:
+        line = f"{ip} {domain_id} {ip_id}\n".encode("ascii", "ignore")
+        if chunk and size + len(line) > MAX_DATAGRAM:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield b"".join(chunk)
+
+
+def decode(datagram: bytes) -> Iterable[Tuple[str, int, int]]:
+    for line in datagram.decode("ascii", "ignore").splitlines():
+        parts = line.split()
+        if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+            continue
+        try:
+            ip = str(ip_address(parts[0]))
+        except ValueError:
+            continue
+        yield ip, int(parts[1]), int(parts[2])
+
+
+class AttributionPublisher:
+    """Fire-and-forget sender of attributions to the reader's socket."""
+
+    def __init__(self, path: str = DEFAULT_SOCKET):
+        self.path = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        # Counters
+        self.sent = 0
+        self.dropped = 0
+
+    def publish(self, attributions: Iterable[Tuple[str, int, int]]):
+        for datagram in encode(attributions):
+            lines = datagram.count(b"\n")
+            try:
+                self._sock.sendto(datagram, self.path)
+                self.sent += lines
+            except OSError:
+                # Reader not running (ENOENT/ECONNREFUSED) or its buffer is full (EAGAIN)
+                self.dropped += lines
+
+    def close(self):
+        self._sock.close()
+
+    def stats(self) -> Dict[str, int]:
+        return {"sent": self.sent, "dropped": self.dropped}
+
+
+class AttributionMap:
+    """LRU map of ip -> (domain_id or None, ip_address_id) with a TTL per entry."""
+
+    def __init__(self, size: int = DEFAULT_SIZE, ttl: float = DEFAULT_TTL):
+        self.size = max(1, int(size))
+        self.ttl = max(1.0, float(ttl))
+        # ip -> (domain_id, ip_id, expires at), least recently used first
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.received = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, ip: str, now: Optional[float] = None) -> Optional[Tuple[Optional[int], int]]:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] <= now:
+                del self._entries[ip]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(ip)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, ip: str, domain_id: Optional[int], ip_id: int, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entries = self._entries
+            entries.pop(ip, None)
+            entries[ip] = (domain_id, ip_id, now + self.ttl)
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "received": self.received,
+            "expired": self.expired,
+            "evictions": self.evictions,
+        }
+
+
+class AttributionListener:
+    """Receives published attributions into an AttributionMap on a daemon thread."""
+
+    def __init__(self, path: str, attributions: AttributionMap,
+                 on_receive: Optional[Callable[[int], None]] = None):
+        self.path = path
+        self.attributions = attributions
+        self.on_receive = on_receive
+        self._sock: Optional[socket.socket] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        """Bind the socket and start receiving; False (DB lookups only) if it cannot be bound."""
+        try:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(self.path)
+        except OSError as e:
+            log.warning("Attribution socket %s unavailable, attributing block events from the database only: %s",
+                        self.path, e)
+            return False
+        self._sock = sock
+        self._thread = threading.Thread(target=self._run, name="attribution-listener", daemon=True)
+        self._thread.start()
+        log.info("Receiving IP attributions from the logger on %s", self.path)
+        return True
+
+    def _run(self):
+        sock = self._sock
+        while True:
+            try:
+                datagram = sock.recv(65536)
+            except OSError:
+                return
+            received = 0
+            now = time.monotonic()
+            for ip, domain_id, ip_id in decode(datagram):
+                self.attributions.put(ip, domain_id, ip_id, now)
+                received += 1
+            self.attributions.received += received
+            if self.on_receive:
+                self.on_receive(received)
+
+    def stop(self):
+        if self._sock is None:
+            return
+        sock, self._sock = self._sock, None
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
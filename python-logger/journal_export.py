@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Stand-in for systemd.journal.Reader fed from `journalctl -o export` files.
+
+Lets nft_blocklog_reader.py replay recorded kernel logs without a journal,
+e.g. to exercise cursor resume and catch-up:
+
+    journalctl -k -o export --since today > kernel.export
+    python3 nft_blocklog_reader.py --journal-export kernel.export
+
+Only what the block-log reader uses is provided: add_match(), this_boot(),
+seek_head()/seek_tail(), seek_cursor(), seek_realtime(), get_next(),
+get_previous(), wait() and iteration. Entries look like the real reader's:
+MESSAGE as text, __REALTIME_TIMESTAMP as a datetime, __CURSOR as recorded
+(files without cursors get synthetic ones).
+"""
+
+import struct
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+# Same values as systemd.journal
+NOP, APPEND, INVALIDATE = 0, 1, 2
+
+
+def read_export(path: str) -> List[Dict[str, bytes]]:
+    """Entries of a journal export file as {field: raw bytes}."""
+    entries: List[Dict[str, bytes]] = []
+    entry: Dict[str, bytes] = {}
+    with open(path, "rb") as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            if line == b"\n":
+                if entry:
+                    entries.append(entry)
+                    entry = {}
+                continue
+            line = line.rstrip(b"\n")
+            name, sep, value = line.partition(b"=")
+            if not sep:
+                # Binary-safe field: name, little-endian 64-bit size, data, newline
+                size = struct.unpack("<Q", f.read(8))[0]
+                value = f.read(size)
+                f.read(1)
+            entry[name.decode("ascii", "replace")] = value
+    if entry:
+        entries.append(entry)
+    return entries
+
+
+def _convert(raw: Dict[str, bytes], index: int) -> dict:
+    entry = {name: value.decode("utf-8", "replace") for name, value in raw.items()}
+    realtime = raw.get("__REALTIME_TIMESTAMP")
+    entry["__REALTIME_TIMESTAMP"] = datetime.fromtimestamp(int(realtime) / 1e6) if realtime else datetime.fromtimestamp(0)
+    entry.setdefault("__CURSOR", f"export;i={index:x}")
+    return entry
+
+
+class ExportReader:
+    """Iterates recorded journal entries like systemd.journal.Reader."""
+
+    def __init__(self, paths: List[str]):
+        self._entries = []
+        for path in paths:
+            self._entries.extend(_convert(raw, len(self._entries)) for raw in read_export(path))
+        self._matches: Dict[str, str] = {}
+        self._view: List[dict] = list(self._entries)
+        # Index of the current entry; -1 before the first, len(view) after the last
+        self._current = -1
+
+    def _filter(self):
+        self._view = [e for e in self._entries if all(e.get(k) == v for k, v in self._matches.items())]
+        self._current = -1
+
+    def add_match(self, **matches):
+        self._matches.update({k: str(v) for k, v in matches.items()})
+        self._filter()
+
+    def this_boot(self):
+        """Limit to the boot of the last recorded entry (the "current" boot of the recording)."""
+        if self._entries and self._entries[-1].get("_BOOT_ID"):
+            self.add_match(_BOOT_ID=self._entries[-1]["_BOOT_ID"])
+
+    def seek_head(self):
+        self._current = -1
+
+    def seek_tail(self):
+        self._current = len(self._view)
+
+    def seek_cursor(self, cursor: str):
+        """The next get_next() returns the entry at cursor."""
+        for i, entry in enumerate(self._view):
+            if entry["__CURSOR"] == cursor:
+                self._current = i - 1
+                return
+        raise ValueError(f"cursor not found: {cursor}")
+
+    def seek_realtime(self, when: datetime):
+        """The next get_next() returns the first entry logged at or after when."""
+        first = next((i for i, e in enumerate(self._view) if e["__REALTIME_TIMESTAMP"] >= when), len(self._view))
+        self._current = first - 1
+
+    def get_next(self) -> dict:
+        if self._current + 1 >= len(self._view):
+            self._current = len(self._view)
+            return {}
+        self._current += 1
+        return self._view[self._current]
+
+    def get_previous(self) -> dict:
+        if self._current - 1 < 0:
+            self._current = -1
+            return {}
+        self._current -= 1
+        return self._view[self._current]
+
+    def remaining(self) -> int:
+        return max(0, len(self._view) - self._current - 1)
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if self.remaining():
+            return APPEND
+        if timeout:
+            time.sleep(min(timeout, 0.1))
+        return NOP
+
+    def __iter__(self):
+        while True:
+            entry = self.get_next()
+            if not entry:
+                return
+            yield entry
@@ -19,15 +19,7 @@ from zoplog_config import load_database_config
 # Get database configuration
 DB_CONFIG = load_database_config()
 
-# DB driver
-try:
-    import pymysql as mariadb
-except Exception:
-    try:
-        import mysql.connector as mariadb
-    except Exception:
-        sys.stderr.write("No MySQL driver found. Install 'pymysql' or 'mysql-connector-python'.\n")
-        sys.exit(1)
+from db_pool import connect as connect_with_retry
 
 # Systemd journal logging
 try:
@@ -85,8 +77,8 @@ def get_disk_usage(path: str = "/var/lib/mysql") -> Tuple[float, float]:
     return usage_percent, available_gb
 
 def db_connect():
-    """Connect to the database."""
-    return mariadb.connect(**DB_CONFIG)
+    """Connect to the database, retrying while the server is unreachable."""
+    return connect_with_retry(DB_CONFIG)
 
 def get_table_sizes(cursor) -> dict:
     """Get the size of main log tables in MB."""
@@ -105,6 +97,18 @@ def get_table_sizes(cursor) -> dict:
 
     return sizes
 
+# Per-minute rollups of packet_logs / blocked_events (see traffic_rollup.py); pruned
+# together with the fact rows so dashboard totals match what is retained
+ROLLUP_TABLES = ('packet_log_minutes', 'blocked_event_minutes')
+
+def purge_rollups(cursor, day: str) -> int:
+    """Delete the rollup rows of one day (YYYY-MM-DD); the minute range keeps it on the primary key."""
+    deleted = 0
+    for table in ROLLUP_TABLES:
+        cursor.execute(f"DELETE FROM {table} WHERE minute >= %s AND minute < %s + INTERVAL 1 DAY", (day, day))
+        deleted += cursor.rowcount
+    return deleted
+
 def purge_by_disk_space(cursor, min_free_percent: float = 8.0, dry_run: bool = False) -> dict:
     """Purge oldest logs one day at a time until disk space is above minimum threshold."""
     usage_percent, available_gb = get_disk_usage()
@@ -133,6 +137,9 @@ def purge_by_disk_space(cursor, min_free_percent: float = 8.0, dry_run: bool = F
             days_deleted += 1
             if not dry_run:
                 print(f"ℹ️  {cutoff_date.strftime('%Y-%m-%d')}: No records to delete")
+                # Rollup rows left behind by earlier runs
+                if purge_rollups(cursor, cutoff_date.strftime('%Y-%m-%d')):
+                    cursor.connection.commit()
             continue  # No records for this day, try the next day
 
         day_total = packet_count + blocked_count
@@ -146,6 +153,7 @@ def purge_by_disk_space(cursor, min_free_percent: float = 8.0, dry_run: bool = F
                           (cutoff_date.strftime('%Y-%m-%d'),))
             cursor.execute("DELETE FROM blocked_events WHERE DATE(event_time) = DATE(%s)",
                           (cutoff_date.strftime('%Y-%m-%d'),))
+            purge_rollups(cursor, cutoff_date.strftime('%Y-%m-%d'))
 
             # Commit to free up space
             cursor.connection.commit()
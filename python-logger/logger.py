@@ -4,187 +4,207 @@
 ZopLog Network Packet Logger
 
 This script monitors network traffic and logs HTTP/HTTPS requests for security analysis.
-It is designed to be completely stateless - settings are loaded once at startup and
-remain static throughout execution. No caching, no reloading, no external state.
+Settings are loaded once at startup and remain static throughout execution.
+Active blocklists and whitelists are held in memory and kept in sync with the
+database by background threads.
 
 Key Features:
 - Monitors HTTP traffic on any TCP port
 - Extracts SNI from HTTPS/TLS handshakes on any TCP port
+- Extracts SNI from QUIC v1/v2 Initial packets (needs the cryptography package)
 - Logs to database with normalized schema
-- Integrates with firewall for automatic IP blocking
+- Integrates with firewall for automatic IP blocking (batched nft set updates)
 - Supports whitelist/blacklist functionality
 
 Settings are loaded once at startup from /etc/zoplog/zoplog.conf
 To change settings, modify the config file and restart the service.
 """
 
-import scapy.all as scapy
-from scapy.layers.http import HTTPRequest
-from scapy.packet import bind_layers
-from scapy.layers.inet import TCP, UDP
 from datetime import datetime
 from config import DB_CONFIG, DEFAULT_MONITOR_INTERFACE, SETTINGS_FILE, SCRIPTS_DIR
 import subprocess
 import json
 import os
+import re
+import signal
 import struct
+import threading
 import time
 
 # --- DB driver: use PyMySQL ---
 import pymysql as mariadb
 
-# --- Ensure HTTP dissector works on all ports ---
-
-bind_layers(TCP, HTTPRequest)
-
-# --- Lightweight TCP flow buffer for TLS ClientHello reassembly ---
+from blocklist_index import BlocklistIndex
+from whitelist_matcher import WhitelistMatcher
+from id_cache import build_id_caches
+from batch_writer import BatchWriter
+from db_pool import ConnectionPool, error_code
+from capture_pipeline import CapturePipeline, ScapyL2Source, packet_shard, run_capture
+from nft_updater import NftSetUpdater
+from decision_cache import DecisionCache, Verdict, WHITELISTED, ALLOWED, BLOCKED
+from tpacket_capture import TPacketV3Source
+from dissector import IPPROTO_TCP, LINK_ETHERNET, dissect, interface_link_type, looks_like_http_request, parse_http_request, parse_dns_answers, TCP_FIN, TCP_SYN, TCP_RST
+from dns_cache import ExpiringCache, address_names
+from quic_initial import QuicInitialParser, QUIC_DECRYPT_AVAILABLE, MIN_INITIAL_DATAGRAM
+from flow_table import FlowTable
+from flow_state import FlowStateTable, PENDING, CLASSIFIED, HTTP, IGNORED
+from traffic_rollup import write_packet_minutes
+from request_coalescer import RequestCoalescer
+from ip_attribution import AttributionPublisher
+from metrics import Registry, TimedCursor, start_metrics_server
+from shard_supervisor import ShardSupervisor, serve_control
+import zoplog_log as log
+
+# --- Metrics (served by start_metrics_endpoint() in Prometheus text format) ---
+metrics = Registry()
+_m_packets = metrics.counter("packets_total", "Packets handled, by protocol", ("protocol",))
+_m_packet_seconds = metrics.histogram("packet_handler_seconds", "Time spent handling one packet")
+_m_sni = metrics.counter("sni_total", "ClientHellos examined for a hostname, by transport and result",
+                         ("transport", "result"))
+_m_logged = metrics.counter("requests_logged_total", "Requests written to packet_logs, by type", ("type",))
+_m_db_seconds = metrics.histogram("db_statement_seconds", "Latency of logger SQL statements", ("call",))
+_m_commit_seconds = metrics.histogram("db_commit_seconds", "Latency of packet_logs commits", ("writer",))
+_m_nft_seconds = metrics.histogram("nft_apply_seconds", "Time to apply one batch of nft set additions")
+_m_handler_errors = metrics.counter("handler_errors_total", "Packets whose handler raised")
+_m_sni_tls_hit = _m_sni.labels("tls", "hit")
+_m_sni_tls_reassembled = _m_sni.labels("tls", "reassembled")
+_m_sni_tls_miss = _m_sni.labels("tls", "miss")
+
+# --- TCP flow table for TLS ClientHello reassembly ---
 # This helps extract SNI when ClientHello spans multiple TCP segments.
-FLOW_BUFFER_TTL = 3.0  # seconds to keep partial flows
-FLOW_BUFFER_MAXLEN = 8192  # clamp per-flow bytes to avoid memory bloat
-_flow_buffers: dict = {}
-_flow_last_cleanup = 0.0
+# Sized by configure_flow_table() in main().
+flow_table = FlowTable()
+
+def configure_flow_table(settings: dict):
+    global flow_table
+    flow_table = FlowTable(
+        ttl=settings.get("flow_table_ttl", 3.0),
+        byte_budget=settings.get("flow_table_byte_budget", 8 << 20),
+        max_flows=settings.get("flow_table_max_flows", 65536),
+    )
 
 def _flow_key(packet):
-    try:
-        if packet.haslayer(scapy.IP):
-            return (packet[scapy.IP].src, packet[scapy.TCP].sport,
-                    packet[scapy.IP].dst, packet[scapy.TCP].dport)
-        if packet.haslayer(scapy.IPv6):
-            return (packet[scapy.IPv6].src, packet[scapy.TCP].sport,
-                    packet[scapy.IPv6].dst, packet[scapy.TCP].dport)
-    except Exception:
-        return None
-    return None
-
-def _flow_buffer_append(key, data: bytes):
-    now = time.time()
-    entry = _flow_buffers.get(key)
-    if entry is None:
-        entry = {"data": bytearray(), "ts": now}
-        _flow_buffers[key] = entry
-    entry["data"].extend(data)
-    # Clamp to maxlen (keep latest tail)
-    if len(entry["data"]) > FLOW_BUFFER_MAXLEN:
-        entry["data"] = entry["data"][-FLOW_BUFFER_MAXLEN:]
-    entry["ts"] = now
-
-def _flow_buffer_get(key) -> bytes | None:
-    entry = _flow_buffers.get(key)
-    if not entry:
-        return None
-    return bytes(entry["data"])
-
-def _flow_buffer_clear(key):
-    if key in _flow_buffers:
-        try:
-            del _flow_buffers[key]
-        except Exception:
-            pass
-
-def _flow_buffer_cleanup():
-    global _flow_last_cleanup
-    now = time.time()
-    # avoid doing it too often
-    if now - _flow_last_cleanup < 1.0:
-        return
-    _flow_last_cleanup = now
-    stale = [k for k, v in list(_flow_buffers.items()) if now - v.get("ts", 0) > FLOW_BUFFER_TTL]
-    for k in stale:
-        try:
-            del _flow_buffers[k]
-        except Exception:
-            pass
+    return (packet.src_ip, packet.sport, packet.dst_ip, packet.dport)
+
+# --- Per-connection classification state ---
+# Lets the TCP handler skip every segment after a connection's first payload
+# has been classified (see flow_state.py). Sized by configure_flow_states() in main().
+flow_states = FlowStateTable()
+
+def configure_flow_states(settings: dict):
+    global flow_states
+    flow_states = FlowStateTable(
+        ttl=settings.get("flow_state_ttl", 300),
+        max_flows=settings.get("flow_state_max_flows", 131072),
+        pending_ttl=settings.get("flow_table_ttl", 3.0),
+    )
 
 # --- DNS cache for QUIC hostname inference ---
-DNS_CACHE_TTL = 120.0
-_dns_cache = {}  # key: (client_ip, server_ip) -> {host, ts}
-_dns_last_cleanup = 0.0
-_seen_quic_flows = {}   # key: (client_ip, sport, server_ip, dport) -> ts
+# (client_ip, server_ip) -> queried name, and QUIC flows already logged.
+# Sized by configure_dns_cache() in main().
+QUIC_FLOW_TTL = 120.0
+_dns_cache = ExpiringCache("dns", 65536, min_ttl=60, max_ttl=3600)
+_seen_quic_flows = ExpiringCache("quic_flows", 65536, min_ttl=QUIC_FLOW_TTL, max_ttl=QUIC_FLOW_TTL)
+
+def configure_dns_cache(settings: dict):
+    global _dns_cache, _seen_quic_flows
+    _dns_cache = ExpiringCache(
+        "dns", settings.get("dns_cache_size", 65536),
+        min_ttl=settings.get("dns_cache_min_ttl", 60),
+        max_ttl=settings.get("dns_cache_max_ttl", 3600),
+    )
+    _seen_quic_flows = ExpiringCache(
+        "quic_flows", settings.get("dns_cache_size", 65536),
+        min_ttl=QUIC_FLOW_TTL, max_ttl=QUIC_FLOW_TTL,
+    )
 
-def _dns_put(client_ip: str, server_ip: str, host: str):
+def dns_cache_stats() -> dict:
+    return {"dns": _dns_cache.stats(), "quic_flows": _seen_quic_flows.stats()}
+
+def _dns_put(client_ip: str, server_ip: str, host: str, ttl: float | None = None):
     if not client_ip or not server_ip or not host:
         return
-    _dns_cache[(client_ip, server_ip)] = {"host": _normalize_hostname(host), "ts": time.time()}
+    _dns_cache.put((client_ip, server_ip), _normalize_hostname(host), ttl)
 
 def _dns_get(client_ip: str, server_ip: str) -> str | None:
-    rec = _dns_cache.get((client_ip, server_ip))
-    if not rec:
-        return None
-    if time.time() - rec.get("ts", 0) > DNS_CACHE_TTL:
-        try:
-            del _dns_cache[(client_ip, server_ip)]
-        except Exception:
-            pass
-        return None
-    return rec.get("host")
-
-def _dns_cleanup():
-    global _dns_last_cleanup
-    now = time.time()
-    if now - _dns_last_cleanup < 5.0:
-        return
-    _dns_last_cleanup = now
-    stale = [k for k, v in list(_dns_cache.items()) if now - v.get("ts", 0) > DNS_CACHE_TTL]
-    for k in stale:
-        try:
-            del _dns_cache[k]
-        except Exception:
-            pass
-    stale2 = [k for k, ts in list(_seen_quic_flows.items()) if now - ts > DNS_CACHE_TTL]
-    for k in stale2:
-        try:
-            del _seen_quic_flows[k]
-        except Exception:
-            pass
+    return _dns_cache.get((client_ip, server_ip))
+
+# --- QUIC Initial decryption ---
+# Set by configure_quic_parser(); None means QUIC names come from the DNS cache above.
+quic_parser = None
+
+def configure_quic_parser(settings: dict):
+    global quic_parser
+    if not settings.get("quic_sni_extraction", True):
+        quic_parser = None
+    elif not QUIC_DECRYPT_AVAILABLE:
+        log.info("QUIC SNI extraction unavailable (python 'cryptography' package not installed); using DNS inference")
+        quic_parser = None
+    else:
+        quic_parser = QuicInitialParser()
 
 def _process_dns_packet(packet, settings):
     try:
-        if not packet.haslayer(scapy.DNS):
-            return
-        dns = packet[scapy.DNS]
-        if dns.qr != 1:
+        # The response goes back to the client that will open the QUIC flow
+        cip = packet.dst_ip
+        if not cip:
             return
-        cip, sip = _get_ips(packet)
-        # Iterate answer RRs
-        for i in range(dns.ancount):
-            rr = dns.an[i]
-            if rr.type in (1, 28):  # A or AAAA
-                host = rr.rrname.decode('utf-8', errors='ignore') if isinstance(rr.rrname, bytes) else str(rr.rrname)
-                ip = rr.rdata if isinstance(rr.rdata, str) else None
-                if host and ip and cip:
-                    _dns_put(cip, ip, host)
+        # CNAME chains are attributed to the name the client queried
+        for address, name, ttl in address_names(parse_dns_answers(packet.payload)):
+            _dns_put(cip, address, name, ttl)
     except Exception as e:
-        log_level = settings.get("log_level", "INFO").upper()
-        if log_level in ("DEBUG", "ALL"):
-            print(f"DNS parse error: {e}")
+        log.limited(log.DEBUG, "dns-parse", "DNS parse error: %s", e)
 
 # (DNS cache removed by user request)
 
-# --- Global connection with better error handling ---
-# Module-level connection placeholders to avoid NameError when checking/using
-# the globals inside get_db_connection() before they've been initialized.
-conn = None
-cursor = None
+# --- Connection pool ---
+# Capture workers run in parallel and a PyMySQL connection must not be shared
+# between threads, so every lookup or synchronous write checks a connection out
+# of the pool for one session (see db_pool.py). Sized by configure_db_pool() in main().
+def _new_db_pool(settings: dict) -> ConnectionPool:
+    return ConnectionPool(
+        DB_CONFIG, name="logger-db",
+        size=settings.get("db_pool_size", 4),
+        write_size=settings.get("db_pool_write_size", 2),
+        checkout_timeout=settings.get("db_pool_timeout", 5.0),
+        ping_interval=settings.get("db_ping_interval", 1.0),
+        idle_timeout=settings.get("db_idle_timeout", 300),
+        retries=settings.get("db_retry_attempts", 2),
+        backoff=settings.get("db_retry_backoff", 0.25),
+        wrap_cursor=lambda cur: TimedCursor(cur, _m_db_seconds),
+        observe_commit=_m_commit_seconds.labels("direct").observe,
+    )
 
-def get_db_connection():
-    """Get database connection with automatic reconnection"""
-    global conn, cursor
-    try:
-        # If conn is falsy or closed, attempt to (re)connect.
-        if not conn or (hasattr(conn, 'open') and not conn.open):
-            conn = mariadb.connect(**DB_CONFIG)
-            cursor = conn.cursor()
-        return conn, cursor
-    except Exception as e:
-        # More explicit error for easier debugging
-        print(f"Database connection error while connecting to {DB_CONFIG.get('host')}:{DB_CONFIG.get('database')}: {e}")
-        try:
-            conn = mariadb.connect(**DB_CONFIG)
-            cursor = conn.cursor()
-            return conn, cursor
-        except Exception as e2:
-            print(f"Failed to reconnect to database {DB_CONFIG.get('host')}/{DB_CONFIG.get('database')}: {e2}")
-            raise
+db_pool = _new_db_pool({})
+
+def configure_db_pool(settings: dict):
+    global db_pool
+    db_pool.close()
+    db_pool = _new_db_pool(settings)
+
+# In-memory blocklist index and whitelist matcher; populated by main() through a background refresh
+# thread. Until the first load completes, lookups fall back to SQL.
+blocklist_index = BlocklistIndex(DB_CONFIG)
+whitelist_matcher = WhitelistMatcher(DB_CONFIG)
+
+# Value -> id LRU caches for the lookup tables; resized from settings in main()
+_id_caches = build_id_caches()
+
+# MariaDB error raised when a referenced row no longer exists
+ER_NO_REFERENCED_ROW = 1452
+
+def configure_id_caches(settings: dict):
+    """Rebuild the lookup-table id caches with the configured sizes."""
+    global _id_caches
+    _id_caches = build_id_caches(settings.get("id_cache_sizes"))
+
+def clear_id_caches():
+    """Drop all cached ids, e.g. after orphan cleanup deleted referenced rows."""
+    for cache in _id_caches.values():
+        cache.clear()
+
+def id_cache_stats() -> dict:
+    return {table: cache.stats() for table, cache in _id_caches.items()}
 
 # Note: do not initialize the DB connection at import time. We use a
 # lazy/deferred connection via get_db_connection() so the module can be
@@ -193,54 +213,74 @@ def get_db_connection():
 # --- DB helpers ---
 def get_or_insert(table, column, value, cursor=None):
     """Insert value into table.column and return lastrowid. Caller may
-    supply a cursor to avoid repeated connection checks.
+    supply a cursor to avoid repeated connection checks. Known values are
+    answered from the table's id cache without a database round-trip.
     """
     if not value:
         return None
+    cache = _id_caches.get(table)
+    if cache is not None:
+        cached_id = cache.get(value)
+        if cached_id is not None:
+            return cached_id
     if cursor is None:
-        conn, cursor = get_db_connection()
+        return db_pool.run(lambda cur: get_or_insert(table, column, value, cursor=cur), write=True)
     try:
         cursor.execute(
             f"INSERT INTO {table} ({column}) VALUES (%s) "
             f"ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id)",
             (value,)
         )
-        return cursor.lastrowid
+        row_id = cursor.lastrowid
+        if cache is not None and row_id:
+            cache.put(value, row_id)
+        return row_id
     except Exception:
         # Let caller handle errors; return None for safety
         return None
 
-def get_or_insert_domain_with_ip(domain, ip_id):
-    """Insert domain with IP relationship or get existing one, updating relationship if needed"""
-    if not domain:
-        return None
-    
-    # Reject IP addresses - domains table should only contain actual domain names
-    import re
-    if re.match(r'^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+.*|^([0-9a-fA-F]{1,4}:){2,7}[0-9a-fA-F]{1,4}.*|^::1.*|^fe80:.*|^fc00:.*|^fd00:.*', domain):
+# Reject IP addresses - domains table should only contain actual domain names
+_IP_LIKE_DOMAIN_RE = re.compile(r'^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+.*|^([0-9a-fA-F]{1,4}:){2,7}[0-9a-fA-F]{1,4}.*|^::1.*|^fe80:.*|^fc00:.*|^fd00:.*')
+
+def get_or_insert_domain(domain, cursor=None):
+    """Return the domains.id for domain, inserting it if needed (cached)."""
+    if not domain or _IP_LIKE_DOMAIN_RE.match(domain):
         return None
-    
-    conn, cursor = get_db_connection()
+    if cursor is None:
+        return db_pool.run(lambda cur: get_or_insert_domain(domain, cursor=cur), write=True)
 
     # Insert domain and get ID in one statement (works for both insert and existing)
-    cursor.execute(
-        "INSERT INTO domains (domain) VALUES (%s) "
-        "ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id)",
-        (domain,)
-    )
-    domain_id = cursor.lastrowid
-
-    # Create or update IP relationship in one statement
-    # For new relationships: set allowed_count = 1, first_seen and last_seen to current time
-    # For existing relationships: increment allowed_count and explicitly update last_seen
-    if ip_id:
+    domain_cache = _id_caches.get("domains")
+    domain_id = domain_cache.get(domain) if domain_cache is not None else None
+    if domain_id is None:
         cursor.execute(
-            "INSERT INTO domain_ip_addresses (domain_id, ip_address_id, allowed_count, first_seen, last_seen) VALUES (%s, %s, 1, NOW(), NOW()) "
-            "ON DUPLICATE KEY UPDATE allowed_count = allowed_count + 1, last_seen = NOW()",
-            (domain_id, ip_id)
+            "INSERT INTO domains (domain) VALUES (%s) "
+            "ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id)",
+            (domain,)
         )
+        domain_id = cursor.lastrowid
+        if domain_cache is not None and domain_id:
+            domain_cache.put(domain, domain_id)
+    return domain_id
 
-    conn.commit()
+# Create or update IP relationships in one statement
+# For new relationships: set allowed_count to the batch count, first_seen and last_seen to current time
+# For existing relationships: add the batch count and explicitly update last_seen
+DOMAIN_IP_UPSERT = (
+    "INSERT INTO domain_ip_addresses (domain_id, ip_address_id, allowed_count, first_seen, last_seen) VALUES (%s, %s, %s, NOW(), NOW()) "
+    "ON DUPLICATE KEY UPDATE allowed_count = allowed_count + VALUES(allowed_count), last_seen = NOW()"
+)
+
+def get_or_insert_domain_with_ip(domain, ip_id, cursor=None):
+    """Insert domain with IP relationship or get existing one, updating relationship if needed.
+    Without a cursor the work runs in its own write session."""
+    if cursor is None:
+        return db_pool.run(lambda cur: get_or_insert_domain_with_ip(domain, ip_id, cursor=cur), write=True)
+    domain_id = get_or_insert_domain(domain, cursor=cursor)
+    if domain_id is None:
+        return None
+    if ip_id:
+        cursor.execute(DOMAIN_IP_UPSERT, (domain_id, ip_id, 1))
     return domain_id
 
 def get_or_insert_ip(ip_address, cursor=None):
@@ -259,59 +299,176 @@ def get_or_insert_ip(ip_address, cursor=None):
 def get_or_insert_mac(mac_address, cursor=None):
     return get_or_insert("mac_addresses", "mac_address", mac_address, cursor=cursor)
 
+PACKET_LOG_INSERT = """
+    INSERT INTO packet_logs
+    (packet_timestamp, src_ip_id, src_port, dst_ip_id, dst_port,
+     src_mac_id, dst_mac_id,
+     method, domain_id, path_id, user_agent_id, accept_language_id, type,
+     hit_count, last_timestamp)
+    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+"""
+
+def write_packet_logs(cursor, rows):
+    """Resolve lookup ids for a batch of packet rows and insert them.
+
+    Each row holds the insert_packet_log() arguments followed by the hit
+    count and last timestamp (see request_coalescer.py). packet_logs rows are
+    written with one executemany(), domain_ip_addresses counters are
+    aggregated per (domain, ip) so each pair is upserted once per batch, and
+    the per-minute packet_log_minutes rollup is updated in the same transaction.
+    The caller owns the transaction; the (ip, domain_id, ip_id) pairs upserted
+    are returned for publish_attributions() once it has committed.
+
+    If a cached id was deleted by orphan cleanup the batch is rolled back to
+    a savepoint taken before its first statement and resolved again, so
+    counters already upserted are not added twice.
+    """
+    cursor.execute("SAVEPOINT packet_batch")
+    for attempt in (1, 2):
+        try:
+            values = []
+            domain_ip_counts = {}
+            attributions = {}
+            for (packet_timestamp, src_ip, src_port, dst_ip, dst_port, src_mac, dst_mac,
+                 method, hostname, path, user_agent, accept_language, pkt_type,
+                 hit_count, last_timestamp) in rows:
+                # Reuse the same cursor for all helper operations to minimize
+                # connection/cursor churn when recording a batch
+                src_ip_id = get_or_insert_ip(src_ip, cursor=cursor) if src_ip else None
+                dst_ip_id = get_or_insert_ip(dst_ip, cursor=cursor) if dst_ip else None
+                src_mac_id = get_or_insert_mac(src_mac, cursor=cursor) if src_mac else None
+                dst_mac_id = get_or_insert_mac(dst_mac, cursor=cursor) if dst_mac else None
+                domain_id = get_or_insert_domain(hostname, cursor=cursor) if hostname else None
+                path_id = get_or_insert("paths", "path", path, cursor=cursor) if path else None
+                user_agent_id = get_or_insert("user_agents", "user_agent", user_agent, cursor=cursor) if user_agent else None
+                accept_language_id = get_or_insert("accept_languages", "accept_language", accept_language, cursor=cursor) if accept_language else None
+
+                if domain_id and dst_ip_id:
+                    key = (domain_id, dst_ip_id)
+                    domain_ip_counts[key] = domain_ip_counts.get(key, 0) + hit_count
+                    attributions[dst_ip] = key
+                values.append((packet_timestamp, src_ip_id, src_port, dst_ip_id, dst_port,
+                               src_mac_id, dst_mac_id,
+                               method, domain_id, path_id, user_agent_id, accept_language_id, pkt_type,
+                               hit_count, last_timestamp))
+
+            if domain_ip_counts:
+                # Sorted to keep lock order stable across concurrent writers
+                cursor.executemany(DOMAIN_IP_UPSERT,
+                                   [(d, i, n) for (d, i), n in sorted(domain_ip_counts.items())])
+            cursor.executemany(PACKET_LOG_INSERT, values)
+            write_packet_minutes(cursor, rows)
+            return [(ip, domain_id, ip_id) for ip, (domain_id, ip_id) in attributions.items()]
+        except mariadb.IntegrityError as e:
+            # A cached id was deleted by orphan cleanup: undo the attempt, forget cached ids and resolve again
+            if attempt == 2 or error_code(e) != ER_NO_REFERENCED_ROW:
+                raise
+            cursor.execute("ROLLBACK TO SAVEPOINT packet_batch")
+            clear_id_caches()
+
+# Publishes committed IP -> domain attributions to the block-log reader (see
+# ip_attribution.py); created by start_attribution_publisher() when
+# attribution_socket is set.
+_attribution_publisher = None
+
+def start_attribution_publisher(settings: dict):
+    global _attribution_publisher
+    path = settings.get("attribution_socket", "")
+    if path:
+        _attribution_publisher = AttributionPublisher(path)
+
+def stop_attribution_publisher():
+    global _attribution_publisher
+    if _attribution_publisher is None:
+        return
+    publisher, _attribution_publisher = _attribution_publisher, None
+    publisher.close()
+
+def publish_attributions(attributions):
+    publisher = _attribution_publisher
+    if publisher is not None and attributions:
+        publisher.publish(attributions)
+
+# Background writer for packet_logs; created by start_packet_writer() in main().
+# Without it (e.g. when imported by tools) rows are written synchronously.
+_packet_writer = None
+
+def start_packet_writer(settings: dict):
+    global _packet_writer
+    _packet_writer = BatchWriter(
+        DB_CONFIG, write_packet_logs, name="packet-log-writer",
+        queue_size=settings.get("writer_queue_size", 10000),
+        batch_size=settings.get("writer_batch_size", 200),
+        flush_interval=settings.get("writer_flush_interval", 1.0),
+        observe_commit=_m_commit_seconds.labels("batched").observe,
+        wrap_cursor=lambda cur: TimedCursor(cur, _m_db_seconds),
+        on_commit=publish_attributions,
+    )
+    _packet_writer.start()
+
+def stop_packet_writer():
+    """Flush pending packet rows and stop the writer thread."""
+    global _packet_writer
+    if _packet_writer is None:
+        return
+    writer, _packet_writer = _packet_writer, None
+    writer.stop()
+    stats = writer.stats()
+    log.info("Packet log writer stopped: written=%d dropped=%d failed=%d", stats['written'], stats['dropped'], stats['failed'])
+
+# Connection-summary mode; created by start_request_coalescer() when
+# request_coalesce_window > 0, otherwise every request is its own row.
+_request_coalescer = None
+
+def start_request_coalescer(settings: dict):
+    global _request_coalescer
+    window = settings.get("request_coalesce_window", 0)
+    if window <= 0:
+        return
+    _request_coalescer = RequestCoalescer(
+        lambda row, hits, last: _store_packet_row(row + (hits, last)),
+        window=window,
+        max_pending=settings.get("request_coalesce_max_pending", 50000),
+    )
+    _request_coalescer.start()
+    log.info("Connection-summary mode: identical requests within %ss are logged as one row", window)
+
+def stop_request_coalescer():
+    """Emit the open entries to the writer and stop the coalescer thread."""
+    global _request_coalescer
+    if _request_coalescer is None:
+        return
+    coalescer, _request_coalescer = _request_coalescer, None
+    coalescer.stop()
+    stats = coalescer.stats()
+    log.info("Request coalescer stopped: received=%d merged=%d rows=%d", stats['received'], stats['merged'], stats['emitted'])
+
 def insert_packet_log(packet_timestamp, src_ip, src_port, dst_ip, dst_port,
                       src_mac, dst_mac, method, hostname, path, user_agent,
                       accept_language, pkt_type):
-    """Insert normalized packet log; reconnect if server has gone away"""
-    global conn, cursor
+    """Log one request: merged into an open summary row in connection-summary
+    mode, otherwise stored as its own row."""
+    row = (packet_timestamp, src_ip, src_port, dst_ip, dst_port,
+           src_mac, dst_mac, method, hostname, path, user_agent,
+           accept_language, pkt_type)
+    _m_logged.labels(pkt_type).inc()
+    coalescer = _request_coalescer
+    if coalescer is not None:
+        coalescer.add((src_ip, dst_ip, dst_port, hostname, path, method, pkt_type), row, packet_timestamp)
+        return
+    _store_packet_row(row + (1, packet_timestamp))
+
+def _store_packet_row(row):
+    """Queue a packet row for the background writer, or write it synchronously
+    in a pooled write session when no writer runs."""
+    if _packet_writer is not None:
+        _packet_writer.submit(row)
+        return
     try:
-        # Ensure we have a valid connection
-        conn, cursor = get_db_connection()
-
-        # Reuse the same cursor for all helper operations to minimize
-        # connection/cursor churn when recording a packet
-        src_ip_id = get_or_insert_ip(src_ip, cursor=cursor) if src_ip else None
-        dst_ip_id = get_or_insert_ip(dst_ip, cursor=cursor) if dst_ip else None
-        src_mac_id = get_or_insert_mac(src_mac, cursor=cursor) if src_mac else None
-        dst_mac_id = get_or_insert_mac(dst_mac, cursor=cursor) if dst_mac else None
-        domain_id = get_or_insert_domain_with_ip(hostname, dst_ip_id) if hostname else None
-        path_id = get_or_insert("paths", "path", path, cursor=cursor) if path else None
-        user_agent_id = get_or_insert("user_agents", "user_agent", user_agent, cursor=cursor) if user_agent else None
-        accept_language_id = get_or_insert("accept_languages", "accept_language", accept_language, cursor=cursor) if accept_language else None
-
-        cursor.execute("""
-            INSERT INTO packet_logs
-            (packet_timestamp, src_ip_id, src_port, dst_ip_id, dst_port,
-             src_mac_id, dst_mac_id,
-             method, domain_id, path_id, user_agent_id, accept_language_id, type)
-            VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-        """, (packet_timestamp, src_ip_id, src_port, dst_ip_id, dst_port,
-              src_mac_id, dst_mac_id,
-              method, domain_id, path_id, user_agent_id, accept_language_id, pkt_type))
-
-        conn.commit()
-
-    except mariadb.Error as e:
-        if "MySQL server has gone away" in str(e):
-            print("DB connection lost, reconnecting...")
-            try:
-                conn = mariadb.connect(**DB_CONFIG)
-                cursor = conn.cursor()
-                # Retry the insert with fresh connection
-                cursor.execute("""
-                    INSERT INTO packet_logs
-                    (packet_timestamp, src_ip_id, src_port, dst_ip_id, dst_port,
-                     src_mac_id, dst_mac_id,
-                     method, domain_id, path_id, user_agent_id, accept_language_id, type)
-                    VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
-                """, (packet_timestamp, src_ip_id, src_port, dst_ip_id, dst_port,
-                      src_mac_id, dst_mac_id,
-                      method, domain_id, path_id, user_agent_id, accept_language_id, pkt_type))
-                conn.commit()
-            except Exception as e2:
-                print(f"Packet log insert failed after reconnect: {e2}")
-        else:
-            print(f"Packet log insert error: {e}")
+        publish_attributions(db_pool.run(lambda cur: write_packet_logs(cur, [row]), write=True))
+    except Exception as e:
+        log.limited(log.ERROR, "packet-log-insert", "Packet log insert error: %s", e)
+
 def _normalize_hostname(host: str) -> str:
     if not host:
         return ""
@@ -326,44 +483,21 @@ def _normalize_hostname(host: str) -> str:
 def find_matching_blocklists_for_host(host: str):
     """Return blocklist IDs where active blocklists contain an exact match of `host`."""
     # Use lazy connection
-    global conn
     h = _normalize_hostname(host)
     if not h:
         return []
+    if blocklist_index.loaded:
+        return blocklist_index.blocklist_ids(h)
     try:
-        conn, cur = get_db_connection()
         query = (
             "SELECT DISTINCT bd.blocklist_id "
             "FROM blocklist_domains bd "
             "JOIN blocklists bl ON bl.id = bd.blocklist_id "
             "WHERE bl.active = 'active' AND bd.domain = %s"
         )
-        cur.execute(query, (h,))
-        rows = cur.fetchall()
-        return [row[0] for row in rows]
-    except mariadb.Error as e:
-        # Attempt a single reconnect on connection loss
-        if "MySQL server has gone away" in str(e):
-            try:
-                conn = mariadb.connect(**DB_CONFIG)
-                cur = conn.cursor()
-                query = (
-                    "SELECT DISTINCT bd.blocklist_id "
-                    "FROM blocklist_domains bd "
-                    "JOIN blocklists bl ON bl.id = bd.blocklist_id "
-                    "WHERE bl.active = 'active' AND bd.domain = %s"
-                )
-                cur.execute(query, (h,))
-                rows = cur.fetchall()
-                return [row[0] for row in rows]
-            except Exception as e2:
-                print(f"Blocklist lookup failed after reconnect: {e2}")
-                return []
-        else:
-            print(f"Blocklist lookup error: {e}")
-            return []
+        return [row[0] for row in db_pool.fetchall(query, (h,))]
     except Exception as e:
-        print(f"Blocklist lookup unexpected error: {e}")
+        log.limited(log.ERROR, "blocklist-lookup", "Blocklist lookup error: %s", e)
     return []
 
 
@@ -371,7 +505,8 @@ def find_matching_blocklist_domains(host: str, settings: dict):
     """
     Find all active blocklists that contain an exact match for the given hostname.
     
-    This function performs a database lookup to identify which active blocklists
+    This function probes the in-memory blocklist index (falling back to a
+    database lookup until the index has loaded) to identify which active blocklists
     contain the specified hostname. It's used to determine if a domain should be
     blocked when processing HTTP/HTTPS traffic.
     
@@ -400,13 +535,30 @@ def find_matching_blocklist_domains(host: str, settings: dict):
         Used by HTTP/HTTPS packet handlers to determine if traffic should be blocked.
         Filters out domains where other domains sharing IPs have recent allowed traffic within last 24 hours.
     """
+    try:
+        return _match_blocklist_domains(host, settings)
+    except Exception as e:
+        log.limited(log.DEBUG, "blocklist-match", "Blocklist lookup failed for %s: %s", host, e)
+        return []
+
+
+def _match_blocklist_domains(host: str, settings: dict):
+    """find_matching_blocklist_domains() without the error handling: lookup failures raise."""
     if not host:
         return []
-    
-    try:
-        conn, cur = get_db_connection()
-        
-        # First, get matching blocklist domains
+
+    # First, get matching blocklist domains
+    rows = None
+    if blocklist_index.loaded:
+        rows = [(bl_id, bd_id, host) for bl_id, bd_id in blocklist_index.lookup(_normalize_hostname(host))]
+        if not rows:
+            return []
+    return db_pool.run(lambda cur: _filter_blocklist_domains(cur, host, rows))
+
+
+def _filter_blocklist_domains(cur, host: str, rows):
+    """Drop blocklist matches whose IPs other domains used recently (rows=None: look them up first)."""
+    if rows is None:
         query = (
             "SELECT bd.blocklist_id, bd.id AS blocklist_domain_id, bd.domain "
             "FROM blocklist_domains bd "
@@ -415,45 +567,37 @@ def find_matching_blocklist_domains(host: str, settings: dict):
         )
         cur.execute(query, (host,))
         rows = cur.fetchall()
+    
+    if not rows:
+        return []
+    
+    # For each matching domain, check if any other domains sharing its IPs have been seen in allowed traffic recently
+    # This prevents false positives with shared CDN IPs where legitimate traffic exists to other domains
+    filtered_results = []
+    for blocklist_id, blocklist_domain_id, domain in rows:
+        # Check if any other domains sharing IPs with this domain have been seen in allowed traffic within last 24 hours
+        # Exclude IP addresses that may have been incorrectly stored as domain names
+        cur.execute("""
+            SELECT 1 
+            FROM domain_ip_addresses dia1
+            JOIN domain_ip_addresses dia2 ON dia1.ip_address_id = dia2.ip_address_id
+            WHERE dia1.domain_id = (SELECT id FROM domains WHERE domain = %s)
+            AND dia2.domain_id != dia1.domain_id
+            AND dia2.last_seen >= DATE_SUB(NOW(), INTERVAL 24 HOUR)
+            LIMIT 1
+        """, (domain,))
         
-        if not rows:
-            return []
-        
-        # For each matching domain, check if any other domains sharing its IPs have been seen in allowed traffic recently
-        # This prevents false positives with shared CDN IPs where legitimate traffic exists to other domains
-        filtered_results = []
-        for blocklist_id, blocklist_domain_id, domain in rows:
-            # Check if any other domains sharing IPs with this domain have been seen in allowed traffic within last 24 hours
-            # Exclude IP addresses that may have been incorrectly stored as domain names
-            cur.execute("""
-                SELECT 1 
-                FROM domain_ip_addresses dia1
-                JOIN domain_ip_addresses dia2 ON dia1.ip_address_id = dia2.ip_address_id
-                WHERE dia1.domain_id = (SELECT id FROM domains WHERE domain = %s)
-                AND dia2.domain_id != dia1.domain_id
-                AND dia2.last_seen >= DATE_SUB(NOW(), INTERVAL 24 HOUR)
-                LIMIT 1
-            """, (domain,))
-            
-            recent_traffic = cur.fetchone()
-            
-            if recent_traffic:
-                # Another domain sharing IPs with this blocked domain has been seen in allowed traffic recently, don't block it
-                log_level = settings.get("log_level", "INFO").upper()
-                if log_level in ("DEBUG", "ALL"):
-                    print(f"DEBUG: Skipping block for domain {domain} - another domain sharing its IP has allowed traffic within 24h")
-                continue
-            else:
-                # No other domains sharing IPs have recent allowed traffic, safe to block
-                filtered_results.append((blocklist_id, blocklist_domain_id))
-        
-        return filtered_results
+        recent_traffic = cur.fetchone()
         
-    except Exception as e:
-        log_level = settings.get("log_level", "INFO").upper()
-        if log_level in ("DEBUG", "ALL"):
-            print(f"Warning: Blocklist lookup failed for {host}: {e}")
-        return []
+        if recent_traffic:
+            # Another domain sharing IPs with this blocked domain has been seen in allowed traffic recently, don't block it
+            log.debug("Skipping block for domain %s - another domain sharing its IP has allowed traffic within 24h", domain)
+            continue
+        else:
+            # No other domains sharing IPs have recent allowed traffic, safe to block
+            filtered_results.append((blocklist_id, blocklist_domain_id))
+    
+    return filtered_results
 
 
 def is_host_whitelisted(host: str, settings: dict):
@@ -461,9 +605,10 @@ def is_host_whitelisted(host: str, settings: dict):
     h = _normalize_hostname(host)
     if not h:
         return False
+    if whitelist_matcher.loaded:
+        return whitelist_matcher.is_whitelisted(h)
     
     try:
-        conn, cur = get_db_connection()
         query = (
             "SELECT 1 "
             "FROM whitelist_domains wd "
@@ -471,30 +616,55 @@ def is_host_whitelisted(host: str, settings: dict):
             "WHERE wl.active = 'active' AND wd.domain = %s "
             "LIMIT 1"
         )
-        cur.execute(query, (h,))
-        row = cur.fetchone()
-        return row is not None
+        return db_pool.fetchone(query, (h,)) is not None
     except Exception as e:
-        log_level = settings.get("log_level", "INFO").upper()
-        if log_level in ("DEBUG", "ALL"):
-            print(f"Warning: Whitelist lookup failed for {h}: {e}")
+        log.limited(log.DEBUG, "whitelist-lookup", "Whitelist lookup failed for %s: %s", h, e)
         return False
 
 
+# Block/allow verdicts per (host, destination IP); sized by configure_decision_cache() in main().
+decision_cache = DecisionCache()
+
+def configure_decision_cache(settings: dict):
+    global decision_cache
+    decision_cache = DecisionCache(
+        ttl=settings.get("decision_cache_ttl", 60),
+        negative_ttl=settings.get("decision_cache_negative_ttl", 30),
+        maxsize=settings.get("decision_cache_size", 16384),
+    )
+
+def decision_cache_stats() -> dict:
+    return decision_cache.stats()
+
+def decide_block(host: str, dst_ip: str, settings: dict) -> Verdict:
+    """Whitelist check plus blocklist match for host, answered from the decision cache when possible."""
+    generation = (blocklist_index.version, whitelist_matcher.version)
+    verdict = decision_cache.get(host, dst_ip, generation)
+    if verdict is not None:
+        return verdict
+
+    if is_host_whitelisted(host, settings):
+        verdict = Verdict(WHITELISTED)
+    else:
+        try:
+            matches = tuple(_match_blocklist_domains(host, settings))
+        except Exception as e:
+            log.limited(log.DEBUG, "blocklist-match", "Blocklist lookup failed for %s: %s", host, e)
+            # Not cached: the next connection retries the lookup
+            return Verdict(ALLOWED)
+        verdict = Verdict(BLOCKED, matches) if matches else Verdict(ALLOWED)
+    decision_cache.put(host, dst_ip, generation, verdict)
+    return verdict
+
+
 def _record_blocked_ip(blocklist_domain_id: int, ip: str):
     """Insert or update the blocked IP record linked to a specific blocklist_domain row."""
     # This function is no longer needed since blocked_ips table was removed
     pass
 
 
-def ipset_add_ip(blocklist_id: int, ip: str, blocklist_domain_id: int | None = None, settings: dict = None):
-    """Add IP to nft set for blocklist and record it in DB linked to the specific domain when provided."""
-    if settings is None:
-        settings = load_system_settings()
-        
-    debug_print(f"DEBUG: ipset_add_ip called with blocklist_id={blocklist_id}, ip={ip}, domain_id={blocklist_domain_id}", settings=settings)
-    
-    # First try to apply firewall change
+def _run_ipset_add_script(blocklist_id: int, ip: str, settings: dict = None) -> bool:
+    """Add one IP via zoplog-firewall-ipset-add (direct, then sudo). Used when nft cannot be run directly."""
     try:
         # Resolve script path (prefer installed scripts dir, fallback to production path)
         candidate_path = os.path.join(SCRIPTS_DIR, "zoplog-firewall-ipset-add")
@@ -502,7 +672,7 @@ def ipset_add_ip(blocklist_id: int, ip: str, blocklist_domain_id: int | None = N
 
         # 1) Try direct execution first (service typically has CAP_NET_ADMIN)
         direct_cmd = [script_path, str(blocklist_id), ip]
-        debug_print(f"DEBUG: Executing (direct): {' '.join(direct_cmd)}", settings=settings)
+        log.debug("Executing (direct): %s", ' '.join(direct_cmd))
         result = subprocess.run(
             direct_cmd,
             capture_output=True,
@@ -510,105 +680,140 @@ def ipset_add_ip(blocklist_id: int, ip: str, blocklist_domain_id: int | None = N
             timeout=3,
         )
 
-        debug_print(f"DEBUG: Direct command completed - returncode={result.returncode}", settings=settings)
-        debug_print(f"DEBUG: stdout: {repr(result.stdout)}", settings=settings)
-        debug_print(f"DEBUG: stderr: {repr(result.stderr)}", settings=settings)
+        log.debug("Direct command completed - returncode=%s stdout=%r stderr=%r",
+                  result.returncode, result.stdout, result.stderr)
 
         if result.returncode == 0:
-            debug_print(f"SUCCESS: ipset add (direct) completed for id={blocklist_id} ip={ip}", settings=settings)
-        else:
-            # 2) Fall back to sudo -n if direct execution failed (e.g., missing capability)
-            sudo_cmd = ["/usr/bin/sudo", "-n", script_path, str(blocklist_id), ip]
-            debug_print(f"DEBUG: Direct failed (rc={result.returncode}). Falling back to sudo: {' '.join(sudo_cmd)}", settings=settings)
-            result2 = subprocess.run(
-                sudo_cmd,
-                capture_output=True,
-                text=True,
-                timeout=3,
-            )
+            log.debug("ipset add (direct) completed for id=%s ip=%s", blocklist_id, ip)
+            return True
+
+        # 2) Fall back to sudo -n if direct execution failed (e.g., missing capability)
+        sudo_cmd = ["/usr/bin/sudo", "-n", script_path, str(blocklist_id), ip]
+        log.debug("Direct failed (rc=%s). Falling back to sudo: %s", result.returncode, ' '.join(sudo_cmd))
+        result2 = subprocess.run(
+            sudo_cmd,
+            capture_output=True,
+            text=True,
+            timeout=3,
+        )
+
+        log.debug("Sudo command completed - returncode=%s stdout=%r stderr=%r",
+                  result2.returncode, result2.stdout, result2.stderr)
 
-            debug_print(f"DEBUG: Sudo command completed - returncode={result2.returncode}", settings=settings)
-            debug_print(f"DEBUG: sudo stdout: {repr(result2.stdout)}", settings=settings)
-            debug_print(f"DEBUG: sudo stderr: {repr(result2.stderr)}", settings=settings)
+        if result2.returncode != 0:
+            err = (result2.stderr or '').strip()
+            log.error("ipset add failed (sudo) rc=%s id=%s ip=%s stderr=%s", result2.returncode, blocklist_id, ip, err)
+            return False
+        log.debug("ipset add (sudo) completed for id=%s ip=%s", blocklist_id, ip)
+        return True
 
-            if result2.returncode != 0:
-                err = (result2.stderr or '').strip()
-                print(f"ERROR: ipset add failed (sudo) rc={result2.returncode} id={blocklist_id} ip={ip} stderr={err}")
-            else:
-                debug_print(f"SUCCESS: ipset add (sudo) completed for id={blocklist_id} ip={ip}", settings=settings)
-            
     except subprocess.TimeoutExpired:
-        print(f"ERROR: ipset add timed out id={blocklist_id} ip={ip}")
+        log.error("ipset add timed out id=%s ip=%s", blocklist_id, ip)
     except Exception as e:
-        print(f"ERROR: ipset add exception id={blocklist_id} ip={ip} err={e}")
+        log.error("ipset add exception id=%s ip=%s err=%s", blocklist_id, ip, e)
+    return False
+
+
+# Batched nft set updater; created by start_nft_updater() in main().
+_nft_updater = None
+_nft_blocklist_version = None
+
+def start_nft_updater(settings: dict):
+    global _nft_updater
+    _nft_updater = NftSetUpdater(
+        nft_binary=settings.get("nft_binary") or None,
+        element_timeout=settings.get("firewall_rule_timeout", 10800),
+        flush_interval=settings.get("firewall_batch_interval", 0.2),
+        fallback=lambda bl_id, ip: _run_ipset_add_script(bl_id, ip, settings),
+        observe_apply=_m_nft_seconds.observe,
+    )
+    _nft_updater.start()
 
-    # Independently record in DB (even if firewall fails, for observability)
-    if blocklist_domain_id:
-        debug_print(f"DEBUG: Database recording skipped (blocked_ips table removed) for domain_id={blocklist_domain_id}", settings=settings)
-    else:
-        debug_print(f"DEBUG: No blocklist_domain_id provided, skipping database record", settings=settings)
+def stop_nft_updater():
+    """Apply pending set additions and stop the updater thread."""
+    global _nft_updater
+    if _nft_updater is None:
+        return
+    updater, _nft_updater = _nft_updater, None
+    updater.stop()
+    stats = updater.stats()
+    log.info("nft updater stopped: applied=%d deduplicated=%d failed=%d transactions=%d",
+             stats['applied'], stats['deduplicated'], stats['failed'], stats['transactions'])
+
+def ipset_add_ip(blocklist_id: int, ip: str, blocklist_domain_id: int | None = None, settings: dict = None):
+    """Add IP to the nft set for blocklist (batched when the updater runs, otherwise via the script)."""
+    global _nft_blocklist_version
+    log.debug("ipset_add_ip called with blocklist_id=%s, ip=%s, domain_id=%s", blocklist_id, ip, blocklist_domain_id)
+
+    updater = _nft_updater
+    if updater is None:
+        _run_ipset_add_script(blocklist_id, ip, settings)
+        return
+
+    # Blocklists were toggled or reloaded: their sets may have been flushed, so re-add on next match
+    if blocklist_index.loaded and blocklist_index.version != _nft_blocklist_version:
+        if _nft_blocklist_version is not None:
+            updater.forget()
+        _nft_blocklist_version = blocklist_index.version
+    if updater.add(blocklist_id, ip):
+        log.debug("queued nft set addition id=%s ip=%s", blocklist_id, ip)
 
 # --- Packet logging ---
 def _get_ips(packet):
-    try:
-        if packet.haslayer(scapy.IP):
-            return packet[scapy.IP].src, packet[scapy.IP].dst
-        if packet.haslayer(scapy.IPv6):
-            return packet[scapy.IPv6].src, packet[scapy.IPv6].dst
-    except Exception:
-        pass
-    return None, None
+    return packet.src_ip, packet.dst_ip
 
 
-def log_http_request(packet, settings: dict):
+def log_http_request(packet, settings: dict, http_request=None):
     ts = datetime.fromtimestamp(float(packet.time)).strftime('%Y-%m-%d %H:%M:%S')
-    http_request = packet[HTTPRequest]
+    if http_request is None:
+        http_request = parse_http_request(packet.payload)
+        if http_request is None:
+            return
 
     src_ip, dst_ip = _get_ips(packet)
-    src_port, dst_port = packet[scapy.TCP].sport, packet[scapy.TCP].dport
-    src_mac = packet[scapy.Ether].src if packet.haslayer(scapy.Ether) else None
-    dst_mac = packet[scapy.Ether].dst if packet.haslayer(scapy.Ether) else None
-
-    method = http_request.Method.decode()
-    # Validate method against known HTTP methods, map unknown ones to N/A
-    known_methods = {'GET', 'POST', 'PUT', 'DELETE', 'HEAD', 'OPTIONS', 'PATCH', 'CONNECT', 'TRACE', 'PROPFIND', 'PROPPATCH', 'MKCOL', 'COPY', 'MOVE', 'LOCK', 'UNLOCK', 'N/A', 'TLS_CLIENTHELLO'}
-    if method not in known_methods:
-        method = 'N/A'
-    host = http_request.Host.decode() if http_request.Host else None
-    path = http_request.Path.decode() if http_request.Path else None
-    user_agent = http_request.User_Agent.decode() if http_request.User_Agent else None
-    accept_language = http_request.Accept_Language.decode() if http_request.Accept_Language else None
+    src_port, dst_port = packet.sport, packet.dport
+    src_mac = packet.src_mac
+    dst_mac = packet.dst_mac
+
+    # parse_http_request() only accepts methods the packet_logs.method enum knows
+    method = http_request.method
+    host = http_request.host
+    path = http_request.path
+    user_agent = http_request.user_agent
+    accept_language = http_request.accept_language
 
     # Normalize hostname to remove port and standardize format
     if host:
         host = _normalize_hostname(host)
 
-    # Only print if INFO level or higher
-    log_level = settings.get("log_level", "INFO").upper()
-    if log_level in ("DEBUG", "ALL"):
-        print(f"{ts}\t{src_ip}:{src_port} ({src_mac})\t{dst_ip}:{dst_port} ({dst_mac})\tHTTP\t{method}\t{host}{path or ''}")
+    # Request lines are only written at DEBUG level
+    if log.debug_enabled:
+        log.debug("%s\t%s:%s (%s)\t%s:%s (%s)\tHTTP\t%s\t%s%s",
+                  ts, src_ip, src_port, src_mac, dst_ip, dst_port, dst_mac, method, host, path or '')
     
     insert_packet_log(ts, src_ip, src_port, dst_ip, dst_port,
                       src_mac, dst_mac,
                       method, host, path, user_agent, accept_language, "HTTP")
 
+    if not host or not dst_ip:
+        return
+
     # Whitelist overrides blacklist: if host is whitelisted, do nothing
-    if host and is_host_whitelisted(host, settings):
-        debug_print(f"DEBUG: HTTP host {host} is whitelisted, skipping blocking", settings=settings)
+    verdict = decide_block(host, dst_ip, settings)
+    if verdict.kind == WHITELISTED:
+        log.debug("HTTP host %s is whitelisted, skipping blocking", host)
         return
 
-    # If host matches any active blocklist and is not whitelisted, add destination IP to corresponding set(s) and record it
+    # If host matches any active blocklist and is not whitelisted, add destination IP to corresponding set(s)
     try:
-        if host and dst_ip:
-            matching_domains = find_matching_blocklist_domains(host, settings)
-            if matching_domains:
-                debug_print(f"DEBUG: HTTP host {host} matches {len(matching_domains)} blocklist(s), blocking IP {dst_ip}", settings=settings)
-                for bl_id, bd_id in matching_domains:
-                    ipset_add_ip(bl_id, dst_ip, bd_id, settings)
-            else:
-                debug_print(f"DEBUG: HTTP host {host} does not match any active blocklists", settings=settings)
+        if verdict.matches:
+            log.debug("HTTP host %s matches %d blocklist(s), blocking IP %s", host, len(verdict.matches), dst_ip)
+            for bl_id, bd_id in verdict.matches:
+                ipset_add_ip(bl_id, dst_ip, bd_id, settings)
+        else:
+            log.debug("HTTP host %s does not match any active blocklists", host)
     except Exception as e:
-        print(f"error during ipset add for HTTP host={host} ip={dst_ip}: {e}")
+        log.error("ipset add failed for HTTP host=%s ip=%s: %s", host, dst_ip, e)
 
 def parse_sni_from_bytes(payload: bytes) -> str | None:
     """Parse SNI hostname from a TLS ClientHello given raw bytes.
@@ -703,11 +908,10 @@ def extract_tls_sni(packet):
     """
     try:
         # --- 1. Initial Validation ---
-        if not packet.haslayer(scapy.TCP) or not packet.haslayer(scapy.Raw):
+        if not packet.is_tcp or not packet.payload_len:
             return None
 
-        payload = bytes(packet[scapy.Raw].load)
-        return parse_sni_from_bytes(payload)
+        return parse_sni_from_bytes(packet.payload)
     except Exception:
         # Handle malformed packets gracefully
         return None
@@ -716,9 +920,9 @@ def log_https_request(packet, settings: dict, hostname: str | None = None):
     ts = datetime.fromtimestamp(float(packet.time)).strftime('%Y-%m-%d %H:%M:%S')
 
     src_ip, dst_ip = _get_ips(packet)
-    src_port, dst_port = packet[scapy.TCP].sport, packet[scapy.TCP].dport
-    src_mac = packet[scapy.Ether].src if packet.haslayer(scapy.Ether) else None
-    dst_mac = packet[scapy.Ether].dst if packet.haslayer(scapy.Ether) else None
+    src_port, dst_port = packet.sport, packet.dport
+    src_mac = packet.src_mac
+    dst_mac = packet.dst_mac
 
     if hostname is None:
         hostname = extract_tls_sni(packet)
@@ -728,75 +932,94 @@ def log_https_request(packet, settings: dict, hostname: str | None = None):
         hostname = _normalize_hostname(hostname)
 
     # Debug logging for SNI extraction issues
-    log_level = settings.get("log_level", "INFO").upper()
-    if log_level in ("DEBUG", "ALL"):
+    if log.debug_enabled:
         if not hostname and dst_port == 443:
-            debug_print(f"DEBUG: Failed to extract SNI from HTTPS packet {src_ip}:{src_port} -> {dst_ip}:{dst_port}, payload size: {len(bytes(packet[scapy.Raw].load)) if packet.haslayer(scapy.Raw) else 0}", settings=settings)
-        print(f"{ts}\t{src_ip}:{src_port} ({src_mac})\t{dst_ip}:{dst_port} ({dst_mac})\tHTTPS\t{hostname or 'N/A'}")
+            log.debug("Failed to extract SNI from HTTPS packet %s:%s -> %s:%s, payload size: %d",
+                      src_ip, src_port, dst_ip, dst_port, packet.payload_len)
+        log.debug("%s\t%s:%s (%s)\t%s:%s (%s)\tHTTPS\t%s",
+                  ts, src_ip, src_port, src_mac, dst_ip, dst_port, dst_mac, hostname or 'N/A')
     
     insert_packet_log(ts, src_ip, src_port, dst_ip, dst_port,
                       src_mac, dst_mac,
                       "TLS_CLIENTHELLO", hostname, None, None, None, "HTTPS")
 
+    if not hostname or not dst_ip:
+        return
+
     # Whitelist overrides blacklist: if host is whitelisted, do nothing
-    if hostname and is_host_whitelisted(hostname, settings):
-        debug_print(f"DEBUG: HTTPS hostname {hostname} is whitelisted, skipping blocking", settings=settings)
+    verdict = decide_block(hostname, dst_ip, settings)
+    if verdict.kind == WHITELISTED:
+        log.debug("HTTPS hostname %s is whitelisted, skipping blocking", hostname)
         return
 
-    # If SNI matches any active blocklist and is not whitelisted, add destination IP to corresponding set(s) and record it
+    # If SNI matches any active blocklist and is not whitelisted, add destination IP to corresponding set(s)
     try:
-        if hostname and dst_ip:
-            matching_domains = find_matching_blocklist_domains(hostname, settings)
-            if matching_domains:
-                debug_print(f"DEBUG: HTTPS hostname {hostname} matches {len(matching_domains)} blocklist(s), blocking IP {dst_ip}", settings=settings)
-                for bl_id, bd_id in matching_domains:
-                    ipset_add_ip(bl_id, dst_ip, bd_id, settings)
-            else:
-                debug_print(f"DEBUG: HTTPS hostname {hostname} does not match any active blocklists", settings=settings)
+        if verdict.matches:
+            log.debug("HTTPS hostname %s matches %d blocklist(s), blocking IP %s", hostname, len(verdict.matches), dst_ip)
+            for bl_id, bd_id in verdict.matches:
+                ipset_add_ip(bl_id, dst_ip, bd_id, settings)
+        else:
+            log.debug("HTTPS hostname %s does not match any active blocklists", hostname)
     except Exception as e:
-        print(f"error during ipset add for HTTPS host={hostname} ip={dst_ip}: {e}")
+        log.error("ipset add failed for HTTPS host=%s ip=%s: %s", hostname, dst_ip, e)
 
 # QUIC logging using DNS-inferred hostname
 def log_https_quic_request(packet, settings: dict, hostname: str | None = None):
     ts = datetime.fromtimestamp(float(packet.time)).strftime('%Y-%m-%d %H:%M:%S')
 
     src_ip, dst_ip = _get_ips(packet)
-    src_port, dst_port = (packet[scapy.UDP].sport if packet.haslayer(scapy.UDP) else None,
-                          packet[scapy.UDP].dport if packet.haslayer(scapy.UDP) else None)
-    src_mac = packet[scapy.Ether].src if packet.haslayer(scapy.Ether) else None
-    dst_mac = packet[scapy.Ether].dst if packet.haslayer(scapy.Ether) else None
+    src_port, dst_port = packet.sport, packet.dport
+    src_mac = packet.src_mac
+    dst_mac = packet.dst_mac
 
     # Normalize hostname to remove port and standardize format
     if hostname:
         hostname = _normalize_hostname(hostname)
 
-    log_level = settings.get("log_level", "INFO").upper()
-    if log_level in ("DEBUG", "ALL"):
-        print(f"{ts}\t{src_ip}:{src_port} ({src_mac})\t{dst_ip}:{dst_port} ({dst_mac})\tHTTPS_QUIC\t{hostname or 'N/A'}")
+    if log.debug_enabled:
+        log.debug("%s\t%s:%s (%s)\t%s:%s (%s)\tHTTPS_QUIC\t%s",
+                  ts, src_ip, src_port, src_mac, dst_ip, dst_port, dst_mac, hostname or 'N/A')
 
     insert_packet_log(ts, src_ip, src_port, dst_ip, dst_port,
                       src_mac, dst_mac,
                       "QUIC", hostname, None, None, None, "HTTPS")
 
+    if not hostname or not dst_ip:
+        return
+
     # Whitelist overrides blacklist: if host is whitelisted, do nothing
-    if hostname and is_host_whitelisted(hostname, settings):
-        debug_print(f"DEBUG: QUIC hostname {hostname} is whitelisted, skipping blocking", settings=settings)
+    verdict = decide_block(hostname, dst_ip, settings)
+    if verdict.kind == WHITELISTED:
+        log.debug("QUIC hostname %s is whitelisted, skipping blocking", hostname)
         return
 
+    # If host matches any active blocklist and is not whitelisted, add destination IP to corresponding set(s)
     try:
-        if hostname and dst_ip:
-            matching_domains = find_matching_blocklist_domains(hostname, settings)
-            if matching_domains:
-                debug_print(f"DEBUG: QUIC hostname {hostname} matches {len(matching_domains)} blocklist(s), blocking IP {dst_ip}", settings=settings)
-                for bl_id, bd_id in matching_domains:
-                    ipset_add_ip(bl_id, dst_ip, bd_id, settings)
-            else:
-                debug_print(f"DEBUG: QUIC hostname {hostname} does not match any active blocklists", settings=settings)
+        if verdict.matches:
+            log.debug("QUIC hostname %s matches %d blocklist(s), blocking IP %s", hostname, len(verdict.matches), dst_ip)
+            for bl_id, bd_id in verdict.matches:
+                ipset_add_ip(bl_id, dst_ip, bd_id, settings)
+        else:
+            log.debug("QUIC hostname %s does not match any active blocklists", hostname)
     except Exception as e:
-        print(f"error during ipset add for HTTPS_QUIC host={hostname} ip={dst_ip}: {e}")
+        log.error("ipset add failed for HTTPS_QUIC host=%s ip=%s: %s", hostname, dst_ip, e)
 
 # (QUIC logging removed by user request)
 
+def _feed_client_hello(packet, settings, key, payload, now):
+    """Add a segment to the ClientHello reassembly and log the hostname once complete."""
+    record = flow_table.feed(key, packet.seq, payload)
+    if record is None:
+        # Still reassembling, or not a TLS handshake at all
+        flow_states.set(key, PENDING if key in flow_table else IGNORED, now)
+        return
+    flow_states.set(key, CLASSIFIED, now)
+    hostname = parse_sni_from_bytes(record)
+    (_m_sni_tls_reassembled if hostname else _m_sni_tls_miss).inc()
+    if hostname:
+        log.debug("HTTPS packet detected via reassembly with SNI: %s", hostname)
+        log_https_request(packet, settings, hostname)
+
 def tcp_packet_handler(packet, settings):
     """
     Process TCP packets and extract HTTP/HTTPS traffic on ANY port.
@@ -804,49 +1027,63 @@ def tcp_packet_handler(packet, settings):
     not just standard ports (80, 443, etc.).
     """
     try:
-        # Check for HTTP traffic on any port
-        if packet.haslayer(HTTPRequest):
-            debug_print(f"DEBUG: HTTP packet detected", settings=settings)
-            log_http_request(packet, settings)
-            return
-
-        # Check for HTTPS traffic (TLS with SNI) on any port
-        if settings.get("enable_sni_extraction", True):
-            hostname = extract_tls_sni(packet)
-            if hostname:
-                debug_print(f"DEBUG: HTTPS packet detected with SNI: {hostname}", settings=settings)
-                log_https_request(packet, settings, hostname)
-                return
-
-            # Attempt simple reassembly using flow buffer
-            if packet.haslayer(scapy.Raw) and packet.haslayer(scapy.TCP):
-                key = _flow_key(packet)
-                if key:
-                    _flow_buffer_append(key, bytes(packet[scapy.Raw].load))
-                    buf = _flow_buffer_get(key)
-                    host2 = parse_sni_from_bytes(buf) if buf else None
-                    if host2:
-                        debug_print(f"DEBUG: HTTPS packet detected via reassembly with SNI: {host2}", settings=settings)
-                        log_https_request(packet, settings, host2)
-                        _flow_buffer_clear(key)
-                        return
-
-        # Cleanup old flow buffers occasionally
-        _flow_buffer_cleanup()
-
-        # Optional: Log other TCP traffic in debug mode for analysis
-        log_level = settings.get("log_level", "INFO").upper()
-        if log_level in ("DEBUG", "ALL") and packet.haslayer(scapy.TCP):
-            dst_port = packet[scapy.TCP].dport
-            src_port = packet[scapy.TCP].sport
-            src_ip, dst_ip = _get_ips(packet)
-            # debug_print(f"DEBUG: Non-HTTP/HTTPS TCP packet: {src_ip}:{src_port} -> {dst_ip}:{dst_port}", settings=settings)
+        key = (packet.src_ip, packet.sport, packet.dst_ip, packet.dport)
+        flags = packet.tcp_flags
+        if flags & TCP_SYN:
+            # A new connection on this 4-tuple: forget whatever the previous one left
+            flow_table.discard(key)
+            flow_states.discard(key)
+        try:
+            if packet.payload_len:
+                _tcp_payload(packet, settings, key)
+        finally:
+            # FIN/RST close the connection, also when they ride on a data segment
+            if flags & (TCP_FIN | TCP_RST):
+                flow_table.discard(key)
+                flow_states.discard(key)
 
     except Exception as e:
-        # Log errors in debug mode only to avoid spam
-        log_level = settings.get("log_level", "INFO").upper()
-        if log_level in ("DEBUG", "ALL"):
-            print(f"Packet processing error: {e}")
+        # Log errors in debug mode only, and rate limited, to avoid spam
+        log.limited(log.DEBUG, "packet-processing", "Packet processing error: %s", e)
+
+def _tcp_payload(packet, settings, key):
+    """Classify a TCP segment's payload and log the HTTP request or TLS SNI it starts."""
+    payload = packet.payload
+
+    # Later segments of a classified connection are skipped without parsing
+    now = time.monotonic()
+    state = flow_states.get(key, now)
+    if state == CLASSIFIED or state == IGNORED:
+        return
+    if state == PENDING:
+        _feed_client_hello(packet, settings, key, payload, now)
+        return
+
+    # Check for HTTP traffic on any port (every request of a keep-alive connection)
+    http_request = parse_http_request(payload)
+    if http_request is not None:
+        log.debug("HTTP packet detected")
+        if state is None:
+            flow_states.set(key, HTTP, now)
+        log_http_request(packet, settings, http_request)
+        return
+    if state == HTTP:
+        return
+
+    # Check for HTTPS traffic (TLS with SNI) on any port
+    if settings.get("enable_sni_extraction", True):
+        hostname = parse_sni_from_bytes(payload)
+        if hostname:
+            _m_sni_tls_hit.inc()
+            flow_states.set(key, CLASSIFIED, now)
+            log.debug("HTTPS packet detected with SNI: %s", hostname)
+            log_https_request(packet, settings, hostname)
+            return
+
+        # Reassemble ClientHellos split across segments (TLS-looking flows only)
+        _feed_client_hello(packet, settings, key, payload, now)
+        return
+    flow_states.set(key, IGNORED, now)
 
 def load_system_settings():
     """Load system settings from centralized config file - called once at startup"""
@@ -856,7 +1093,7 @@ def load_system_settings():
             from zoplog_config import load_settings_config
             return load_settings_config()
     except Exception as e:
-        print(f"Warning: Could not load settings file: {e}")
+        log.warning("Could not load settings file: %s", e)
     
     # Return defaults
     return {
@@ -867,16 +1104,6 @@ def load_system_settings():
         "log_level": "INFO"
     }
 
-def debug_print(*args, settings: dict = None, **kwargs):
-    """Conditional debug print - only prints if debug logging is enabled"""
-    if settings is None:
-        # Fallback for functions that don't have settings passed
-        settings = load_system_settings()
-    
-    log_level = settings.get("log_level", "INFO").upper()
-    if log_level in ("DEBUG", "ALL"):
-        print(*args, **kwargs)
-
 def get_available_interfaces():
     """Get list of available network interfaces"""
     try:
@@ -900,7 +1127,7 @@ def get_default_interface():
     # Verify interface exists
     available = get_available_interfaces()
     if interface not in available:
-        print(f"Warning: Configured interface '{interface}' not found. Available: {available}")
+        log.warning("Configured interface '%s' not found. Available: %s", interface, available)
         # Try bridge interface first, then first available
         if "br-zoplog" in available:
             interface = "br-zoplog"
@@ -911,62 +1138,356 @@ def get_default_interface():
     
     return interface
 
-def main():
-    """Main function - settings are loaded once at startup and remain static"""
-    # Load settings once at startup - no caching, no reloading
-    settings = load_system_settings()
-    
-    interface = get_default_interface()
-    print(f"Monitoring HTTP/HTTPS traffic on {interface}...")
-    
-    # Display current git commit for version tracking
+def open_capture_source(interface: str, bpf_filter: str, settings: dict):
+    """Open the configured capture backend, falling back to scapy."""
+    if settings.get("capture_backend", "scapy") == "tpacket":
+        try:
+            source = TPacketV3Source(
+                interface,
+                block_size=settings.get("tpacket_block_size", 1 << 20),
+                block_count=settings.get("tpacket_block_count", 64),
+                frame_size=settings.get("tpacket_frame_size", 2048),
+                snaplen=settings.get("snaplen", 0),
+                bpf_filter=bpf_filter,
+                fanout_group=settings.get("fanout_group"),
+            )
+            log.info("Capture backend: AF_PACKET TPACKET_V3 ring (%d x %d bytes)", source.block_count, source.block_size)
+            if not source.filtered:
+                log.warning("could not attach BPF filter to TPACKET_V3 socket, capturing all traffic")
+            return source
+        except (OSError, ValueError) as e:
+            log.warning("TPACKET_V3 capture unavailable (%s), falling back to scapy", e)
+    if interface_link_type(interface) is None:
+        log.warning("%s is neither Ethernet nor raw IP, decoding its link layer with scapy", interface)
+    log.info("Capture backend: scapy")
+    return ScapyL2Source(interface, bpf_filter, fanout_group=settings.get("fanout_group"))
+
+def keep_payload(packet) -> bool:
+    """Whether the handlers can use a packet's payload (checked on the undetached frame).
+
+    Only HTTP request heads, TLS handshakes (and the rest of a ClientHello
+    being reassembled), DNS answers and QUIC Initials are read; the payload
+    of every other segment - bulk data of classified connections above all -
+    is never copied out of the capture buffer. TCP segments of connections
+    no worker has classified yet are kept whole: with capture workers the
+    continuation of a split ClientHello usually reaches the capture thread
+    before the worker that saw its first segment has marked the flow PENDING.
+    """
+    size = packet.payload_end - packet.payload_offset
+    if not size:
+        return False
+    if packet.proto == IPPROTO_TCP:
+        state = flow_states.peek((packet.src_ip, packet.sport, packet.dst_ip, packet.dport))
+        if state is None or state == PENDING:
+            return True
+        if state == CLASSIFIED or state == IGNORED:
+            return False
+        return looks_like_http_request(packet.payload)
+    if quic_parser is not None:
+        # Long-header datagrams of the minimum Initial size, of connections not logged yet
+        return (packet.dport == 443 and size >= MIN_INITIAL_DATAGRAM and bool(packet.frame[packet.payload_offset] & 0x80)
+                and (packet.src_ip, packet.sport, packet.dst_ip, packet.dport) not in _seen_quic_flows)
+    return packet.sport == 53
+
+def packet_from_frame(frame, ts: float, link: str = LINK_ETHERNET):
+    """Dissect a frame in place and detach the packet from it, keeping only the payload handlers read."""
+    packet = dissect(frame, ts, link)
+    if packet is not None:
+        packet.detach(keep_payload(packet))
+    return packet
+
+def run_capture_pipeline(interface: str, bpf_filter: str, handler, settings: dict):
+    """Capture frames on this thread and process them in a pool of worker threads.
+
+    Frames are dissected in place on the capture thread (a few header reads)
+    and only the payload bytes a handler can use are copied; parsing,
+    database lookups and nft calls happen in the workers, so the capture
+    loop never waits on them. With capture_workers = 0 packets are processed
+    inline on the capture thread.
+    """
+    source = open_capture_source(interface, bpf_filter, settings)
+    link = source.link_type
+
+    def handle_frame(frame, ts: float):
+        packet = packet_from_frame(frame, ts, link)
+        if packet is not None:
+            handler(packet)
+
+    if source.fanout_mode == "hash":
+        log.warning("PACKET_FANOUT_CBPF unavailable, sharding by kernel flow hash "
+                    "(DNS answers and the QUIC flows they name may reach different shards)")
+    workers = settings.get("capture_workers", 2)
+    pipeline = None
+    if workers > 0:
+        pipeline = CapturePipeline(
+            lambda packet, ts: handler(packet),
+            workers=workers,
+            queue_size=settings.get("capture_queue_size", 4096),
+            shard=packet_shard,
+        )
+
+        def on_frame(frame, ts: float):
+            # Ring frames are views into kernel memory: queue the detached packet
+            packet = packet_from_frame(frame, ts, link)
+            if packet is not None:
+                pipeline.submit(packet, ts)
+    else:
+        on_frame = handle_frame
+    last_drops = [0]
+    metrics.add_collector(
+        "capture",
+        lambda: {**(pipeline.stats() if pipeline else {}),
+                 "kernel_packets": source.kernel_packets, "kernel_drops": source.kernel_drops},
+        counters=("received", "userspace_drops", "handler_errors", "kernel_packets", "kernel_drops"),
+    )
+
+    def report():
+        stats = pipeline.stats() if pipeline else {"received": "n/a", "queue_depths": [], "userspace_drops": 0}
+        drops = source.kernel_drops + stats["userspace_drops"]
+        if drops != last_drops[0] or log.debug_enabled:
+            log.info("Capture stats: received=%s queue_depth=%s kernel_drops=%d userspace_drops=%d",
+                     stats['received'], stats['queue_depths'], source.kernel_drops, stats['userspace_drops'])
+        if log.debug_enabled:
+            dc = decision_cache_stats()
+            log.debug("Decision cache: size=%d hit_ratio=%.2f%% negative_hits=%d invalidated=%d",
+                      dc['size'], dc['hit_ratio'] * 100, dc['negative_hits'], dc['invalidated'])
+            ft = flow_table.stats()
+            log.debug("Flow table: flows=%d bytes=%d completed=%d expired=%d evicted=%d",
+                      ft['flows'], ft['bytes'], ft['completed'], ft['expired'], ft['evicted'])
+            fs = flow_states.stats()
+            log.debug("Flow states: flows=%d skipped=%d/%d segments expired=%d evicted=%d",
+                      fs['flows'], fs['skipped'], fs['lookups'], fs['expired'], fs['evicted'])
+            dns = _dns_cache.stats()
+            log.debug("DNS cache: size=%d hit_ratio=%.2f%% evictions=%d expired=%d",
+                      dns['size'], dns['hit_ratio'] * 100, dns['evictions'], dns['expired'])
+        last_drops[0] = drops
+
+    stop_event = threading.Event()
+    if pipeline:
+        pipeline.start()
+        log.info("Capture pipeline started with %d worker(s)", pipeline.workers)
     try:
-        git_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__)).decode('utf-8').strip()
-        print(f"Git commit: {git_commit}", flush=True)
-    except (subprocess.CalledProcessError, FileNotFoundError, OSError):
-        print("Git commit: unknown (not in git repository or git not available)", flush=True)
-    
-    print("Time\tSource\tDestination\tType\tMethod/Host")
+        run_capture(source, on_frame, stop_event,
+                    stats_interval=settings.get("capture_stats_interval", 60), report=report)
+    finally:
+        stop_event.set()
+        if pipeline:
+            pipeline.stop()
+        source.update_kernel_stats()
+        source.close()
+        report()
+
+def register_metrics_collectors():
+    """Export the components' stats() through the metrics registry."""
+    metrics.add_collector("decision_cache", lambda: decision_cache.stats(),
+                          counters=("hits", "negative_hits", "misses", "expired", "invalidated", "evictions"))
+    metrics.add_collector("flow_table", lambda: flow_table.stats(),
+                          counters=("admitted", "rejected", "completed", "expired", "evicted", "out_of_order"))
+    metrics.add_collector("flow_state", lambda: flow_states.stats(),
+                          counters=("lookups", "skipped", "expired", "evicted", "closed"))
+    metrics.add_collector("expiring_cache", dns_cache_stats, label="cache",
+                          counters=("hits", "misses", "evictions", "expired"))
+    metrics.add_collector("id_cache", id_cache_stats, label="table", counters=("hits", "misses", "evictions"))
+    metrics.add_collector("quic", lambda: quic_parser.stats() if quic_parser else None,
+                          counters=("decrypted", "failed", "reassembled"))
+    metrics.add_collector("writer", lambda: _packet_writer.stats() if _packet_writer else None,
+                          counters=("enqueued", "dropped", "written", "failed", "batches", "reconnects"))
+    metrics.add_collector("db_pool", lambda: db_pool.stats(),
+                          counters=("opened", "reused", "recycled", "ping_failures", "discarded", "retried", "timeouts"))
+    metrics.add_collector("coalescer", lambda: _request_coalescer.stats() if _request_coalescer else None,
+                          counters=("received", "merged", "emitted", "early"))
+    metrics.add_collector("attribution", lambda: _attribution_publisher.stats() if _attribution_publisher else None,
+                          counters=("sent", "dropped"))
+    metrics.add_collector("nft", lambda: _nft_updater.stats() if _nft_updater else None,
+                          counters=("queued", "deduplicated", "dropped", "applied", "failed",
+                                    "transactions", "fallback_calls"))
+    metrics.add_collector("lists", lambda: {
+        "blocklist_loaded": blocklist_index.loaded, "blocklist_version": blocklist_index.version,
+        "whitelist_version": whitelist_matcher.version,
+    })
+
+def start_metrics_endpoint(settings: dict):
+    """Export component stats and serve the metrics registry (if configured)."""
+    register_metrics_collectors()
+    return start_metrics_server(metrics, settings.get("logger_metrics_listen", ""))
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def make_packet_handler(settings: dict):
+    """Return the per-packet handler used by main() (and by bench_replay.py)."""
+    count_tcp, count_quic, count_dns, count_udp = (_m_packets.labels(p) for p in ("tcp", "quic", "dns", "udp"))
+    sni_quic_hit, sni_quic_miss = _m_sni.labels("quic", "hit"), _m_sni.labels("quic", "miss")
+    observe = _m_packet_seconds.observe
+    perf = time.perf_counter
 
-    # Create a packet handler that captures the settings
     def packet_handler_with_settings(packet):
+        started = perf()
         try:
-            # Update DNS cache from responses
-            if packet.haslayer(scapy.DNS):
-                _process_dns_packet(packet, settings)
-                _dns_cleanup()
             # TCP handling (HTTP/HTTPS)
-            if packet.haslayer(scapy.TCP):
+            if packet.is_tcp:
+                count_tcp.inc()
                 return tcp_packet_handler(packet, settings)
-            # QUIC handling via DNS inference
-            if packet.haslayer(scapy.UDP):
-                udp = packet[scapy.UDP]
-                if udp.dport == 443 or udp.sport == 443:
+            if packet.is_udp:
+                # QUIC: read the SNI from the client's Initial packets
+                if quic_parser is not None:
+                    if packet.dport == 443:
+                        count_quic.inc()
+                        # One row per connection: PTO retransmissions and post-Retry
+                        # Initials repeat the ClientHello on the same 4-tuple
+                        flow = (packet.src_ip, packet.sport, packet.dst_ip, packet.dport)
+                        if flow in _seen_quic_flows:
+                            return
+                        record = quic_parser.extract_client_hello(packet.payload, (packet.src_ip, packet.sport))
+                        host = parse_sni_from_bytes(record) if record else None
+                        if record is not None:
+                            (sni_quic_hit if host else sni_quic_miss).inc()
+                        if host:
+                            log_https_quic_request(packet, settings, host)
+                            _seen_quic_flows.put(flow, True)
+                    else:
+                        count_udp.inc()
+                    return
+                # Without QUIC decryption, infer the QUIC hostname from earlier DNS answers
+                if packet.sport == 53:
+                    count_dns.inc()
+                    _process_dns_packet(packet, settings)
+                    return
+                if packet.dport == 443 or packet.sport == 443:
+                    count_quic.inc()
                     src_ip, dst_ip = _get_ips(packet)
-                    sport, dport = udp.sport, udp.dport
+                    sport, dport = packet.sport, packet.dport
                     flow = (src_ip, sport, dst_ip, dport)
                     if flow not in _seen_quic_flows:
                         host = _dns_get(src_ip, dst_ip)
                         if host:
                             log_https_quic_request(packet, settings, host)
-                            _seen_quic_flows[flow] = time.time()
+                            _seen_quic_flows.put(flow, True)
                             return
+                else:
+                    count_udp.inc()
         except Exception as e:
-            log_level = settings.get("log_level", "INFO").upper()
-            if log_level in ("DEBUG", "ALL"):
-                print(f"handler error: {e}")
+            _m_handler_errors.inc()
+            log.limited(log.DEBUG, "handler", "handler error: %s", e)
+        finally:
+            observe(perf() - started)
+    return packet_handler_with_settings
+
+
+def start_components(settings: dict):
+    """Size the caches and start the writer, nft updater and list refresh threads."""
+    configure_id_caches(settings)
+    configure_db_pool(settings)
+    configure_decision_cache(settings)
+    configure_flow_table(settings)
+    configure_flow_states(settings)
+    configure_dns_cache(settings)
+    configure_quic_parser(settings)
+    start_attribution_publisher(settings)
+    start_packet_writer(settings)
+    start_request_coalescer(settings)
+    start_nft_updater(settings)
+
+    # Load active blocklists and whitelists into memory and keep them in sync in the background
+    blocklist_index.refresh_interval = settings.get("blocklist_refresh_interval", 30)
+    blocklist_index.start()
+    whitelist_matcher.refresh_interval = settings.get("whitelist_refresh_interval", 10)
+    whitelist_matcher.match_parents = settings.get("whitelist_match_parents", False)
+    whitelist_matcher.start()
+
+def stop_components():
+    """Flush queued rows and nft additions and close this process's connection."""
+    dc = decision_cache_stats()
+    log.info("Decision cache: hits=%d misses=%d hit_ratio=%.2f%%", dc['hits'], dc['misses'], dc['hit_ratio'] * 100)
+    stop_nft_updater()
+    stop_request_coalescer()
+    stop_packet_writer()
+    stop_attribution_publisher()
+    db_pool.close()
+
+def capture_filter() -> str:
+    """Capture TCP for HTTP/HTTPS and UDP:443 for QUIC (plus UDP:53 when QUIC names come from DNS)."""
+    return "tcp or udp dst port 443" if quic_parser is not None else "tcp or udp port 53 or udp port 443"
+
+def run_capture_shard(index: int, count: int, control, settings: dict, interface: str, fanout_group: int):
+    """Entry point of one capture process in sharded mode (see shard_supervisor.py)."""
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    start_components(settings)
+    register_metrics_collectors()
+    serve_control(control, metrics)
+    log.configure(settings.get("log_level", "INFO"))
+    log.info("Capture shard %d/%d started (pid %d)", index + 1, count, os.getpid())
+    try:
+        run_capture_pipeline(interface, capture_filter(), make_packet_handler(settings),
+                             dict(settings, fanout_group=fanout_group))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_components()
+        # Worker processes exit without running atexit handlers
+        log.flush()
+
+def run_sharded_capture(interface: str, settings: dict):
+    """Run capture_processes workers in one PACKET_FANOUT group and supervise them."""
+    fanout_group = os.getpid() & 0xFFFF
+    supervisor = ShardSupervisor(run_capture_shard, settings["capture_processes"],
+                                 args=(settings, interface, fanout_group))
+    metrics_server = start_metrics_server(supervisor, settings.get("logger_metrics_listen", ""))
+    stop_event = threading.Event()
+    supervisor.start()
+    try:
+        supervisor.run(stop_event)
+    finally:
+        stop_event.set()
+        supervisor.stop()
+        if metrics_server:
+            metrics_server.stop()
+
+def main():
+    """Main function - settings are loaded once at startup and remain static"""
+    # Load settings once at startup - no caching, no reloading
+    settings = load_system_settings()
+    log.configure(settings.get("log_level", "INFO"))
+
+    interface = get_default_interface()
+    log.info("Monitoring HTTP/HTTPS traffic on %s...", interface)
+    
+    # Display current git commit for version tracking
+    try:
+        git_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__)).decode('utf-8').strip()
+        log.info("Git commit: %s", git_commit)
+    except (subprocess.CalledProcessError, FileNotFoundError, OSError):
+        log.info("Git commit: unknown (not in git repository or git not available)")
+
+    # systemd stops the service with SIGTERM; treat it like Ctrl+C so queued rows are flushed
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+
+    log.info("Time\tSource\tDestination\tType\tMethod/Host")
+
+    if settings.get("capture_processes", 1) > 1:
+        # Each worker process captures a share of the traffic with its own lists, caches and connections
+        try:
+            run_sharded_capture(interface, settings)
+            log.info("\nMonitoring stopped")
+        except KeyboardInterrupt:
+            log.info("\nMonitoring stopped")
+        return
+
+    start_components(settings)
+    metrics_server = start_metrics_endpoint(settings)
+    packet_handler_with_settings = make_packet_handler(settings)
 
     try:
-        # Capture TCP for HTTP/HTTPS, UDP:53 for DNS, UDP:443 for QUIC
-        scapy.sniff(iface=interface, filter="tcp or udp port 53 or udp port 443", prn=packet_handler_with_settings, store=False)
+        run_capture_pipeline(interface, capture_filter(), packet_handler_with_settings, settings)
+        log.info("\nMonitoring stopped")
     except KeyboardInterrupt:
-        print("\nMonitoring stopped")
-        cursor.close()
-        conn.close()
+        log.info("\nMonitoring stopped")
     except Exception as e:
-        print(f"Error: {e}")
-        cursor.close()
-        conn.close()
+        log.error("%s", e)
+    finally:
+        stop_components()
+        if metrics_server:
+            metrics_server.stop()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+In-process metrics for the ZopLog daemons, served in Prometheus text format.
+
+Counters, gauges and latency histograms are plain Python objects updated on
+the hot path without locks (like the other counters in the logger, a rare
+lost increment under contention is acceptable). Components that already keep
+their own counters (caches, flow table, writer, nft updater) are exported
+through collectors: callables returning the component's stats() dict, read
+only when the endpoint is scraped.
+
+The endpoint is a small HTTP server on a daemon thread, listening on a TCP
+address ("127.0.0.1:9745") or a Unix socket ("unix:/run/zoplog/logger.sock"):
+
+    curl -s http://127.0.0.1:9745/metrics
+    curl -s --unix-socket /run/zoplog/logger.sock http://localhost/metrics
+"""
+
+import os
+import socketserver
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import zoplog_log as log
+
+# Seconds; spans sub-millisecond cache hits up to multi-second stalls
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# (sample name, ((label, value), ...), value)
+Sample = Tuple[str, Tuple[Tuple[str, str], ...], object]
+# (family name, type, help, samples): picklable, so other processes can send them
+Family = Tuple[str, str, str, List[Sample]]
+
+
+def _format_labels(pairs: Tuple[Tuple[str, str], ...]) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in pairs) + "}"
+
+
+def _format_value(value) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One slot per bucket plus +Inf; cumulated when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    """Context manager observing the elapsed time of its block."""
+    __slots__ = ("child", "started")
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Metric:
+    """A named metric family; unlabeled metrics proxy to their single child."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Child for these label values; keep the result to skip the lookup on hot paths."""
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self) -> List[Sample]:
+        return [(self.name, tuple(zip(self.labelnames, values)), child.value)
+                for values, child in list(self._children.items())]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.value = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, seconds: float):
+        self._default.observe(seconds)
+
+    def time(self):
+        return _Timer(self._default)
+
+    def samples(self) -> List[Sample]:
+        out = []
+        for values, child in list(self._children.items()):
+            labels = tuple(zip(self.labelnames, values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), list(child.counts)):
+                cumulative += count
+                out.append((self.name + "_bucket", labels + (("le", _format_value(float(bound))),), cumulative))
+            out.append((self.name + "_sum", labels, child.sum))
+            out.append((self.name + "_count", labels, child.count))
+        return out
+
+
+class Registry:
+    """Holds the metrics of one process and renders them for scraping."""
+
+    def __init__(self, prefix: str = "zoplog"):
+        self.prefix = prefix
+        self._metrics: Dict[str, Metric] = {}
+        # (name prefix, stats callable, keys exported as counters, label name)
+        self._collectors: List[Tuple[str, Callable[[], Optional[dict]], frozenset, Optional[str]]] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(f"{self.prefix}_{name}", help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(f"{self.prefix}_{name}", help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: Iterable[str] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(f"{self.prefix}_{name}", help_text, labelnames, buckets))
+
+    def add_collector(self, name: str, stats: Callable[[], Optional[dict]], counters: Iterable[str] = (),
+                      label: Optional[str] = None):
+        """Export the numeric fields of stats() as <prefix>_<name>_<field>.
+
+        Fields listed in counters are typed as counters, the rest as gauges.
+        stats() may return None when the component is not running. With label,
+        stats() returns {label value: stats dict} (e.g. one dict per cache).
+        """
+        self._collectors.append((f"{self.prefix}_{name}", stats, frozenset(counters), label))
+
+    def collect(self) -> List[Family]:
+        families = [(m.name, m.kind, m.help, m.samples()) for m in list(self._metrics.values())]
+        for name, stats, counters, label in self._collectors:
+            try:
+                values = stats() or {}
+            except Exception:
+                continue
+            groups = sorted(values.items()) if label else [(None, values)]
+            fields: Dict[str, List[Tuple[Tuple[Tuple[str, str], ...], object]]] = {}
+            for label_value, group in groups:
+                labels = ((label, str(label_value)),) if label else ()
+                for key, value in (group or {}).items():
+                    if isinstance(value, (int, float)):
+                        fields.setdefault(key, []).append((labels, value))
+            for key, samples in sorted(fields.items()):
+                kind = "counter" if key in counters else "gauge"
+                field = f"{name}_{key}_total" if kind == "counter" else f"{name}_{key}"
+                families.append((field, kind, "", [(field, labels, value) for labels, value in samples]))
+        return families
+
+    def render(self) -> str:
+        return render_families(self.collect())
+
+
+def render_families(families: Iterable[Family]) -> str:
+    lines = []
+    for name, kind, help_text, samples in families:
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample_name, labels, value in samples:
+            lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def merge_families(sources: Dict[str, List[Family]], label: str = "shard") -> List[Family]:
+    """Combine the snapshots of several processes into one set of families.
+
+    Every sample gets label=<source key>, so per-process series stay apart
+    and can be summed at query time.
+    """
+    merged: Dict[str, Family] = {}
+    for source, families in sorted(sources.items()):
+        for name, kind, help_text, samples in families:
+            family = merged.setdefault(name, (name, kind, help_text, []))
+            family[3].extend((sample_name, ((label, source),) + labels, value)
+                             for sample_name, labels, value in samples)
+    return list(merged.values())
+
+
+class TimedCursor:
+    """DB-API cursor proxy observing each statement's latency in a histogram."""
+
+    def __init__(self, cursor, histogram: Histogram):
+        self._cursor = cursor
+        self._execute = histogram.labels("execute")
+        self._executemany = histogram.labels("executemany")
+
+    def execute(self, *args):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(*args)
+        finally:
+            self._execute.observe(time.perf_counter() - started)
+
+    def executemany(self, *args):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(*args)
+        finally:
+            self._executemany.observe(time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+# --- HTTP endpoint ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = None
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _TCPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("unix", 0)
+
+
+class MetricsServer:
+    """Serves a registry (anything with render()) on a TCP address or Unix socket from a daemon thread."""
+
+    def __init__(self, registry: Registry, listen: str):
+        self.registry = registry
+        self.listen = listen.strip()
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        handler = type("MetricsHandler", (_MetricsHandler,), {"registry": self.registry})
+        if self.listen.startswith("unix:"):
+            path = self.listen[len("unix:"):]
+            if os.path.exists(path):
+                os.unlink(path)
+            self._server = _UnixServer(path, handler)
+        else:
+            host, _, port = self.listen.rpartition(":")
+            self._server = _TCPServer((host.strip("[]") or "127.0.0.1", int(port)), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        if self.listen.startswith("unix:"):
+            try:
+                os.unlink(self.listen[len("unix:"):])
+            except OSError:
+                pass
+        self._server = None
+
+
+def start_metrics_server(registry: Registry, listen: str) -> Optional[MetricsServer]:
+    """Start serving unless listen is empty; a bind failure only logs a warning."""
+    if not listen or not listen.strip():
+        return None
+    server = MetricsServer(registry, listen)
+    try:
+        server.start()
+    except (OSError, ValueError) as e:
+        log.warning("metrics endpoint %s unavailable: %s", listen, e)
+        return None
+    log.info("Metrics endpoint listening on %s", server.listen)
+    return server
@@ -4,78 +4,118 @@ Realtime reader for nftables LOG entries with prefixes:
   - ZOPLOG-BLOCKLIST-IN
   - ZOPLOG-BLOCKLIST-OUT
 
-Uses systemd.journal.Reader (no sleep loops). Prints each matched log to stdout
-and stores events into the database. No schema creation here.
+Uses systemd.journal.Reader (no sleep loops). Every matched entry is stored:
+entries available at a wakeup are parsed and written to blocked_events and
+blocked_event_messages with multi-row INSERTs, one transaction per batch, with
+the batch size adapted to the measured write time. No schema creation here.
+
+The journal cursor of the last stored entry is saved after every batch
+(reader_cursor_file) and reading resumes from it after a restart. A backlog -
+after a restart, or when the reader fell reader_catchup_lag seconds behind -
+is replayed in catch-up mode: large batches, messages parsed on worker
+processes, progress and lag logged until the live tail is reached.
+
+For testing, --journal-export replays `journalctl -o export` files instead of
+reading the journal (see journal_export.py).
 """
 
-import re
+import argparse
+import multiprocessing
 import sys
 import os
-from typing import Dict, Optional, Tuple
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
 from ipaddress import ip_address
 import subprocess
 
-from zoplog_config import load_database_config, DEFAULT_MONITOR_INTERFACE
+from zoplog_config import load_database_config, load_settings_config, DEFAULT_MONITOR_INTERFACE
+from metrics import Registry, TimedCursor, start_metrics_server
+from traffic_rollup import BlockedMinuteRollup
+from blocked_counts import BlockedCounts
+from ip_attribution import AttributionMap, AttributionListener
+from nft_log_parser import parse_log_line, parse_log_lines
+from journal_export import ExportReader
+from db_pool import ConnectionPool, PoolTimeout, error_code, is_connection_error, is_data_error, is_transient_error
+from batch_writer import AdaptiveBatchSize
+import zoplog_log as log
 
 # Get database configuration
 DB_CONFIG = load_database_config()
 
-# DB driver (PyMySQL preferred; fallback to mysql-connector)
-try:
-    import pymysql as mariadb
-except Exception:
-    try:
-        import mysql.connector as mariadb
-    except Exception:
-        sys.stderr.write("No MySQL driver found. Install 'pymysql' or 'mysql-connector-python'.\n")
-        sys.exit(1)
-
-# systemd journal reader
+# systemd journal reader (not needed to replay --journal-export files)
 try:
     from systemd import journal as sd_journal
 except Exception:
-    sys.stderr.write("python3-systemd is required. Install with: sudo apt install python3-systemd\n")
-    sys.exit(1)
-
-PREFIX_IN = "ZOPLOG-BLOCKLIST-IN"
-PREFIX_OUT = "ZOPLOG-BLOCKLIST-OUT"
-PREFIX_FWD = "ZOPLOG-BLOCKLIST-FWD"
-
-# Also handle cases where nftables appends interface direction
-PREFIX_IN_IN = "ZOPLOG-BLOCKLIST-ININ"
-PREFIX_IN_OUT = "ZOPLOG-BLOCKLIST-INOUT"
-PREFIX_OUT_IN = "ZOPLOG-BLOCKLIST-OUTIN"
-PREFIX_OUT_OUT = "ZOPLOG-BLOCKLIST-OUTOUT"
-PREFIX_FWD_IN = "ZOPLOG-BLOCKLIST-FWDIN"
-PREFIX_FWD_OUT = "ZOPLOG-BLOCKLIST-FWDOUT"
-
-def db_connect():
-    conn = mariadb.connect(**DB_CONFIG)
-    cur = conn.cursor()
-    return conn, cur
-
-def get_or_insert_ip(cursor, ip: Optional[str]) -> Optional[int]:
-    if not ip:
-        return None
-    
-    # Normalize IPv6 addresses to canonical compressed form
+    sd_journal = None
+
+# --- Metrics (served on reader_metrics_listen in Prometheus text format) ---
+metrics = Registry()
+m_entries = metrics.counter("reader_journal_entries_total", "Kernel journal entries read, by outcome", ("outcome",))
+m_backlog = metrics.gauge("reader_backlog_entries", "Journal entries returned by the last wakeup")
+m_batch_events = metrics.histogram("reader_batch_events", "Block events stored per transaction",
+                                   buckets=(1, 5, 10, 50, 100, 250, 500, 1000, 2500, 5000))
+m_batch_size = metrics.gauge("reader_batch_size", "Current adaptive batch size limit")
+m_inserted = metrics.counter("reader_events_inserted_total", "Block events stored", ("direction",))
+m_db_errors = metrics.counter("reader_db_errors_total", "Block events that failed to store")
+m_reconnects = metrics.counter("reader_db_reconnects_total", "Database reconnects after a lost connection")
+m_db_seconds = metrics.histogram("reader_db_statement_seconds", "Latency of block-log SQL statements", ("call",))
+m_commit_seconds = metrics.histogram("reader_db_commit_seconds", "Latency of block event batch commits")
+m_lag = metrics.gauge("reader_lag_seconds", "Age of the newest block event committed")
+m_catching_up = metrics.gauge("reader_catching_up", "1 while a journal backlog is replayed in catch-up mode")
+m_catchup_entries = metrics.counter("reader_catchup_entries_total", "Journal entries replayed in catch-up mode")
+m_event_lag = metrics.histogram("reader_event_lag_seconds", "Time from the kernel log entry to its commit",
+                                buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+
+# Foreign key violation: a referenced row was deleted (e.g. by orphan cleanup)
+ER_NO_REFERENCED_ROW = 1452
+
+def db_pool(settings: dict) -> ConnectionPool:
+    """Write sessions for block events; one connection, as events are stored in order."""
+    return ConnectionPool(
+        DB_CONFIG, name="reader-db", size=1, write_size=1,
+        checkout_timeout=settings.get("db_pool_timeout", 5.0),
+        ping_interval=settings.get("db_ping_interval", 1.0),
+        idle_timeout=settings.get("db_idle_timeout", 300),
+        retries=settings.get("db_retry_attempts", 2),
+        backoff=settings.get("db_retry_backoff", 0.25),
+        wrap_cursor=lambda cur: TimedCursor(cur, m_db_seconds),
+        observe_commit=m_commit_seconds.observe,
+    )
+
+def normalize_ip(ip: str) -> str:
+    """Canonical text form (compressed IPv6) as stored in ip_addresses."""
     try:
-        normalized_ip = str(ip_address(ip))
-        ip = normalized_ip
+        return str(ip_address(ip))
     except ValueError:
         # Not a valid IP address, use as-is
-        pass
-    
-    cursor.execute(
-        "INSERT INTO ip_addresses (ip_address) VALUES (%s) "
-        "ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id)",
-        (ip,),
-    )
-    return cursor.lastrowid
+        return ip
+
+def _in_list(values) -> str:
+    return ",".join(["%s"] * len(values))
+
+def resolve_ip_ids(cursor, ips) -> Dict[str, int]:
+    """ip_addresses ids for a set of normalized addresses, inserting the missing ones."""
+    ips = sorted(ips)
+    if not ips:
+        return {}
+    cursor.execute(f"SELECT ip_address, id FROM ip_addresses WHERE ip_address IN ({_in_list(ips)})", ips)
+    ids = {normalize_ip(ip): ip_id for ip, ip_id in cursor.fetchall()}
+    missing = [ip for ip in ips if ip not in ids]
+    if missing:
+        cursor.executemany(
+            "INSERT INTO ip_addresses (ip_address) VALUES (%s) ON DUPLICATE KEY UPDATE id = id",
+            [(ip,) for ip in missing],
+        )
+        cursor.execute(f"SELECT ip_address, id FROM ip_addresses WHERE ip_address IN ({_in_list(missing)})", missing)
+        ids.update((normalize_ip(ip), ip_id) for ip, ip_id in cursor.fetchall())
+    return ids
 
 def get_wan_ip_id(direction: str, src_ip_id: Optional[int], dst_ip_id: Optional[int], phys_iface_in: Optional[str], phys_iface_out: Optional[str], monitoring_interface: str) -> Optional[int]:
     """
-    Determine the WAN IP ID based on interface information.
+    Determine the WAN IP ID (or address, given addresses) based on interface information.
     The monitoring interface is the WAN-facing interface.
     """
     if direction == "FWD":
@@ -92,250 +132,563 @@ def get_wan_ip_id(direction: str, src_ip_id: Optional[int], dst_ip_id: Optional[
         return dst_ip_id
     else:
         # Defensive programming - any other direction, assume dst_ip
-        print(f"Other direction: '{direction}', assuming dst_ip is WAN")
+        log.limited(log.WARNING, ("direction", direction), "Other direction: '%s', assuming dst_ip is WAN", direction)
         return dst_ip_id
 
-# Inject a space right after the prefix token if glued (e.g., ...-OUTIN=)
-def _normalize_prefix_spacing(msg: str) -> str:
-    all_prefixes = (
-        PREFIX_IN, PREFIX_OUT, PREFIX_FWD,
-        PREFIX_IN_IN, PREFIX_IN_OUT, PREFIX_OUT_IN, PREFIX_OUT_OUT,
-        PREFIX_FWD_IN, PREFIX_FWD_OUT
-    )
-    for pref in all_prefixes:
-        i = msg.find(pref)
-        if i != -1:
-            j = i + len(pref)
-            if j < len(msg) and msg[j] != ' ':
-                msg = msg[:j] + ' ' + msg[j:]
-    return msg
-
-kv_re = re.compile(r"\b([A-Z]+)=([^\s]+)")
-
-def parse_log_line(line: str) -> Optional[Tuple[str, Dict[str, str]]]:
-    all_prefixes = (
-        PREFIX_IN, PREFIX_OUT, PREFIX_FWD,
-        PREFIX_IN_IN, PREFIX_IN_OUT, PREFIX_OUT_IN, PREFIX_OUT_OUT,
-        PREFIX_FWD_IN, PREFIX_FWD_OUT
-    )
-    
-    # Check if any of our prefixes are in the line
-    found_prefix = None
-    for pref in all_prefixes:
-        if pref in line:
-            found_prefix = pref
-            break
-    
-    if not found_prefix:
-        return None
-        
-    line = _normalize_prefix_spacing(line)
-    
-    # Map the found prefix to the correct direction
-    if found_prefix in (PREFIX_IN, PREFIX_IN_IN, PREFIX_IN_OUT, PREFIX_OUT_IN):
-        direction = "IN"
-    elif found_prefix in (PREFIX_OUT, PREFIX_OUT_OUT):
-        direction = "OUT"
-    elif found_prefix in (PREFIX_FWD, PREFIX_FWD_IN, PREFIX_FWD_OUT):
-        direction = "FWD"
-    else:
-        return None
-    
-    fields = {}
-    for match in kv_re.finditer(line):
-        key = match.group(1)
-        value = match.group(2)
-        # Only set the field if it hasn't been set before (preserve first occurrence)
-        if key not in fields:
-            fields[key] = value
-    return direction, fields
-
-def insert_block_event(conn, cursor, direction: str, fields: Dict[str, str], raw: str):
-    iface_in = fields.get("IN")
-    iface_out = fields.get("OUT")
-    phys_iface_in = fields.get("PHYSIN")
-    phys_iface_out = fields.get("PHYSOUT")
-    proto = fields.get("PROTO")
-    src_ip = fields.get("SRC")
-    dst_ip = fields.get("DST")
-    spt = fields.get("SPT")
-    dpt = fields.get("DPT")
+EVENT_COLUMNS = ("(event_time, direction, src_ip_id, dst_ip_id, wan_ip_id, domain_id, "
+                 "src_port, dst_port, proto, iface_in, iface_out)")
+EVENT_VALUES = "(%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+# Rows per multi-row INSERT; keeps each statement well below max_allowed_packet
+INSERT_CHUNK = 500
 
-    try:
-        src_port = int(spt) if spt and spt.isdigit() else None
-    except Exception:
-        src_port = None
-    try:
-        dst_port = int(dpt) if dpt and dpt.isdigit() else None
-    except Exception:
-        dst_port = None
+def _port(value: Optional[str]) -> Optional[int]:
+    return int(value) if value and value.isdigit() else None
 
-    src_ip_id = get_or_insert_ip(cursor, src_ip)
-    dst_ip_id = get_or_insert_ip(cursor, dst_ip)
+# @@auto_increment_increment, read on first use (Galera sets it to the cluster size)
+_auto_increment_step: Optional[int] = None
 
-    # TODO: Also store phys_iface_in/phys_iface_out in DB
+def auto_increment_step(cursor) -> int:
+    """The server's auto-increment step, queried once per process."""
+    global _auto_increment_step
+    if _auto_increment_step is None:
+        cursor.execute("SELECT @@auto_increment_increment")
+        _auto_increment_step = int(cursor.fetchone()[0])
+    return _auto_increment_step
 
-    wan_ip_id = get_wan_ip_id(direction, src_ip_id, dst_ip_id, phys_iface_in, phys_iface_out, DEFAULT_MONITOR_INTERFACE)
+def insert_multirow(cursor, table: str, columns: str, values: str, rows: List[tuple]) -> List[int]:
+    """Insert rows with multi-row INSERT statements; returns their auto-increment ids.
 
-    domain_id = get_domain_id(cursor, wan_ip_id)
+    InnoDB gives the rows of one multi-row INSERT ids starting at
+    LAST_INSERT_ID() and spaced by auto_increment_increment (innodb_autoinc_lock_mode
+    0/1, and 2 with the reader as the only writer of blocked_events).
+    """
+    step = auto_increment_step(cursor)
+    ids: List[int] = []
+    for i in range(0, len(rows), INSERT_CHUNK):
+        chunk = rows[i:i + INSERT_CHUNK]
+        cursor.execute(f"INSERT INTO {table} {columns} VALUES " + ",".join([values] * len(chunk)),
+                       [v for row in chunk for v in row])
+        first = cursor.lastrowid
+        ids.extend(range(first, first + len(chunk) * step, step))
+    return ids
+
+def store_block_events(cursor, events: List[tuple], rollup: Optional[BlockedMinuteRollup] = None,
+                       counts: Optional[BlockedCounts] = None,
+                       attributions: Optional[AttributionMap] = None) -> List[tuple]:
+    """Store a batch of (direction, record, raw, logged at) block events in the caller's transaction.
+
+    Addresses and domains are resolved once per batch, events and their raw
+    messages are written with multi-row INSERTs. WAN addresses found in
+    attributions (published by the logger) need no lookup; the
+    (ip, domain_id, ip_id) attributions looked up in the database instead
+    are returned, to be added to the map once the batch has committed.
+    """
+    addresses = []
+    ips = set()
+    for direction, record, _, _ in events:
+        src_ip = normalize_ip(record.src) if record.src else None
+        dst_ip = normalize_ip(record.dst) if record.dst else None
+        # TODO: Also store phys_iface_in/phys_iface_out in DB
+        wan_ip = get_wan_ip_id(direction, src_ip, dst_ip, record.phys_in, record.phys_out,
+                               DEFAULT_MONITOR_INTERFACE)
+        addresses.append((src_ip, dst_ip, wan_ip))
+        ips.update(ip for ip in (src_ip, dst_ip) if ip)
+
+    wan_ips = {wan_ip for _, _, wan_ip in addresses if wan_ip}
+    attributed: Dict[str, tuple] = {}
+    if attributions is not None:
+        for ip in wan_ips:
+            known = attributions.get(ip)
+            if known is not None:
+                attributed[ip] = known
+    ip_ids = {ip: ip_id for ip, (_, ip_id) in attributed.items()}
+    ip_ids.update(resolve_ip_ids(cursor, ips.difference(attributed)))
+
+    # Most recently seen domain for the WAN addresses the map did not know
+    lookup = {ip_ids[ip]: ip for ip in wan_ips if ip not in attributed and ip in ip_ids}
+    domain_ids = latest_domain_ids(cursor, lookup)
+    looked_up = [(ip, domain_ids.get(ip_id), ip_id) for ip_id, ip in lookup.items()]
+    attributed.update((ip, (domain_id, ip_id)) for ip, domain_id, ip_id in looked_up)
+
+    rows = []
+    for (direction, record, raw, when), (src_ip, dst_ip, wan_ip) in zip(events, addresses):
+        event_time = datetime.fromtimestamp(when).strftime('%Y-%m-%d %H:%M:%S')
+        domain_id, wan_ip_id = attributed.get(wan_ip, (None, None)) if wan_ip else (None, None)
+        rows.append([event_time, direction, ip_ids.get(src_ip) if src_ip else None,
+                     ip_ids.get(dst_ip) if dst_ip else None, wan_ip_id, domain_id,
+                     _port(record.spt), _port(record.dpt), record.proto,
+                     record.iface_in, record.iface_out])
+
+    event_ids = insert_multirow(cursor, "blocked_events", EVENT_COLUMNS, EVENT_VALUES, rows)
+
+    # Raw messages go to a separate table
+    messages = [(event_id, raw[:65535]) for event_id, (_, _, raw, _) in zip(event_ids, events) if raw]
+    if messages:
+        insert_multirow(cursor, "blocked_event_messages", "(id, message)", "(%s,%s)", messages)
+
+    if rollup is not None:
+        for row, event in zip(rows, events):
+            rollup.add(row[1], row[4], event[3])
+
+    # blocked_count increments are written by BlockedCounts, duplicates within its window are not counted
+    if counts is not None:
+        for row, event in zip(rows, events):
+            counts.add(row[2], row[3], row[5], row[4], event[3])
+
+    return looked_up
+
+class CursorFile:
+    """Journal cursor of the last stored entry, replaced atomically on every save."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> Optional[str]:
+        try:
+            with open(self.path) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            log.warning("Cannot read journal cursor %s: %s", self.path, e)
+            return None
+
+    def save(self, cursor: str):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(cursor + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.limited(log.ERROR, "cursor-save", "Cannot save journal cursor %s: %s", self.path, e)
+
+def journal_reader(cursor: Optional[str] = None, max_age: float = 0, export_paths: Optional[List[str]] = None):
+    """Journal reader positioned after cursor, or at the tail; returns (reader, resumed)."""
+    if export_paths:
+        r = ExportReader(export_paths)
+    elif sd_journal is not None:
+        r = sd_journal.Reader()
+    else:
+        sys.stderr.write("python3-systemd is required. Install with: sudo apt install python3-systemd\n")
+        sys.exit(1)
+    if not cursor:
+        try:
+            r.this_boot()
+        except Exception:
+            pass
+    # Kernel transport - correct way to filter kernel messages
+    r.add_match(_TRANSPORT="kernel")
+    if cursor:
+        # Resume after the last stored entry, also across a reboot
+        try:
+            r.seek_cursor(cursor)
+            entry = r.get_next()
+        except Exception as e:
+            log.warning("Saved journal cursor is unusable (%s), starting at the tail", e)
+            entry = None
+        if entry:
+            if entry.get('__CURSOR') != cursor:
+                # The entry itself was rotated away; the journal placed us on the closest one, not stored yet
+                r.get_previous()
+            oldest = datetime.now() - timedelta(seconds=max_age)
+            if max_age and entry.get('__REALTIME_TIMESTAMP', oldest) < oldest:
+                log.warning("Journal backlog reaches back to %s, replaying only the last %ds",
+                            entry['__REALTIME_TIMESTAMP'], max_age)
+                r.seek_realtime(oldest)
+            return r, True
+    if export_paths:
+        # A recording is replayed from its first entry
+        r.seek_head()
+        return r, True
+    # Start from tail to only get new entries
+    r.seek_tail()
+    r.get_previous()
+    return r, False
 
+def latest_domain_ids(cursor, wan_ip_ids) -> Dict[int, int]:
+    """Most recently seen domain per WAN address id."""
+    wan_ip_ids = sorted(wan_ip_ids)
+    if not wan_ip_ids:
+        return {}
     cursor.execute(
-        """
-        INSERT INTO blocked_events
-          (event_time, direction, src_ip_id, dst_ip_id, wan_ip_id, domain_id, src_port, dst_port, proto, iface_in, iface_out)
-        VALUES (NOW(), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """,
-        (direction, src_ip_id, dst_ip_id, wan_ip_id, domain_id, src_port, dst_port, proto, iface_in, iface_out),
+        f"SELECT ip_address_id, domain_id, last_seen FROM domain_ip_addresses WHERE ip_address_id IN ({_in_list(wan_ip_ids)})",
+        wan_ip_ids,
     )
+    latest: Dict[int, tuple] = {}
+    for ip_id, domain_id, last_seen in cursor.fetchall():
+        if ip_id not in latest or last_seen > latest[ip_id][1]:
+            latest[ip_id] = (domain_id, last_seen)
+    return {ip_id: domain_id for ip_id, (domain_id, _) in latest.items()}
+
+def entry_time(entry) -> float:
+    logged_at = entry.get('__REALTIME_TIMESTAMP')
+    return logged_at.timestamp() if isinstance(logged_at, datetime) else time.time()
+
+def _is_candidate(msg: str) -> bool:
+    """Whether a journal message may be a block event (other outcomes are counted here)."""
+    if not msg:
+        m_entries.labels("empty").inc()
+        return False
+
+    # Fast path: only care for our prefixes
+    if "ZOPLOG-BLOCKLIST-" not in msg:
+        m_entries.labels("other").inc()
+        return False
+    return True
+
+def parse_entry(entry) -> Optional[tuple]:
+    """Block event (direction, record, raw, logged at) for a journal entry, or None."""
+    msg = entry.get('MESSAGE', '')
+    if not _is_candidate(msg):
+        return None
 
-    event_id = cursor.lastrowid
+    log.debug("[RAW JOURNAL] %s", msg)
+    return block_event(msg, parse_log_line(msg), entry_time(entry))
 
-    # Insert message into separate table
-    if raw:
-        cursor.execute(
-            "INSERT INTO blocked_event_messages (id, message) VALUES (%s, %s)",
-            (event_id, raw[:65535]),
-        )
-    
-    # Increment blocked_count for the related domain_ip_addresses row
-    # Only increment if this is not a duplicate event within 5 seconds
-    if wan_ip_id and domain_id:
-        cursor.execute("""
-            UPDATE domain_ip_addresses 
-            SET blocked_count = blocked_count + 1, last_seen = NOW()
-            WHERE ip_address_id = %s AND domain_id = %s
-            AND (
-                SELECT MAX(event_time) 
-                FROM blocked_events 
-                WHERE src_ip_id = %s AND dst_ip_id = %s
-            ) > domain_ip_addresses.last_seen + INTERVAL 5 SECOND
-            OR NOT EXISTS (
-                SELECT 1 
-                FROM blocked_events 
-                WHERE src_ip_id = %s AND dst_ip_id = %s
-            )
-        """, (wan_ip_id, domain_id, src_ip_id, dst_ip_id, src_ip_id, dst_ip_id))
+def block_event(msg: str, record, when: float) -> Optional[tuple]:
+    """Block event for a parsed ZOPLOG-BLOCKLIST message, or None (counts the outcome)."""
+    if record is None:
+        # Show raw for troubleshooting
+        m_entries.labels("unparsed").inc()
+        log.limited(log.DEBUG, "unparsed", "Unparsed: %s", msg)
+        return None
 
-    
+    # Skip ICMP packets as they are usually not relevant for domain blocking
+    if record.proto == 'ICMP':
+        m_entries.labels("icmp").inc()
+        return None
+    m_entries.labels("block_event").inc()
+
+    if log.debug_enabled:
+        log.debug("[%s] %s %s:%s -> %s:%s IN=%s OUT=%s", record.direction, record.proto or '', record.src or '',
+                  record.spt or '', record.dst or '', record.dpt or '', record.iface_in or '', record.iface_out or '')
+
+    return record.direction, record, record.message, when
+
+class EventIngest:
+    """Collects parsed block events and stores them in batches without losing any.
+
+    A batch is written when it reaches the adaptive batch size or when the
+    journal has been drained; blocked_count increments go with the first
+    batch after their flush interval, or on their own when the journal is
+    quiet. A batch referring to a domain or address that no longer exists
+    (deleted by orphan cleanup while it was in the attribution map) is
+    retried once with an empty map. One rejected for its data (value too
+    long, invalid value) is stored event by event so only the bad entries
+    are dropped. Any other failure - lost connection, lock wait timeout,
+    deadlock - holds the batch and retries it with backoff; the journal is
+    not read further meanwhile (it keeps the entries).
+
+    The caller sets position to the journal cursor of each entry it has
+    handled; once everything up to it is stored, flush() saves it to
+    cursor_file.
+    """
 
-def journal_reader():
-    r = sd_journal.Reader()
-    try:
-        r.this_boot()
-    except Exception:
-        pass
-    # Kernel transport - correct way to filter kernel messages
-    r.add_match(_TRANSPORT="kernel")
-    # Start from tail to only get new entries
-    r.seek_tail()
-    r.get_previous()
-    return r
+    def __init__(self, pool: ConnectionPool, rollup: BlockedMinuteRollup, counts: BlockedCounts,
+                 batch_size: AdaptiveBatchSize, attributions: Optional[AttributionMap] = None,
+                 cursor_file: Optional[CursorFile] = None):
+        self.pool = pool
+        self.rollup = rollup
+        self.counts = counts
+        self.attributions = attributions
+        self._looked_up: List[tuple] = []
+        self.batch_size = batch_size
+        # Fixed batch size overriding the adaptive one (catch-up mode)
+        self.limit: Optional[int] = None
+        self.pending: List[tuple] = []
+        self.cursor_file = cursor_file
+        self.position: Optional[str] = None
+        self._saved_position: Optional[str] = None
+        self.stored = 0
+        m_batch_size.set(batch_size.size)
+
+    def add(self, event: tuple):
+        self.pending.append(event)
+        if len(self.pending) >= (self.limit or self.batch_size.size):
+            self.flush()
+
+    def flush(self):
+        events, self.pending = self.pending, []
+        if events or self.counts.due():
+            self._store(events)
+        if self.cursor_file and self.position and self.position != self._saved_position:
+            self.cursor_file.save(self.position)
+            self._saved_position = self.position
+
+    def close(self):
+        """Write the blocked_count increments not flushed yet (one attempt, at shutdown)."""
+        try:
+            self.pool.run(lambda cursor: self.counts.write(cursor, force=True), write=True)
+            self.counts.committed()
+        except Exception as e:
+            self.counts.discard()
+            log.error("Could not write pending blocked counts: %s", e)
+
+    def _write(self, cursor, events: List[tuple]):
+        # A retry after a lost connection starts from a rolled-back transaction
+        self.rollup.discard()
+        self.counts.discard()
+        self._looked_up = store_block_events(cursor, events, self.rollup, self.counts, self.attributions)
+        self.rollup.write(cursor)
+        self.counts.write(cursor)
+
+    def _store(self, events: List[tuple]):
+        backoff = 0.5
+        cleared = False
+        while True:
+            retried = self.pool.retried
+            started = time.perf_counter()
+            try:
+                self.pool.run(lambda cursor: self._write(cursor, events), write=True)
+            except Exception as e:
+                self.rollup.discard()
+                self.counts.discard()
+                m_reconnects.inc(self.pool.retried - retried)
+                if error_code(e) == ER_NO_REFERENCED_ROW and self.attributions is not None and not cleared:
+                    self.attributions.clear()
+                    cleared = True
+                    continue
+                if is_data_error(e):
+                    # Deterministic: isolate the offending event(s), only those are dropped
+                    if len(events) == 1:
+                        m_db_errors.inc()
+                        log.limited(log.ERROR, "db", "DB error, block event dropped: %s", e)
+                        return
+                    log.limited(log.WARNING, "db-batch", "Storing %d block events one by one after a data error: %s",
+                                len(events), e)
+                    for event in events:
+                        self._store([event])
+                    return
+                # Lost connection, lock wait timeout, deadlock or anything else: hold the
+                # batch and retry it, the journal cursor does not move past it meanwhile
+                if is_connection_error(e) or isinstance(e, PoolTimeout):
+                    reason = "Database unavailable"
+                elif is_transient_error(e):
+                    reason = "Lock conflict"
+                else:
+                    reason = "DB error"
+                log.limited(log.ERROR, "db-hold", "%s, holding %d block events (retrying in %.1fs): %s",
+                            reason, len(events), backoff, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            seconds = time.perf_counter() - started
+            m_reconnects.inc(self.pool.retried - retried)
+            self.rollup.committed()
+            self.counts.committed()
+            if self.attributions is not None:
+                for ip, domain_id, ip_id in self._looked_up:
+                    self.attributions.put(ip, domain_id, ip_id)
+            if events:
+                self._stored(events, seconds)
+            return
+
+    def _stored(self, events: List[tuple], seconds: float):
+        m_batch_events.observe(len(events))
+        m_batch_size.set(self.batch_size.update(len(events), seconds))
+        self.stored += len(events)
+        now = time.time()
+        directions: Dict[str, int] = {}
+        newest = 0.0
+        for direction, _, _, when in events:
+            directions[direction] = directions.get(direction, 0) + 1
+            m_event_lag.observe(max(0.0, now - when))
+            newest = max(newest, when)
+        m_lag.set(max(0.0, now - newest))
+        for direction, count in directions.items():
+            m_inserted.labels(direction).inc(count)
+        log.info("Stored %d block event(s) (%s) in %.0f ms", len(events),
+                 " ".join(f"{d}={n}" for d, n in sorted(directions.items())), seconds * 1000)
+
+# Messages per parse task in catch-up mode
+CATCHUP_CHUNK = 2000
+
+class CatchUp:
+    """Replays a journal backlog until the live tail is reached.
+
+    Batches are reader_catchup_batch events instead of the adaptive size,
+    and candidate messages are parsed in chunks on worker processes while
+    the next chunk is read from the journal (inline when there is no CPU to
+    spare). Results are consumed in journal order, so events are stored and
+    the cursor advances exactly as in live mode. Progress and lag are logged
+    every progress_interval seconds.
+    """
 
-def get_domain_id(cursor, wan_ip_id: Optional[int]) -> Optional[int]:
-    if not wan_ip_id:
-        return None
-    cursor.execute("SELECT domain_id FROM domain_ip_addresses WHERE ip_address_id = %s ORDER BY last_seen DESC LIMIT 1", (wan_ip_id,))
-    result = cursor.fetchone()
-    return result[0] if result else None
+    def __init__(self, ingest: EventIngest, batch: int = 20000, workers: int = 2,
+                 progress_interval: float = 5.0):
+        self.ingest = ingest
+        self.batch = max(1, int(batch))
+        self.workers = max(0, min(int(workers), (os.cpu_count() or 1) - 1))
+        self.progress_interval = progress_interval
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _parse(self, messages: List[str]):
+        """Future-like result of parsing messages (a worker task, or parsed now)."""
+        if not self.workers:
+            return parse_log_lines(messages)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("forkserver"))
+        return self._executor.submit(parse_log_lines, messages)
+
+    def _consume(self, chunk: List[tuple], parsed):
+        """Hand a chunk of (cursor, when, candidate message or None) to the ingest, in order."""
+        records = iter(parsed if isinstance(parsed, list) else parsed.result())
+        ingest = self.ingest
+        for cursor, when, msg in chunk:
+            ingest.position = cursor
+            if msg is not None:
+                event = block_event(msg, next(records), when)
+                if event is not None:
+                    ingest.add(event)
+
+    def run(self, r, first_entry: Optional[dict] = None):
+        ingest = self.ingest
+        ingest.limit = self.batch
+        m_catching_up.set(1)
+        started = last_report = time.monotonic()
+        stored_before = ingest.stored
+        read = 0
+        when = time.time()
+        chunk: List[tuple] = []
+        messages: List[str] = []
+        in_flight: deque = deque()
+
+        def submit():
+            in_flight.append((chunk[:], self._parse(messages[:])))
+            chunk.clear()
+            messages.clear()
+            # Keep every worker busy with one chunk while the next one is read
+            while len(in_flight) > self.workers:
+                self._consume(*in_flight.popleft())
+
+        entries = r if first_entry is None else _chain(first_entry, r)
+        try:
+            for entry in entries:
+                read += 1
+                when = entry_time(entry)
+                msg = entry.get('MESSAGE', '')
+                if _is_candidate(msg):
+                    messages.append(msg)
+                    chunk.append((entry.get('__CURSOR'), when, msg))
+                else:
+                    chunk.append((entry.get('__CURSOR'), when, None))
+                if len(chunk) >= CATCHUP_CHUNK:
+                    submit()
+                now = time.monotonic()
+                if now - last_report >= self.progress_interval:
+                    last_report = now
+                    log.info("Catch-up: %d journal entries read (%.0f/s), %d block events stored, %.0fs behind",
+                             read, read / (now - started), ingest.stored - stored_before, max(0.0, time.time() - when))
+            if chunk:
+                submit()
+            while in_flight:
+                self._consume(*in_flight.popleft())
+            ingest.flush()
+        finally:
+            ingest.limit = None
+            m_catching_up.set(0)
+            m_catchup_entries.inc(read)
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+        elapsed = time.monotonic() - started
+        log.info("Catch-up done: %d journal entries in %.1fs (%.0f/s), %d block events stored, now %.1fs behind",
+                 read, elapsed, read / elapsed if elapsed else 0.0, ingest.stored - stored_before,
+                 max(0.0, time.time() - when))
+
+def _chain(first: dict, rest):
+    yield first
+    yield from rest
 
 def main():
-    print("Starting nft block log reader (systemd-journal)…", flush=True)
+    parser = argparse.ArgumentParser(description="ZopLog nftables block log reader")
+    parser.add_argument("--journal-export", nargs="+", metavar="FILE",
+                        help="Replay `journalctl -o export` files instead of reading the journal, then exit")
+    parser.add_argument("--cursor-file", help="Journal cursor file (default: reader_cursor_file setting)")
+    args = parser.parse_args()
+
+    settings = load_settings_config()
+    log.configure(settings.get("log_level", "INFO"))
+    log.info("Starting nft block log reader (systemd-journal)…")
     
     # Display current git commit for version tracking
     try:
         git_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__)).decode('utf-8').strip()
-        print(f"Git commit: {git_commit}", flush=True)
+        log.info("Git commit: %s", git_commit)
     except (subprocess.CalledProcessError, FileNotFoundError, OSError):
-        print("Git commit: unknown (not in git repository or git not available)", flush=True)
-
-    conn, cursor = db_connect()
-    r = journal_reader()
+        log.info("Git commit: unknown (not in git repository or git not available)")
+
+    metrics_server = start_metrics_server(metrics, settings.get("reader_metrics_listen", ""))
+
+    pool = db_pool(settings)
+    cursor_path = args.cursor_file if args.cursor_file is not None else settings.get("reader_cursor_file", "")
+    cursor_file = CursorFile(cursor_path) if cursor_path else None
+    r, resumed = journal_reader(cursor_file.load() if cursor_file else None,
+                                max_age=settings.get("reader_catchup_max_age", 86400),
+                                export_paths=args.journal_export)
+    # Per-minute counts for blocked_event_minutes, written with each commit
+    rollup = BlockedMinuteRollup()
+    # blocked_count increments for domain_ip_addresses, written every flush interval
+    counts = BlockedCounts(window=settings.get("reader_duplicate_window", 5.0),
+                           flush_interval=settings.get("reader_count_flush_interval", 5.0))
+    metrics.add_collector("reader_blocked_counts", counts.stats, counters=("counted", "suppressed", "flushes"))
+    # IP -> domain attributions published by the logger, so most events need no domain lookup
+    attributions = AttributionMap(size=settings.get("reader_attribution_size", 65536),
+                                  ttl=settings.get("reader_attribution_ttl", 600))
+    metrics.add_collector("reader_attribution", attributions.stats,
+                          counters=("hits", "misses", "received", "expired", "evictions"))
+    listener = None
+    if settings.get("attribution_socket"):
+        listener = AttributionListener(settings["attribution_socket"], attributions)
+        listener.start()
+
+    ingest = EventIngest(pool, rollup, counts, AdaptiveBatchSize(
+        maximum=settings.get("reader_batch_max", 5000),
+        target_seconds=settings.get("reader_commit_target", 0.5),
+    ), attributions, cursor_file)
+    catchup = CatchUp(ingest, batch=settings.get("reader_catchup_batch", 20000),
+                      workers=settings.get("reader_catchup_workers", 2))
+    catchup_lag = settings.get("reader_catchup_lag", 30)
 
     try:
+        if resumed:
+            log.info("Resuming from the saved journal cursor, replaying the backlog")
+            catchup.run(r)
+
         while True:
-            # Wait for new journal entries
-            r.wait()
-            
-            # Get all available entries and process up to 5 most recent to avoid overwhelming slow SD card
-            entries = list(r)
-            total_entries = len(entries)
-            processed_count = 0
-            
-            for entry in entries:
-                if processed_count >= 5:
-                    skipped_count = total_entries - processed_count
-                     # Log skipped events if any
-                    if skipped_count > 0:
-                        print(f"[DEBUG] {skipped_count} events skipped to maintain performance (processing only 5 most recent)", flush=True)
+            # Wait for new journal entries (waking up to flush blocked counts when quiet)
+            r.wait(counts.flush_interval)
+
+            # Parse every entry available; full batches are stored on the way
+            drained = 0
+            for entry in r:
+                drained += 1
+                if catchup_lag and time.time() - entry_time(entry) > catchup_lag:
+                    log.warning("Block log reader is %.0fs behind the journal, switching to catch-up mode",
+                                time.time() - entry_time(entry))
+                    catchup.run(r, entry)
                     break
-                    
-                msg = entry.get('MESSAGE', '')
-                if not msg:
-                    continue
-
-                # Fast path: only care for our prefixes
-                if "ZOPLOG-BLOCKLIST-" not in msg:
-                    continue
-
-                print(f"[RAW JOURNAL] {msg}", flush=True)
-
-                # Normalize glued prefix (…-OUTIN= / …-ININ=)
-                raw = _normalize_prefix_spacing(msg)
-                parsed = parse_log_line(raw)
-                if not parsed:
-                    # Show raw for troubleshooting
-                    print(f"[DEBUG] Unparsed: {raw}", flush=True)
-                    continue
-
-                direction, fields = parsed
-
-                # Skip ICMP packets as they are usually not relevant for domain blocking
-                if fields.get('PROTO') == 'ICMP':
-                    continue
-
-                # Print summary + raw line for troubleshooting
-                proto = fields.get('PROTO') or ''
-                src = fields.get('SRC') or ''
-                dst = fields.get('DST') or ''
-                spt = fields.get('SPT') or ''
-                dpt = fields.get('DPT') or ''
-                inif = fields.get('IN') or ''
-                outif = fields.get('OUT') or ''
-                print(f"[{direction}] {proto} {src}:{spt} -> {dst}:{dpt} IN={inif} OUT={outif}", flush=True)
-
-                # DB insert
-                try:
-                    insert_block_event(conn, cursor, direction, fields, raw)
-                    conn.commit()
-                    print(f"[DB] Inserted {direction} event", flush=True)
-                except mariadb.Error as e:
-                    emsg = str(e)
-                    if "gone away" in emsg or "Lost connection" in emsg:
-                        try:
-                            cursor.close()
-                        except Exception:
-                            pass
-                        try:
-                            conn.close()
-                        except Exception:
-                            pass
-                        conn, cursor = db_connect()
-                        sys.stderr.write("Reconnected to DB after 'gone away'.\n")
-                    else:
-                        sys.stderr.write(f"DB error: {e}\n")
-                except Exception as e:
-                    sys.stderr.write(f"Unexpected error: {e}\n")
-                
-                processed_count += 1
+                ingest.position = entry.get('__CURSOR')
+                event = parse_entry(entry)
+                if event is not None:
+                    ingest.add(event)
+            m_backlog.set(drained)
+            ingest.flush()
+            if args.journal_export and not r.remaining():
+                log.info("Journal export replayed, %d block events stored", ingest.stored)
+                break
 
     except KeyboardInterrupt:
-        print("Stopping…")
+        log.info("Stopping…")
     finally:
-        try:
-            cursor.close()
-            conn.close()
-        except Exception:
-            pass
+        if listener:
+            listener.stop()
+        ingest.close()
+        pool.close()
+        if metrics_server:
+            metrics_server.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
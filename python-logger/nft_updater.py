@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Batched nftables set updater for the ZopLog packet logger.
+
+Blocked destination IPs are queued with add() and applied by a background
+thread as one `nft -f -` transaction per flush interval, instead of forking
+zoplog-firewall-ipset-add (and four nft invocations) per IP. Pending
+additions are deduplicated, and elements that were already added are
+remembered until their nft timeout (firewall_rule_timeout) expires, so a page
+that resolves the same ad host dozens of times costs nothing after the first.
+
+The nft binary is configurable, which lets the updater run against a fake
+nft that just records its input. If nft cannot be run directly (no
+CAP_NET_ADMIN, binary missing), a fallback callable - the legacy per-IP
+script via sudo - is used for each element instead.
+"""
+
+import ipaddress
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import zoplog_log as log
+
+TABLE = "zoplog"
+DEFAULT_ELEMENT_TIMEOUT = 10800
+
+# nft errors that mean we are not allowed to change the ruleset at all
+_PERMISSION_ERRORS = ("Operation not permitted", "Permission denied")
+
+
+def find_nft_binary() -> Optional[str]:
+    if os.access("/usr/sbin/nft", os.X_OK):
+        return "/usr/sbin/nft"
+    return shutil.which("nft")
+
+
+def set_name(blocklist_id: int, family: int) -> str:
+    return f"zoplog-blocklist-{int(blocklist_id)}-v{family}"
+
+
+class NftSetUpdater:
+    """Coalesces blocklist set additions into periodic nft transactions."""
+
+    def __init__(self, nft_binary: Optional[str] = None, element_timeout: int = DEFAULT_ELEMENT_TIMEOUT,
+                 flush_interval: float = 0.2, max_pending: int = 50000, max_remembered: int = 200000,
+                 fallback: Optional[Callable] = None, table: str = TABLE,
+                 observe_apply: Optional[Callable[[float], None]] = None):
+        self.nft_binary = nft_binary or find_nft_binary()
+        self.element_timeout = max(1, int(element_timeout))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.max_pending = max(1, int(max_pending))
+        self.max_remembered = max(0, int(max_remembered))
+        self.fallback = fallback
+        self.table = table
+        # Optional instrumentation: called with the seconds each batch took to apply
+        self.observe_apply = observe_apply
+        # (blocklist_id, family) -> ips waiting for the next transaction
+        self._pending: Dict[Tuple[int, int], Set[str]] = {}
+        self._pending_count = 0
+        # (blocklist_id, ip) -> monotonic expiry; insertion order == expiry order
+        self._recent: "OrderedDict[Tuple[int, str], float]" = OrderedDict()
+        self._declared: Set[str] = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._use_fallback = self.nft_binary is None
+        # Counters
+        self.queued = 0
+        self.deduplicated = 0
+        self.dropped = 0
+        self.applied = 0
+        self.failed = 0
+        self.transactions = 0
+        self.fallback_calls = 0
+        self.last_apply_seconds = 0.0
+
+    # --- Producer side ---
+
+    def add(self, blocklist_id: int, ip: str) -> bool:
+        """Queue ip for the blocklist's nft set. Returns False if it is already there or queued."""
+        try:
+            family = ipaddress.ip_address(ip).version
+        except ValueError:
+            return False
+        key = (int(blocklist_id), ip)
+        now = time.monotonic()
+        with self._lock:
+            expiry = self._recent.get(key)
+            if expiry is not None and expiry > now:
+                self.deduplicated += 1
+                return False
+            pending = self._pending.setdefault((key[0], family), set())
+            if ip in pending:
+                self.deduplicated += 1
+                return False
+            if self._pending_count >= self.max_pending:
+                self.dropped += 1
+                return False
+            pending.add(ip)
+            self._pending_count += 1
+            self.queued += 1
+        self._wakeup.set()
+        return True
+
+    def forget(self, blocklist_id: Optional[int] = None):
+        """Drop remembered elements (all, or one blocklist's) so they are re-added on next match.
+
+        Call this when sets may have been flushed or deleted outside the logger.
+        """
+        with self._lock:
+            if blocklist_id is None:
+                self._recent.clear()
+                self._declared.clear()
+                return
+            bl_id = int(blocklist_id)
+            for key in [k for k in self._recent if k[0] == bl_id]:
+                del self._recent[key]
+            self._declared.discard(set_name(bl_id, 4))
+            self._declared.discard(set_name(bl_id, 6))
+
+    def stats(self) -> dict:
+        return {
+            "pending": self._pending_count,
+            "remembered": len(self._recent),
+            "queued": self.queued,
+            "deduplicated": self.deduplicated,
+            "dropped": self.dropped,
+            "applied": self.applied,
+            "failed": self.failed,
+            "transactions": self.transactions,
+            "fallback_calls": self.fallback_calls,
+            "last_apply_seconds": self.last_apply_seconds,
+        }
+
+    # --- Applying ---
+
+    def _set_declaration(self, name: str, family: int) -> str:
+        addr_type = "ipv4_addr" if family == 4 else "ipv6_addr"
+        return (f"add set inet {self.table} {name} "
+                f"{{ type {addr_type}; flags interval; timeout {self.element_timeout}s; }}\n")
+
+    def build_script(self, batch: Dict[Tuple[int, int], Set[str]], declare: bool = True) -> str:
+        """Render one nft transaction adding every element of batch."""
+        lines = []
+        if declare:
+            lines.append(f"add table inet {self.table}\n")
+        for (bl_id, family), ips in sorted(batch.items()):
+            name = set_name(bl_id, family)
+            if declare and name not in self._declared:
+                lines.append(self._set_declaration(name, family))
+            lines.append(f"add element inet {self.table} {name} {{ {', '.join(sorted(ips))} }}\n")
+        return "".join(lines)
+
+    def _run_nft(self, script: str) -> Tuple[bool, str]:
+        """Run one nft transaction; OSError (nft not executable) propagates."""
+        try:
+            result = subprocess.run([self.nft_binary, "-f", "-"], input=script,
+                                    capture_output=True, text=True, timeout=10)
+        except subprocess.TimeoutExpired as e:
+            return False, str(e)
+        self.transactions += 1
+        return result.returncode == 0, (result.stderr or "").strip()
+
+    def _apply_transaction(self, batch: Dict[Tuple[int, int], Set[str]]) -> bool:
+        try:
+            ok, err = self._run_nft(self.build_script(batch))
+        except OSError as e:
+            log.warning("nft updater: cannot run %s (%s); using the per-IP script fallback", self.nft_binary, e)
+            self._use_fallback = True
+            return False
+        if not ok and any(e in err for e in _PERMISSION_ERRORS):
+            log.warning("nft updater: cannot run nft directly (%s); using the per-IP script fallback", err)
+            self._use_fallback = True
+            return False
+        if not ok:
+            # The sets may already exist with other flags (e.g. an older timeout):
+            # retry with element additions only
+            ok, err = self._run_nft(self.build_script(batch, declare=False))
+        if not ok:
+            log.limited(log.ERROR, "nft-transaction", "nft updater: transaction failed for %d elements: %s",
+                        sum(len(v) for v in batch.values()), err)
+        return ok
+
+    def _apply(self, batch: Dict[Tuple[int, int], Set[str]]):
+        count = sum(len(ips) for ips in batch.values())
+        started = time.perf_counter()
+        ok = False
+        if not self._use_fallback:
+            ok = self._apply_transaction(batch)
+            if not ok and not self._use_fallback and len(batch) > 1:
+                # Isolate the failing set so the others are still applied
+                ok_sets = [key for key in batch if self._apply_transaction({key: batch[key]})]
+                self._remember({key: batch[key] for key in ok_sets})
+                applied = sum(len(batch[key]) for key in ok_sets)
+                self.applied += applied
+                self.failed += count - applied
+                self.last_apply_seconds = time.perf_counter() - started
+                return
+        if ok:
+            self._remember(batch)
+            self.applied += count
+        elif self._use_fallback and self.fallback:
+            applied = {}
+            for (bl_id, family), ips in batch.items():
+                for ip in ips:
+                    self.fallback_calls += 1
+                    if self.fallback(bl_id, ip):
+                        applied.setdefault((bl_id, family), set()).add(ip)
+            self._remember(applied)
+            done = sum(len(v) for v in applied.values())
+            self.applied += done
+            self.failed += count - done
+        else:
+            self.failed += count
+        self.last_apply_seconds = time.perf_counter() - started
+
+    def _remember(self, batch: Dict[Tuple[int, int], Set[str]]):
+        if not batch:
+            return
+        now = time.monotonic()
+        # Forget slightly before nft does, so an element is never assumed present after it expired
+        expiry = now + self.element_timeout * 0.98
+        with self._lock:
+            recent = self._recent
+            for (bl_id, family), ips in batch.items():
+                self._declared.add(set_name(bl_id, family))
+                for ip in ips:
+                    key = (bl_id, ip)
+                    recent.pop(key, None)
+                    recent[key] = expiry
+            # Oldest entries sit at the front: prune expired ones and enforce the bound
+            while recent:
+                key, exp = next(iter(recent.items()))
+                if exp > now and len(recent) <= self.max_remembered:
+                    break
+                recent.popitem(last=False)
+
+    def flush(self):
+        """Apply everything pending now (called by the worker thread, or directly)."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._pending_count = 0
+        if batch:
+            self._apply(batch)
+            if self.observe_apply:
+                self.observe_apply(self.last_apply_seconds)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait()
+            if self._stopping:
+                break
+            # Let additions from the same page load accumulate into one transaction
+            time.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.limited(log.ERROR, "nft-flush", "nft updater: flush error: %s", e)
+        self.flush()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        if self.nft_binary is None:
+            log.warning("nft updater: nft binary not found; using the per-IP script fallback")
+        self._thread = threading.Thread(target=self._run, name="nft-updater", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 15.0):
+        """Apply pending additions and stop the worker thread."""
+        if not self._thread:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join(timeout=timeout)
+        self._thread = None
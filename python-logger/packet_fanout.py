@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+PACKET_FANOUT support for sharding capture across processes.
+
+Every capture process opens its own AF_PACKET socket on the interface and
+joins the same fanout group; the kernel then hands each packet to exactly one
+member. Distribution uses a small classic BPF program (PACKET_FANOUT_CBPF)
+so related packets always reach the same process:
+
+  - TCP: hash of source XOR destination address, identical for both
+    directions of a connection;
+  - UDP: hash of the client address, where the client is the destination of
+    packets from port 53/443 and the source otherwise, so a DNS answer and
+    the QUIC flow that relies on it are handled by the same process.
+
+The program reads headers relative to the network header (SKF_NET_OFF) and
+the protocol from packet metadata, so it does not depend on the link layer.
+The kernel takes the returned value modulo the number of group members.
+Kernels without PACKET_FANOUT_CBPF fall back to the kernel's flow hash
+(PACKET_FANOUT_HASH), which keeps TCP connections together but may split
+DNS answers from the QUIC flows inferred from them.
+"""
+
+import ctypes
+import socket
+import struct
+from typing import List, Tuple
+
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+PACKET_FANOUT_DATA = 22
+
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_CBPF = 6
+PACKET_FANOUT_FLAG_DEFRAG = 0x8000
+
+# Classic BPF opcodes (linux/filter.h)
+BPF_LD, BPF_LDX, BPF_ALU, BPF_JMP, BPF_RET, BPF_MISC = 0x00, 0x01, 0x04, 0x05, 0x06, 0x07
+BPF_W, BPF_H, BPF_B = 0x00, 0x08, 0x10
+BPF_ABS, BPF_IND, BPF_MSH = 0x20, 0x40, 0xA0
+BPF_JEQ, BPF_JA = 0x10, 0x00
+BPF_MUL, BPF_RSH, BPF_XOR = 0x20, 0x70, 0xA0
+BPF_K, BPF_X, BPF_A = 0x00, 0x08, 0x10
+BPF_TAX = 0x00
+
+SKF_AD_OFF = -0x1000
+SKF_AD_PROTOCOL = 0
+SKF_NET_OFF = -0x100000
+
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+IPPROTO_UDP = 17
+UDP_SERVER_PORTS = (53, 443)
+# Knuth's multiplicative hash spreads neighbouring addresses across members
+_HASH_MULTIPLIER = 2654435761
+
+_SOCK_FILTER = struct.Struct("HBBI")
+
+
+def _net(offset: int) -> int:
+    return SKF_NET_OFF + offset
+
+
+def client_hash_program() -> List[Tuple[int, int, int, int]]:
+    """The fanout program as (code, jt, jf, k) instructions."""
+    prog: List[list] = []
+    labels = {}
+
+    def op(code, k=0, jt=None, jf=None):
+        prog.append([code, jt, jf, k])
+
+    def label(name):
+        labels[name] = len(prog)
+
+    def jeq(k, jt, jf):
+        op(BPF_JMP | BPF_JEQ | BPF_K, k, jt, jf)
+
+    op(BPF_LD | BPF_W | BPF_ABS, SKF_AD_OFF + SKF_AD_PROTOCOL)
+    jeq(ETH_P_IP, "v4", "not_v4")
+    label("not_v4")
+    jeq(ETH_P_IPV6, "v6", "other")
+
+    # IPv4: protocol at 9, addresses at 12/16, ports after the IHL
+    label("v4")
+    op(BPF_LD | BPF_B | BPF_ABS, _net(9))
+    jeq(IPPROTO_UDP, "v4_udp", "v4_pair")
+    label("v4_pair")
+    op(BPF_LD | BPF_W | BPF_ABS, _net(12))
+    op(BPF_MISC | BPF_TAX)
+    op(BPF_LD | BPF_W | BPF_ABS, _net(16))
+    op(BPF_ALU | BPF_XOR | BPF_X)
+    op(BPF_JMP | BPF_JA, "mix")
+    label("v4_udp")
+    op(BPF_LDX | BPF_B | BPF_MSH, _net(0))
+    op(BPF_LD | BPF_H | BPF_IND, _net(0))
+    jeq(UDP_SERVER_PORTS[0], "v4_dst", "v4_udp_443")
+    label("v4_udp_443")
+    jeq(UDP_SERVER_PORTS[1], "v4_dst", "v4_src")
+    label("v4_src")
+    op(BPF_LD | BPF_W | BPF_ABS, _net(12))
+    op(BPF_JMP | BPF_JA, "mix")
+    label("v4_dst")
+    op(BPF_LD | BPF_W | BPF_ABS, _net(16))
+    op(BPF_JMP | BPF_JA, "mix")
+
+    # IPv6: next header at 6, low words of the addresses at 20/36, ports at 40
+    label("v6")
+    op(BPF_LD | BPF_B | BPF_ABS, _net(6))
+    jeq(IPPROTO_UDP, "v6_udp", "v6_pair")
+    label("v6_pair")
+    op(BPF_LD | BPF_W | BPF_ABS, _net(20))
+    op(BPF_MISC | BPF_TAX)
+    op(BPF_LD | BPF_W | BPF_ABS, _net(36))
+    op(BPF_ALU | BPF_XOR | BPF_X)
+    op(BPF_JMP | BPF_JA, "mix")
+    label("v6_udp")
+    op(BPF_LD | BPF_H | BPF_ABS, _net(40))
+    jeq(UDP_SERVER_PORTS[0], "v6_dst", "v6_udp_443")
+    label("v6_udp_443")
+    jeq(UDP_SERVER_PORTS[1], "v6_dst", "v6_src")
+    label("v6_src")
+    op(BPF_LD | BPF_W | BPF_ABS, _net(20))
+    op(BPF_JMP | BPF_JA, "mix")
+    label("v6_dst")
+    op(BPF_LD | BPF_W | BPF_ABS, _net(36))
+
+    label("mix")
+    op(BPF_ALU | BPF_MUL | BPF_K, _HASH_MULTIPLIER)
+    op(BPF_ALU | BPF_RSH | BPF_K, 16)
+    op(BPF_RET | BPF_A)
+    label("other")
+    op(BPF_RET | BPF_K, 0)
+
+    # Resolve labels into relative jump offsets
+    out = []
+    for pc, (code, jt, jf, k) in enumerate(prog):
+        if code == BPF_JMP | BPF_JA:
+            k = labels[k] - pc - 1
+        jt = labels[jt] - pc - 1 if jt is not None else 0
+        jf = labels[jf] - pc - 1 if jf is not None else 0
+        out.append((code, jt, jf, k & 0xFFFFFFFF))
+    return out
+
+
+def _set_cbpf(sock: socket.socket, program: List[Tuple[int, int, int, int]]):
+    """setsockopt(PACKET_FANOUT_DATA, struct sock_fprog)."""
+    raw = b"".join(_SOCK_FILTER.pack(*insn) for insn in program)
+    buf = ctypes.create_string_buffer(raw, len(raw))
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    fprog = struct.pack("HL", len(program), ctypes.addressof(buf))
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT_DATA, fprog)
+
+
+def _fanout_arg(group_id: int, mode: int) -> bytes:
+    # The flag bit makes the value exceed a C int, so pass it packed
+    return struct.pack("I", group_id | ((mode | PACKET_FANOUT_FLAG_DEFRAG) << 16))
+
+
+def join_fanout(sock: socket.socket, group_id: int) -> str:
+    """Join a bound AF_PACKET socket to a fanout group; returns the mode used.
+
+    All members of a group must join the same way; the mode only depends on
+    the kernel, so processes on one host always agree.
+    """
+    group_id &= 0xFFFF
+    try:
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT, _fanout_arg(group_id, PACKET_FANOUT_CBPF))
+    except OSError:
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT, _fanout_arg(group_id, PACKET_FANOUT_HASH))
+        return "hash"
+    # A member cannot leave the group again, so a rejected program is an error
+    _set_cbpf(sock, client_hash_program())
+    return "cbpf"
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+QUIC Initial packet decryption for SNI extraction (RFC 9001, RFC 9369).
+
+Initial packets are encrypted with keys derived from the client's
+Destination Connection ID and a version-specific salt, so any on-path
+observer can remove their protection. This module derives the client Initial
+keys for QUIC v1 and v2, removes header protection, decrypts the payload and
+collects the CRYPTO frames that carry the TLS ClientHello. The ClientHello is
+returned wrapped in a TLS record header, ready for parse_sni_from_bytes().
+
+ClientHellos larger than one Initial packet (e.g. with post-quantum key
+shares) are reassembled across packets of the same connection in a small
+bounded cache.
+
+AES-GCM and AES-ECB come from the optional `cryptography` package; without
+it QUIC_DECRYPT_AVAILABLE is False and extract_client_hello() returns None.
+"""
+
+import hashlib
+import hmac
+import struct
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    QUIC_DECRYPT_AVAILABLE = True
+except ImportError:
+    QUIC_DECRYPT_AVAILABLE = False
+
+from dns_cache import ExpiringCache
+
+QUIC_V1 = 0x00000001
+QUIC_V2 = 0x6B3343CF
+
+# version -> (initial salt, key label, iv label, hp label, Initial type, Retry type)
+_VERSIONS = {
+    QUIC_V1: (bytes.fromhex("38762cf7f55934b34d179ae6a4c80cadccbb7f0a"),
+              b"quic key", b"quic iv", b"quic hp", 0, 3),
+    QUIC_V2: (bytes.fromhex("0dede3def700a6db819381be6e269dcbf9bd2ed9"),
+              b"quicv2 key", b"quicv2 iv", b"quicv2 hp", 1, 0),
+}
+# Clients must pad datagrams carrying Initial packets to at least this size
+MIN_INITIAL_DATAGRAM = 1200
+
+FRAME_PADDING = 0x00
+FRAME_PING = 0x01
+FRAME_ACK = 0x02
+FRAME_ACK_ECN = 0x03
+FRAME_CRYPTO = 0x06
+FRAME_CONNECTION_CLOSE = 0x1C
+
+TLS_CLIENT_HELLO = 0x01
+# Largest ClientHello we are willing to reassemble
+MAX_CRYPTO_BYTES = 16384
+
+_U32 = struct.Struct("!I")
+
+
+# --- Key derivation ---
+
+def _hkdf_expand_label(secret: bytes, label: bytes, length: int) -> bytes:
+    full_label = b"tls13 " + label
+    info = struct.pack("!HB", length, len(full_label)) + full_label + b"\x00"
+    # HKDF-Expand with SHA-256; every length used here fits in one block
+    return hmac.new(secret, info + b"\x01", hashlib.sha256).digest()[:length]
+
+
+def client_initial_keys(version: int, dcid: bytes) -> Tuple[bytes, bytes, bytes]:
+    """Return (key, iv, hp) protecting client Initial packets for this DCID."""
+    salt, key_label, iv_label, hp_label, _, _ = _VERSIONS[version]
+    initial_secret = hmac.new(salt, dcid, hashlib.sha256).digest()
+    client_secret = _hkdf_expand_label(initial_secret, b"client in", 32)
+    return (_hkdf_expand_label(client_secret, key_label, 16),
+            _hkdf_expand_label(client_secret, iv_label, 12),
+            _hkdf_expand_label(client_secret, hp_label, 16))
+
+
+# --- Packet parsing ---
+
+def _varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    first = buf[pos]
+    length = 1 << (first >> 6)
+    if pos + length > len(buf):
+        raise IndexError("truncated varint")
+    value = first & 0x3F
+    for i in range(1, length):
+        value = (value << 8) | buf[pos + i]
+    return value, pos + length
+
+
+def _decrypt_initial(datagram: bytes, pos: int):
+    """Decrypt the Initial packet at pos.
+
+    Returns (dcid, plaintext, next_pos); plaintext is None for packets that are
+    not client Initials or fail authentication. Raises on malformed headers.
+    """
+    first = datagram[pos]
+    version = _U32.unpack_from(datagram, pos + 1)[0]
+    if not first & 0x80 or version not in _VERSIONS:
+        return None, None, len(datagram)
+    off = pos + 5
+    dcid_len = datagram[off]
+    dcid = bytes(datagram[off + 1:off + 1 + dcid_len])
+    off += 1 + dcid_len
+    off += 1 + datagram[off]  # SCID
+    packet_type = (first >> 4) & 0x03
+    initial_type, retry_type = _VERSIONS[version][4:]
+    if packet_type != initial_type:
+        # A Retry has no length field and ends the datagram; skip 0-RTT/Handshake
+        if packet_type == retry_type:
+            return dcid, None, len(datagram)
+        length, off = _varint(datagram, off)
+        return dcid, None, off + length
+    token_len, off = _varint(datagram, off)
+    off += token_len
+    length, pn_offset = _varint(datagram, off)
+    end = pn_offset + length
+    if end > len(datagram) or length < 20:
+        return dcid, None, len(datagram)
+
+    key, iv, hp = client_initial_keys(version, dcid)
+    sample = bytes(datagram[pn_offset + 4:pn_offset + 20])
+    mask = Cipher(algorithms.AES(hp), modes.ECB()).encryptor().update(sample)
+    first_plain = first ^ (mask[0] & 0x0F)
+    pn_len = (first_plain & 0x03) + 1
+    pn_bytes = bytes(b ^ m for b, m in zip(datagram[pn_offset:pn_offset + pn_len], mask[1:1 + pn_len]))
+    header = bytes([first_plain]) + bytes(datagram[pos + 1:pn_offset]) + pn_bytes
+    packet_number = int.from_bytes(pn_bytes, "big")
+    nonce = (int.from_bytes(iv, "big") ^ packet_number).to_bytes(12, "big")
+    try:
+        plaintext = AESGCM(key).decrypt(nonce, bytes(datagram[pn_offset + pn_len:end]), header)
+    except Exception:
+        return dcid, None, end
+    return dcid, plaintext, end
+
+
+def _crypto_frames(plaintext: bytes) -> List[Tuple[int, bytes]]:
+    """Collect (offset, data) of the CRYPTO frames in an Initial payload."""
+    frames = []
+    pos = 0
+    n = len(plaintext)
+    while pos < n:
+        frame_type = plaintext[pos]
+        if frame_type == FRAME_PADDING:
+            pos += 1
+        elif frame_type == FRAME_PING:
+            pos += 1
+        elif frame_type == FRAME_CRYPTO:
+            offset, pos = _varint(plaintext, pos + 1)
+            length, pos = _varint(plaintext, pos)
+            frames.append((offset, plaintext[pos:pos + length]))
+            pos += length
+        elif frame_type in (FRAME_ACK, FRAME_ACK_ECN):
+            _, pos = _varint(plaintext, pos + 1)      # largest acknowledged
+            _, pos = _varint(plaintext, pos)          # ack delay
+            ranges, pos = _varint(plaintext, pos)
+            _, pos = _varint(plaintext, pos)          # first range
+            for _ in range(ranges * 2):
+                _, pos = _varint(plaintext, pos)
+            if frame_type == FRAME_ACK_ECN:
+                for _ in range(3):
+                    _, pos = _varint(plaintext, pos)
+        elif frame_type == FRAME_CONNECTION_CLOSE:
+            _, pos = _varint(plaintext, pos + 1)
+            _, pos = _varint(plaintext, pos)
+            reason_len, pos = _varint(plaintext, pos)
+            pos += reason_len
+        else:
+            # Not allowed in Initial packets
+            break
+    return frames
+
+
+# --- ClientHello reassembly ---
+
+def _assemble(fragments: Dict[int, bytes]) -> Tuple[Optional[bytes], bool]:
+    """Join fragments from offset 0; returns (contiguous bytes, ClientHello complete)."""
+    data = bytearray()
+    for offset in sorted(fragments):
+        if offset > len(data):
+            break
+        chunk = fragments[offset]
+        if offset + len(chunk) > len(data):
+            data += chunk[len(data) - offset:]
+    if len(data) < 4:
+        return None, False
+    if data[0] != TLS_CLIENT_HELLO:
+        return None, True
+    needed = 4 + int.from_bytes(data[1:4], "big")
+    return bytes(data[:needed]), len(data) >= needed
+
+
+class QuicInitialParser:
+    """Extracts ClientHellos from client Initial datagrams."""
+
+    def __init__(self, pending_size: int = 4096, pending_ttl: float = 3.0):
+        # (src_ip, sport, dcid) -> {offset: data} for ClientHellos spanning packets
+        self._pending = ExpiringCache("quic_crypto", pending_size, min_ttl=pending_ttl, max_ttl=pending_ttl)
+        self.decrypted = 0
+        self.failed = 0
+        self.reassembled = 0
+
+    def extract_client_hello(self, datagram: bytes, flow: Tuple = ()) -> Optional[bytes]:
+        """Return the ClientHello of a client Initial datagram as a TLS record, or None.
+
+        flow (e.g. the source address and port) keeps reassembly of different
+        clients apart; partial ClientHellos are kept until the rest arrives.
+        """
+        if not QUIC_DECRYPT_AVAILABLE or len(datagram) < MIN_INITIAL_DATAGRAM or not datagram[0] & 0x80:
+            return None
+        fragments: Dict[int, bytes] = {}
+        dcid = None
+        pos = 0
+        try:
+            # A datagram may coalesce several long-header packets
+            while pos < len(datagram) and datagram[pos] & 0x80:
+                packet_dcid, plaintext, pos = _decrypt_initial(datagram, pos)
+                if plaintext is None:
+                    continue
+                self.decrypted += 1
+                dcid = packet_dcid
+                for offset, data in _crypto_frames(plaintext):
+                    if offset + len(data) <= MAX_CRYPTO_BYTES:
+                        fragments[offset] = data
+        except (IndexError, struct.error, ValueError):
+            self.failed += 1
+        if not fragments:
+            return None
+
+        key = (flow, dcid)
+        earlier = self._pending.get(key)
+        if earlier:
+            earlier.update(fragments)
+            fragments = earlier
+        hello, complete = _assemble(fragments)
+        if not complete:
+            self._pending.put(key, fragments)
+            return None
+        if earlier:
+            self._pending.discard(key)
+            self.reassembled += 1
+        if hello is None:
+            return None
+        return b"\x16\x03\x01" + len(hello).to_bytes(2, "big") + hello
+
+    def stats(self) -> dict:
+        return {
+            "decrypted": self.decrypted,
+            "failed": self.failed,
+            "reassembled": self.reassembled,
+            "pending": len(self._pending),
+        }
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Connection-summary mode for the packet logger.
+
+Browsers open many parallel connections to the same host, and each one is
+logged as its own packet_logs row and domain_ip_addresses upsert. With a
+coalescing window configured, identical requests - same client, server,
+port, host, path, method and type - seen within the window are merged into
+one row that carries a hit count and the first and last timestamps.
+
+A request opens an entry; repeats within `window` seconds of the first one
+only bump its count. A background thread hands expired entries to the emit
+callback (normally the batched writer), so a row reaches the database at
+most `window` seconds late. When more than max_pending entries are open the
+oldest is emitted early.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional
+
+import zoplog_log as log
+
+
+class RequestCoalescer:
+    """Merges identical rows seen within a window into (row, hits, last timestamp)."""
+
+    def __init__(self, emit: Callable[[tuple, int, str], None], window: float = 10.0,
+                 max_pending: int = 50000, name: str = "request-coalescer"):
+        self.emit = emit
+        self.window = max(0.1, float(window))
+        self.max_pending = max(1, int(max_pending))
+        self.name = name
+        # key -> [deadline, row, hits, last timestamp]; insertion order == deadline order
+        self._pending: "OrderedDict[Hashable, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # Counters
+        self.received = 0
+        self.merged = 0
+        self.emitted = 0
+        self.early = 0
+
+    def add(self, key: Hashable, row: tuple, timestamp: str) -> bool:
+        """Record one request. Returns True if it was merged into an open entry."""
+        now = time.monotonic()
+        evicted = None
+        with self._lock:
+            self.received += 1
+            entry = self._pending.get(key)
+            if entry is not None:
+                entry[2] += 1
+                if timestamp > entry[3]:
+                    entry[3] = timestamp
+                self.merged += 1
+                return True
+            self._pending[key] = [now + self.window, row, 1, timestamp]
+            if len(self._pending) > self.max_pending:
+                _, evicted = self._pending.popitem(last=False)
+                self.early += 1
+        if evicted is not None:
+            self._emit([evicted])
+        return False
+
+    def _take_expired(self, now: float) -> List[list]:
+        expired = []
+        with self._lock:
+            pending = self._pending
+            while pending:
+                key, entry = next(iter(pending.items()))
+                if entry[0] > now:
+                    break
+                del pending[key]
+                expired.append(entry)
+        return expired
+
+    def _emit(self, entries: List[list]):
+        for _, row, hits, last in entries:
+            try:
+                self.emit(row, hits, last)
+            except Exception as e:
+                log.limited(log.ERROR, (self.name, "emit"), "%s: emit failed: %s", self.name, e)
+                continue
+            self.emitted += 1
+
+    def flush(self):
+        """Emit every open entry now."""
+        with self._lock:
+            entries = list(self._pending.values())
+            self._pending.clear()
+        self._emit(entries)
+
+    def _run(self):
+        tick = min(1.0, self.window / 4)
+        while not self._stop.wait(tick):
+            self._emit(self._take_expired(time.monotonic()))
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Stop the expiry thread and emit what is still open."""
+        if self._thread:
+            self._stop.set()
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "received": self.received,
+            "merged": self.merged,
+            "emitted": self.emitted,
+            "early": self.early,
+        }
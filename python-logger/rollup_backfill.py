@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+ZopLog rollup backfill
+
+Rebuilds the per-minute rollup tables (packet_log_minutes, blocked_event_minutes)
+from packet_logs and blocked_events. Run it once after the rollup migration to
+cover history recorded before the logger maintained the rollups; it is safe to
+run again, because each day is recomputed (delete + INSERT ... SELECT) in its
+own transaction.
+
+Minutes from the start of the current minute onwards are left to the running
+logger and block-log reader.
+"""
+
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+from typing import Optional
+
+# Add the parent directory to the path so we can import zoplog_config
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zoplog_config import load_database_config
+from traffic_rollup import TARGET_WINDOW_SECONDS
+
+# Get database configuration
+DB_CONFIG = load_database_config()
+
+from db_pool import connect as connect_with_retry
+
+MINUTE_EXPR = "DATE_FORMAT({col}, '%%Y-%%m-%%d %%H:%%i:00')"
+
+ROLLUPS = {
+    "packet_log_minutes": {
+        "source": "packet_logs",
+        "time_column": "packet_timestamp",
+        "insert": f"""
+            INSERT INTO packet_log_minutes (minute, type, method, requests)
+            SELECT {MINUTE_EXPR.format(col='packet_timestamp')} AS m, type, COALESCE(method, 'N/A'), SUM(hit_count)
+            FROM packet_logs
+            WHERE packet_timestamp >= %s AND packet_timestamp < %s
+            GROUP BY m, type, COALESCE(method, 'N/A')
+        """,
+    },
+    "blocked_event_minutes": {
+        "source": "blocked_events",
+        "time_column": "event_time",
+        "insert": f"""
+            INSERT INTO blocked_event_minutes (minute, direction, events, targets)
+            SELECT {MINUTE_EXPR.format(col='event_time')} AS m, direction, COUNT(*),
+                   COUNT(DISTINCT CONCAT(wan_ip_id, '-', FLOOR(UNIX_TIMESTAMP(event_time) / {TARGET_WINDOW_SECONDS})))
+            FROM blocked_events
+            WHERE event_time >= %s AND event_time < %s
+            GROUP BY m, direction
+        """,
+    },
+}
+
+
+def db_connect():
+    """Connect to the database, retrying while the server is unreachable."""
+    return connect_with_retry(DB_CONFIG)
+
+
+def first_day(cursor, source: str, time_column: str) -> Optional[datetime]:
+    cursor.execute(f"SELECT MIN({time_column}) FROM {source}")
+    row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    first = row[0]
+    if not isinstance(first, datetime):
+        first = datetime.strptime(str(first), '%Y-%m-%d %H:%M:%S')
+    return first.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def backfill_table(conn, table: str, since: Optional[datetime], until: datetime, dry_run: bool = False) -> int:
+    """Recompute one rollup table day by day for [since, until); returns the days processed."""
+    spec = ROLLUPS[table]
+    cursor = conn.cursor()
+    try:
+        start = first_day(cursor, spec["source"], spec["time_column"])
+        if start is None:
+            print(f"{table}: {spec['source']} is empty, nothing to backfill")
+            return 0
+        if since is not None and since > start:
+            start = since
+        days = 0
+        while start < until:
+            end = min(start + timedelta(days=1), until)
+            bounds = (start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S'))
+            if dry_run:
+                print(f"{table}: would rebuild {bounds[0]} .. {bounds[1]}")
+            else:
+                cursor.execute(f"DELETE FROM {table} WHERE minute >= %s AND minute < %s", bounds)
+                cursor.execute(spec["insert"], bounds)
+                conn.commit()
+                print(f"{table}: rebuilt {bounds[0]} .. {bounds[1]} ({cursor.rowcount} rows)")
+            days += 1
+            start = end
+        return days
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ZopLog rollup backfill - rebuild per-minute rollups from packet_logs and blocked_events')
+    parser.add_argument('--since', help='Only rebuild from this date (YYYY-MM-DD); default is the oldest logged row')
+    parser.add_argument('--table', choices=sorted(ROLLUPS), action='append', help='Rollup table to rebuild (default: all)')
+    parser.add_argument('--dry-run', action='store_true', help='Show what would be done without making changes')
+
+    args = parser.parse_args()
+
+    since = datetime.strptime(args.since, '%Y-%m-%d') if args.since else None
+    # Leave the minute in progress to the logger and the block-log reader
+    until = datetime.now().replace(second=0, microsecond=0)
+
+    print(f"ZopLog rollup backfill - {'DRY RUN' if args.dry_run else 'LIVE RUN'}")
+    try:
+        conn = db_connect()
+        try:
+            for table in args.table or sorted(ROLLUPS):
+                days = backfill_table(conn, table, since, until, args.dry_run)
+                print(f"✅ {table}: {days} days processed")
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"Error during rollup backfill: {e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Supervisor for sharded (multi-process) packet capture.
+
+The GIL keeps one logger process on one core. In sharded mode the logger
+starts N worker processes instead; each joins the same PACKET_FANOUT group
+on the interface (see packet_fanout.py) and runs the normal capture pipeline
+with its own database connection, caches, writer and nft updater. Nothing
+is shared: each worker loads and refreshes a full copy of the blocklist and
+whitelist, so memory and refresh queries grow with the number of workers
+(see capture_processes in zoplog.conf.example).
+
+The supervisor restarts workers that exit unexpectedly, backing off while
+they keep crashing shortly after start, and merges their metrics: each
+worker answers snapshot requests on a pipe and the supervisor renders all
+snapshots with a shard="<n>" label on the shared metrics endpoint.
+
+Workers are started with the "spawn" method, so they do not inherit the
+supervisor's threads or open sockets.
+"""
+
+import multiprocessing
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from metrics import Family, Registry, merge_families, render_families
+import zoplog_log as log
+
+# A worker that lives shorter than this counts as crashing on start
+STABLE_SECONDS = 10.0
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+
+def serve_control(conn, registry: Registry):
+    """Answer the supervisor's metrics requests from a daemon thread (worker side)."""
+    def loop():
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                return
+            if request == "metrics":
+                try:
+                    conn.send(registry.collect())
+                except (OSError, ValueError):
+                    return
+    thread = threading.Thread(target=loop, name="shard-control", daemon=True)
+    thread.start()
+    return thread
+
+
+class _Shard:
+    __slots__ = ("index", "process", "conn", "started", "restarts", "backoff", "restart_at")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.started = 0.0
+        self.restarts = 0
+        self.backoff = MIN_BACKOFF
+        self.restart_at: Optional[float] = None
+
+
+class ShardSupervisor:
+    """Runs target(index, count, control_conn, *args) in count child processes."""
+
+    def __init__(self, target: Callable, count: int, args: tuple = (), name: str = "capture-shard"):
+        self.target = target
+        self.count = max(1, int(count))
+        self.args = args
+        self.name = name
+        self._ctx = multiprocessing.get_context("spawn")
+        self._shards = [_Shard(i) for i in range(self.count)]
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.metrics = Registry()
+        self.metrics.add_collector("shard", self.stats, counters=("restarts",), label="shard")
+
+    def _spawn(self, shard: _Shard):
+        parent_conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(
+            target=self.target, args=(shard.index, self.count, child_conn) + tuple(self.args),
+            name=f"{self.name}-{shard.index}", daemon=False,
+        )
+        process.start()
+        child_conn.close()
+        shard.process, shard.conn, shard.started = process, parent_conn, time.monotonic()
+        shard.restart_at = None
+
+    def start(self):
+        for shard in self._shards:
+            self._spawn(shard)
+        log.info("Started %d capture processes", self.count)
+
+    def _check(self, shard: _Shard):
+        process = shard.process
+        if process is not None and process.exitcode is None:
+            return
+        now = time.monotonic()
+        if shard.restart_at is None:
+            code = process.exitcode if process is not None else None
+            lived = now - shard.started
+            # Quick crashes back off exponentially; a worker that ran for a while restarts promptly
+            shard.backoff = min(shard.backoff * 2, MAX_BACKOFF) if lived < STABLE_SECONDS else MIN_BACKOFF
+            shard.restart_at = now + shard.backoff
+            log.warning("%s-%d exited with code %s after %.0fs; restarting in %.0fs",
+                        self.name, shard.index, code, lived, shard.backoff)
+            with self._lock:
+                if shard.conn is not None:
+                    shard.conn.close()
+                    shard.conn = None
+            return
+        if now >= shard.restart_at:
+            shard.restarts += 1
+            with self._lock:
+                self._spawn(shard)
+
+    def run(self, stop_event: threading.Event, poll_interval: float = 1.0):
+        """Watch the workers until stop_event is set (or KeyboardInterrupt)."""
+        while not stop_event.is_set() and not self._stopping:
+            for shard in self._shards:
+                self._check(shard)
+            stop_event.wait(poll_interval)
+
+    def stop(self, timeout: float = 30.0):
+        """Ask every worker to shut down (SIGTERM) and wait for them to flush."""
+        self._stopping = True
+        processes = [s.process for s in self._shards if s.process is not None]
+        for process in processes:
+            if process.exitcode is None:
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in processes:
+            process.join(timeout=max(0.0, deadline - time.monotonic()))
+            if process.exitcode is None:
+                log.warning("%s did not stop in time; killing it", process.name)
+                process.kill()
+                process.join(timeout=5)
+
+    def stats(self) -> Dict[str, dict]:
+        return {
+            str(s.index): {
+                "up": s.process is not None and s.process.exitcode is None,
+                "restarts": s.restarts,
+                "pid": (s.process.pid or 0) if s.process is not None else 0,
+            }
+            for s in self._shards
+        }
+
+    def collect_metrics(self, timeout: float = 1.0) -> Dict[str, List[Family]]:
+        """Snapshot every live worker's registry; slow or dead workers are skipped."""
+        snapshots = {}
+        with self._lock:
+            for shard in self._shards:
+                conn = shard.conn
+                if conn is None or shard.process is None or shard.process.exitcode is not None:
+                    continue
+                try:
+                    # Drop a late answer to an earlier, timed-out request
+                    while conn.poll():
+                        conn.recv()
+                    conn.send("metrics")
+                    if conn.poll(timeout):
+                        snapshots[str(shard.index)] = conn.recv()
+                except (EOFError, OSError):
+                    continue
+        return snapshots
+
+    def render(self) -> str:
+        """Metrics endpoint body: merged worker metrics plus the supervisor's own."""
+        return render_families(merge_families(self.collect_metrics()) + self.metrics.collect())
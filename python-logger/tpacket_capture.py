@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Memory-mapped capture sources for the ZopLog packet logger.
+
+TPacketV3Source reads frames from an AF_PACKET TPACKET_V3 receive ring: the
+kernel fills fixed-size blocks in a shared mmap and userspace walks them
+without a recv() syscall or copy per packet. Frames are handed to the callback
+as memoryview slices of the ring, which stay valid only until the callback
+returns (the block is then released back to the kernel). Callers that keep a
+frame must copy it with bytes(view).
+
+PcapFileSource offers the same read() interface over an mmap'd classic pcap
+file, so capture code can be exercised offline by replaying a capture.
+"""
+
+import mmap
+import os
+import select
+import socket
+import struct
+import time
+from typing import Callable, Optional
+
+from dissector import LINK_ETHERNET, LINK_RAW_IP, interface_link_type
+from packet_fanout import join_fanout
+
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# struct tpacket_req3
+_REQ3 = struct.Struct("7I")
+# struct tpacket_block_desc: version, offset_to_priv, then tpacket_hdr_v1
+# (block_status, num_pkts, offset_to_first_pkt, ...)
+_BLOCK_STATUS_OFFSET = 8
+_BLOCK_HDR = struct.Struct("=III")
+# struct tpacket3_hdr: next_offset, sec, nsec, snaplen, len, status, mac, net
+_PKT_HDR = struct.Struct("=IIIIIIHH")
+_STATUS = struct.Struct("=I")
+
+# Defaults: 64 x 1 MiB blocks, 2 KiB frames (enough for a full Ethernet MTU)
+DEFAULT_BLOCK_SIZE = 1 << 20
+DEFAULT_BLOCK_COUNT = 64
+DEFAULT_FRAME_SIZE = 2048
+
+
+def _attach_filter(sock: socket.socket, bpf_filter: str, interface: str) -> bool:
+    """Compile a tcpdump-style filter with libpcap (via scapy) and attach it."""
+    try:
+        from scapy.arch.linux import attach_filter
+    except ImportError:
+        return False
+    attach_filter(sock, bpf_filter, interface)
+    return True
+
+
+class TPacketV3Source:
+    """AF_PACKET TPACKET_V3 mmap ring capture on one interface."""
+
+    def __init__(self, interface: str, block_size: int = DEFAULT_BLOCK_SIZE,
+                 block_count: int = DEFAULT_BLOCK_COUNT, frame_size: int = DEFAULT_FRAME_SIZE,
+                 snaplen: int = 0, bpf_filter: Optional[str] = None, block_timeout_ms: int = 60,
+                 fanout_group: Optional[int] = None):
+        if block_size % mmap.PAGESIZE or block_size % frame_size:
+            raise ValueError("block_size must be a multiple of the page size and of frame_size")
+        self.link_type = interface_link_type(interface)
+        if self.link_type is None:
+            raise ValueError(f"{interface}: link type is neither Ethernet nor raw IP")
+        self.interface = interface
+        self.block_size = block_size
+        self.block_count = block_count
+        self.snaplen = snaplen
+        self.kernel_packets = 0
+        self.kernel_drops = 0
+        self.filtered = False
+        self.fanout_mode = None
+        self._current = 0
+
+        self._sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            self._sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            if bpf_filter:
+                self.filtered = _attach_filter(self._sock, bpf_filter, interface)
+            frame_count = (block_size * block_count) // frame_size
+            self._sock.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                                  _REQ3.pack(block_size, block_count, frame_size, frame_count,
+                                             block_timeout_ms, 0, 0))
+            self._ring = mmap.mmap(self._sock.fileno(), block_size * block_count,
+                                   mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            self._sock.bind((interface, ETH_P_ALL))
+            if fanout_group is not None:
+                self.fanout_mode = join_fanout(self._sock, fanout_group)
+        except Exception:
+            self._sock.close()
+            raise
+        self._view = memoryview(self._ring)
+        self._poller = select.poll()
+        self._poller.register(self._sock.fileno(), select.POLLIN | select.POLLERR)
+
+    def fileno(self) -> int:
+        return self._sock.fileno()
+
+    def read(self, on_frame: Callable, timeout: float) -> int:
+        """Deliver every frame of the next ready block to on_frame(view, ts)."""
+        ring = self._ring
+        block = self._current * self.block_size
+        (status,) = _STATUS.unpack_from(ring, block + _BLOCK_STATUS_OFFSET)
+        if not status & TP_STATUS_USER:
+            if not self._poller.poll(int(timeout * 1000)):
+                return 0
+            (status,) = _STATUS.unpack_from(ring, block + _BLOCK_STATUS_OFFSET)
+            if not status & TP_STATUS_USER:
+                return 0
+
+        _, num_pkts, offset = _BLOCK_HDR.unpack_from(ring, block + _BLOCK_STATUS_OFFSET)
+        view = self._view
+        snaplen = self.snaplen
+        pos = block + offset
+        try:
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, caplen, _, _, mac, _ = _PKT_HDR.unpack_from(ring, pos)
+                if snaplen and caplen > snaplen:
+                    caplen = snaplen
+                start = pos + mac
+                on_frame(view[start:start + caplen], sec + nsec * 1e-9)
+                pos += next_offset
+        finally:
+            # Hand the block back to the kernel even if a handler raised
+            _STATUS.pack_into(ring, block + _BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+            self._current = (self._current + 1) % self.block_count
+        return num_pkts
+
+    def update_kernel_stats(self) -> None:
+        """Accumulate tpacket_stats_v3 (the kernel resets them on every read)."""
+        try:
+            raw = self._sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12)
+            packets, drops = struct.unpack("II", raw[:8])
+            self.kernel_packets += packets
+            self.kernel_drops += drops
+        except (OSError, struct.error):
+            pass
+
+    def close(self) -> None:
+        try:
+            self._view.release()
+            self._ring.close()
+        except (BufferError, ValueError):
+            # A caller still holds a frame view; the mapping goes away with the process
+            pass
+        self._sock.close()
+
+
+# Classic libpcap file format
+_PCAP_MAGIC_USEC = 0xA1B2C3D4
+_PCAP_MAGIC_NSEC = 0xA1B23C4D
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+
+
+class PcapFileSource:
+    """File-backed stand-in for a live capture source (classic pcap, Ethernet or raw IP).
+
+    With realtime=True frames are paced to the original capture timing,
+    otherwise they are delivered as fast as the consumer accepts them.
+    """
+
+    def __init__(self, path: str, snaplen: int = 0, realtime: bool = False, batch: int = 256):
+        self.path = path
+        self.snaplen = snaplen
+        self.realtime = realtime
+        self.batch = batch
+        self.eof = False
+        self.frames = 0
+        self.kernel_packets = 0
+        self.kernel_drops = 0
+        self._fd = os.open(path, os.O_RDONLY)
+        size = os.fstat(self._fd).st_size
+        if size < 24:
+            os.close(self._fd)
+            raise ValueError(f"{path}: not a pcap file")
+        self._map = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+        magic_le = struct.unpack_from("<I", self._map, 0)[0]
+        magic_be = struct.unpack_from(">I", self._map, 0)[0]
+        if magic_le in (_PCAP_MAGIC_USEC, _PCAP_MAGIC_NSEC):
+            endian, magic = "<", magic_le
+        elif magic_be in (_PCAP_MAGIC_USEC, _PCAP_MAGIC_NSEC):
+            endian, magic = ">", magic_be
+        else:
+            self.close()
+            raise ValueError(f"{path}: unsupported capture format (pcapng is not supported)")
+        self._divisor = 1e9 if magic == _PCAP_MAGIC_NSEC else 1e6
+        self._rec = struct.Struct(endian + "IIII")
+        linktype = struct.unpack_from(endian + "I", self._map, 20)[0]
+        if linktype == LINKTYPE_ETHERNET:
+            self.link_type = LINK_ETHERNET
+        elif linktype == LINKTYPE_RAW:
+            self.link_type = LINK_RAW_IP
+        else:
+            self.close()
+            raise ValueError(f"{path}: link type {linktype} is neither Ethernet nor raw IP")
+        self._pos = 24
+        self._size = size
+        self._replay_start = None
+        self._capture_start = None
+
+    def read(self, on_frame: Callable, timeout: float = 0.0) -> int:
+        rec, view, divisor = self._rec, self._view, self._divisor
+        count = 0
+        while count < self.batch and self._pos + 16 <= self._size:
+            sec, frac, caplen, _ = rec.unpack_from(self._map, self._pos)
+            start = self._pos + 16
+            self._pos = start + caplen
+            ts = sec + frac / divisor
+            if self.realtime:
+                self._pace(ts)
+            length = min(caplen, self.snaplen) if self.snaplen else caplen
+            on_frame(view[start:start + length], ts)
+            count += 1
+        self.frames += count
+        if self._pos + 16 > self._size:
+            self.eof = True
+        return count
+
+    def _pace(self, ts: float):
+        now = time.monotonic()
+        if self._replay_start is None:
+            self._replay_start, self._capture_start = now, ts
+            return
+        delay = (ts - self._capture_start) - (now - self._replay_start)
+        if delay > 0:
+            time.sleep(delay)
+
+    def update_kernel_stats(self) -> None:
+        pass
+
+    def close(self) -> None:
+        try:
+            self._view.release()
+            self._map.close()
+        except (BufferError, ValueError, AttributeError):
+            pass
+        try:
+            os.close(self._fd)
+        except OSError:
+            pass
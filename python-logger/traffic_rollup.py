@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Per-minute traffic rollups for the dashboards.
+
+The logger and the block-log reader count what they write per minute and
+upsert the counts into packet_log_minutes / blocked_event_minutes in the same
+transaction as the fact rows, so the rollups stay exact across retries and
+rollbacks. Dashboards read a few rows per minute instead of grouping
+packet_logs and blocked_events on every refresh.
+
+History written before the rollups existed is filled in by rollup_backfill.py.
+"""
+
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+PACKET_MINUTE_UPSERT = """
+    INSERT INTO packet_log_minutes (minute, type, method, requests)
+    VALUES (%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE requests = requests + VALUES(requests)
+"""
+
+BLOCKED_MINUTE_UPSERT = """
+    INSERT INTO blocked_event_minutes (minute, direction, events, targets)
+    VALUES (%s,%s,%s,%s)
+    ON DUPLICATE KEY UPDATE events = events + VALUES(events), targets = targets + VALUES(targets)
+"""
+
+# Blocked events for the same WAN address within one window count as one target
+# (matches the dashboards' former FLOOR(UNIX_TIMESTAMP(event_time) / 30) grouping)
+TARGET_WINDOW_SECONDS = 30
+
+
+def minute_of(timestamp) -> str:
+    """'YYYY-MM-DD HH:MM:00' for a datetime or a 'YYYY-MM-DD HH:MM:SS' string."""
+    if isinstance(timestamp, datetime):
+        return timestamp.strftime('%Y-%m-%d %H:%M:00')
+    return str(timestamp)[:16] + ':00'
+
+
+def packet_minute_counts(rows: Iterable[tuple], ts_index: int = 0, method_index: int = 7,
+                         type_index: int = 12, hits_index: int = 13) -> List[Tuple[str, str, str, int]]:
+    """Aggregate packet rows into sorted (minute, type, method, requests) upsert rows.
+
+    A summary row (connection-summary mode) counts its hits in its first minute.
+    """
+    counts: Dict[Tuple[str, str, str], int] = {}
+    for row in rows:
+        key = (minute_of(row[ts_index]), row[type_index], row[method_index] or 'N/A')
+        counts[key] = counts.get(key, 0) + row[hits_index]
+    # Sorted to keep lock order stable across concurrent writers
+    return [(m, t, meth, n) for (m, t, meth), n in sorted(counts.items())]
+
+
+def write_packet_minutes(cursor, rows: Iterable[tuple]):
+    """Add a batch of packet_logs rows to packet_log_minutes (caller owns the transaction)."""
+    counts = packet_minute_counts(rows)
+    if counts:
+        cursor.executemany(PACKET_MINUTE_UPSERT, counts)
+
+
+class BlockedMinuteRollup:
+    """Counts blocked events per (minute, direction) between commits.
+
+    add() records an event; write(cursor) upserts the pending counts inside
+    the caller's transaction, after which the caller reports the outcome with
+    committed() or discard(). Distinct (wan_ip_id, window) targets are tracked
+    for the current and previous window only, which is enough because events
+    arrive in journal (time) order.
+    """
+
+    def __init__(self, window: int = TARGET_WINDOW_SECONDS):
+        self.window = max(1, int(window))
+        self._pending: Dict[Tuple[str, str], List[int]] = {}
+        self._pending_targets: List[Tuple[int, int]] = []
+        # window number -> WAN address ids already counted in it
+        self._seen: Dict[int, Set[int]] = {}
+
+    def add(self, direction: str, wan_ip_id: Optional[int], when: Optional[float] = None):
+        when = datetime.now().timestamp() if when is None else when
+        window = int(when // self.window)
+        for old in [w for w in self._seen if w < window - 1]:
+            del self._seen[old]
+        counts = self._pending.setdefault((minute_of(datetime.fromtimestamp(when)), direction), [0, 0])
+        counts[0] += 1
+        if wan_ip_id is not None:
+            seen = self._seen.setdefault(window, set())
+            if wan_ip_id not in seen:
+                seen.add(wan_ip_id)
+                self._pending_targets.append((window, wan_ip_id))
+                counts[1] += 1
+
+    def write(self, cursor):
+        if self._pending:
+            cursor.executemany(BLOCKED_MINUTE_UPSERT,
+                               [(m, d, e, t) for (m, d), (e, t) in sorted(self._pending.items())])
+
+    def committed(self):
+        self._pending.clear()
+        self._pending_targets.clear()
+
+    def discard(self):
+        """Forget pending counts after a rollback so the events count again if retried."""
+        for window, wan_ip_id in self._pending_targets:
+            seen = self._seen.get(window)
+            if seen is not None:
+                seen.discard(wan_ip_id)
+        self.committed()
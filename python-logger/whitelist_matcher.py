@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+In-memory whitelist matcher for the ZopLog packet logger.
+
+Every logged request is checked against the active whitelists before any
+blocking decision. Instead of querying whitelist_domains JOIN whitelists per
+packet, the active whitelist domains are held in a set and answered with a
+hash probe. A background thread polls a cheap change signature and reloads the
+set when the whitelists or whitelist_domains tables change.
+
+If the database is unavailable the last loaded set stays in use, so whitelist
+decisions keep working through short outages.
+"""
+
+import threading
+from typing import FrozenSet, Optional
+
+import pymysql as mariadb
+
+import zoplog_log as log
+
+# COUNT/MAX over whitelist_domains catches added and removed domains (including
+# cascaded deletes); whitelists.updated_at catches toggles and renames.
+SIGNATURE_QUERY = (
+    "SELECT "
+    "(SELECT COUNT(*) FROM whitelist_domains), "
+    "(SELECT COALESCE(MAX(id), 0) FROM whitelist_domains), "
+    "(SELECT COUNT(*) FROM whitelists), "
+    "(SELECT MAX(updated_at) FROM whitelists), "
+    "(SELECT COUNT(*) FROM whitelists WHERE active = 'active')"
+)
+
+DOMAINS_QUERY = (
+    "SELECT DISTINCT wd.domain "
+    "FROM whitelist_domains wd "
+    "JOIN whitelists wl ON wl.id = wd.whitelist_id "
+    "WHERE wl.active = 'active'"
+)
+
+
+class WhitelistMatcher:
+    """Constant-time whitelist decisions backed by a periodically synced set."""
+
+    def __init__(self, db_config: dict, refresh_interval: float = 10.0, match_parents: bool = False):
+        self.db_config = db_config
+        self.refresh_interval = refresh_interval
+        self.match_parents = match_parents
+        self.loaded = False
+        self.version = 0  # bumped whenever the whitelisted set changes
+        self._domains: FrozenSet[str] = frozenset()
+        self._signature = None
+        self._conn = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def __len__(self) -> int:
+        return len(self._domains)
+
+    def is_whitelisted(self, host: str) -> bool:
+        """Return True if host (already normalized) is whitelisted.
+
+        With match_parents enabled, a whitelisted example.com also covers
+        www.example.com and cdn.img.example.com.
+        """
+        domains = self._domains
+        if host in domains:
+            return True
+        if self.match_parents:
+            idx = host.find('.')
+            # Stop before the last label so a bare TLD never matches
+            while idx != -1 and host.find('.', idx + 1) != -1:
+                if host[idx + 1:] in domains:
+                    return True
+                idx = host.find('.', idx + 1)
+        return False
+
+    def preload(self, domains) -> int:
+        """Use a fixed set of domains without a database (offline replay and benchmarks)."""
+        self._domains = frozenset(d.strip().lower().rstrip('.') for d in domains if d and d.strip())
+        self.loaded = True
+        self.version += 1
+        return len(self._domains)
+
+    def _connection(self):
+        if not self._conn or (hasattr(self._conn, 'open') and not self._conn.open):
+            self._conn = mariadb.connect(**self.db_config)
+        return self._conn
+
+    def refresh(self) -> bool:
+        """Reload the whitelist set if the tables changed. Returns True on reload."""
+        conn = self._connection()
+        # End the previous read snapshot so committed changes are visible
+        conn.commit()
+        cur = conn.cursor()
+        try:
+            cur.execute(SIGNATURE_QUERY)
+            signature = tuple(str(v) for v in cur.fetchone())
+            if self.loaded and signature == self._signature:
+                return False
+            cur.execute(DOMAINS_QUERY)
+            domains = set()
+            for (domain,) in cur.fetchall():
+                if isinstance(domain, bytes):
+                    domain = domain.decode('utf-8', errors='ignore')
+                domain = (domain or "").strip().lower().rstrip('.')
+                if domain:
+                    domains.add(domain)
+        finally:
+            cur.close()
+        conn.commit()
+
+        # Swap the whole set in one assignment so readers never see a partial load
+        self._domains = frozenset(domains)
+        self._signature = signature
+        self.loaded = True
+        self.version += 1
+        log.info("Whitelist matcher: loaded %d domains", len(domains))
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the last good set while the database is unavailable
+                log.limited(log.WARNING, "whitelist-refresh", "Whitelist refresh failed, using cached whitelist: %s", e)
+                try:
+                    if self._conn:
+                        self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None
+            self._stop.wait(self.refresh_interval)
+
+    def start(self):
+        """Load the whitelist and keep it in sync from a daemon thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="whitelist-matcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        try:
+            if self._conn:
+                self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
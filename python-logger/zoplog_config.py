@@ -90,12 +90,64 @@ def load_settings_config() -> Dict[str, Any]:
         "monitor_interface": "eth0",    # WAN interface for better internet traffic capture
         "firewall_interface": "eth0",   # Apply firewall to internet-facing interface
         "capture_mode": "promiscuous",
+        "capture_backend": "scapy",     # scapy or tpacket (AF_PACKET TPACKET_V3 mmap ring)
+        "tpacket_block_size": 1 << 20,  # bytes per ring block (multiple of page size)
+        "tpacket_block_count": 64,
+        "tpacket_frame_size": 2048,
+        "snaplen": 0,                   # max bytes per frame handed to handlers (0 = no limit)
+        "quic_sni_extraction": True,    # decrypt QUIC Initial packets for SNI (needs cryptography)
         "log_level": "INFO",
         "block_mode": "immediate",
         "log_blocked": True,
         "firewall_rule_timeout": 10800,  # 3 hours default
         "update_interval": 30,
-        "max_log_entries": 10000
+        "max_log_entries": 10000,
+        "blocklist_refresh_interval": 30,  # seconds between blocklist index syncs
+        "whitelist_refresh_interval": 10,  # seconds between whitelist change checks
+        "whitelist_match_parents": False,  # whitelisting example.com also covers its subdomains
+        "writer_queue_size": 10000,  # packet rows buffered before new ones are dropped
+        "writer_batch_size": 200,  # rows per packet_logs transaction
+        "writer_flush_interval": 1.0,  # max seconds a row waits before being flushed
+        "request_coalesce_window": 0.0,  # seconds identical requests merge into one row (0 = off)
+        "request_coalesce_max_pending": 50000,  # open summary rows before the oldest is written early
+        "db_pool_size": 4,  # pooled read connections (lookups) per process
+        "db_pool_write_size": 2,  # pooled write connections (synchronous inserts) per process
+        "db_pool_timeout": 5.0,  # seconds to wait for a free pooled connection
+        "db_ping_interval": 1.0,  # pooled connections idle this long are pinged before reuse
+        "db_idle_timeout": 300,  # pooled connections idle this long are closed and reopened
+        "db_retry_attempts": 2,  # retries of a lookup/insert after a lost connection
+        "db_retry_backoff": 0.25,  # seconds before the first retry, doubled for each further one
+        "reader_batch_max": 5000,  # most block events the block-log reader stores per transaction
+        "reader_commit_target": 0.5,  # seconds per block event transaction the batch size adapts to
+        "reader_duplicate_window": 5.0,  # seconds a source/destination pair's block events count once
+        "reader_count_flush_interval": 5.0,  # seconds between blocked_count upserts
+        "attribution_socket": "/run/zoplog/attribution.sock",  # logger -> reader IP attributions ("" disables)
+        "reader_attribution_size": 65536,  # IP -> domain attributions the reader keeps
+        "reader_attribution_ttl": 600,  # seconds an attribution is used before it is looked up again
+        "reader_cursor_file": "/var/lib/zoplog/blocklog.cursor",  # journal position of the last stored entry ("" disables)
+        "reader_catchup_batch": 20000,  # block events per transaction while catching up
+        "reader_catchup_workers": 2,  # parse processes while catching up (0 = parse inline)
+        "reader_catchup_lag": 30,  # seconds behind the journal that switch the reader to catch-up (0 = never)
+        "reader_catchup_max_age": 86400,  # seconds of backlog replayed after a restart (0 = all)
+        "capture_workers": 2,  # packet processing threads (0 = process inline in the capture callback)
+        "capture_processes": 1,  # >1 = shard capture across processes with PACKET_FANOUT
+        "capture_queue_size": 4096,  # raw frames buffered between capture and workers
+        "capture_stats_interval": 60,  # seconds between capture drop reports
+        "nft_binary": "",  # path to nft for the batched set updater (empty = auto-detect)
+        "firewall_batch_interval": 0.2,  # seconds nft set additions are coalesced before applying
+        "decision_cache_ttl": 60,  # seconds a block verdict for (host, destination IP) is reused
+        "decision_cache_negative_ttl": 30,  # seconds an allow/whitelisted verdict is reused
+        "decision_cache_size": 16384,  # max cached (host, destination IP) verdicts
+        "flow_table_ttl": 3.0,  # seconds an incomplete TLS ClientHello is kept for reassembly
+        "flow_table_byte_budget": 8 << 20,  # total bytes buffered across all partial handshakes
+        "flow_table_max_flows": 65536,  # max partial handshakes tracked at once
+        "flow_state_ttl": 300,  # idle seconds before a connection's classification is forgotten
+        "flow_state_max_flows": 131072,  # connections whose classification is remembered (0 = off)
+        "dns_cache_size": 65536,  # (client, server IP) -> name entries kept for QUIC attribution
+        "dns_cache_min_ttl": 60,  # DNS record TTLs are clamped to [min, max] seconds
+        "dns_cache_max_ttl": 3600,
+        "logger_metrics_listen": "127.0.0.1:9745",  # Prometheus endpoint of logger.py ("" = off, or unix:/path)
+        "reader_metrics_listen": "127.0.0.1:9746",  # Prometheus endpoint of nft_blocklog_reader.py
     }
     
     for config_path in config_paths:
@@ -113,6 +165,12 @@ def load_settings_config() -> Dict[str, Any]:
                         config['monitor_interface'] = monitoring.get('interface', config['monitor_interface'])
                         config['capture_mode'] = monitoring.get('capture_mode', config['capture_mode'])
                         config['log_level'] = monitoring.get('log_level', config['log_level'])
+                        config['capture_backend'] = monitoring.get('capture_backend', config['capture_backend']).strip().lower()
+                        config['tpacket_block_size'] = monitoring.getint('tpacket_block_size', config['tpacket_block_size'])
+                        config['tpacket_block_count'] = max(1, monitoring.getint('tpacket_block_count', config['tpacket_block_count']))
+                        config['tpacket_frame_size'] = monitoring.getint('tpacket_frame_size', config['tpacket_frame_size'])
+                        config['snaplen'] = max(0, monitoring.getint('snaplen', config['snaplen']))
+                        config['quic_sni_extraction'] = monitoring.getboolean('quic_sni_extraction', config['quic_sni_extraction'])
                     
                     if parser.has_section('firewall'):
                         firewall = parser['firewall']
@@ -120,12 +178,69 @@ def load_settings_config() -> Dict[str, Any]:
                         config['block_mode'] = firewall.get('block_mode', config['block_mode'])
                         config['log_blocked'] = firewall.getboolean('log_blocked', config['log_blocked'])
                         config['firewall_rule_timeout'] = max(1, firewall.getint('firewall_rule_timeout', config['firewall_rule_timeout']))
+                        config['whitelist_match_parents'] = firewall.getboolean('whitelist_match_parents', config['whitelist_match_parents'])
+                        config['nft_binary'] = firewall.get('nft_binary', config['nft_binary']).strip()
                     
                     if parser.has_section('system'):
                         system = parser['system']
                         config['update_interval'] = system.getint('update_interval', config['update_interval'])
                         config['max_log_entries'] = system.getint('max_log_entries', config['max_log_entries'])
                     
+                    if parser.has_section('metrics'):
+                        metrics = parser['metrics']
+                        config['logger_metrics_listen'] = metrics.get('logger_listen', config['logger_metrics_listen']).strip()
+                        config['reader_metrics_listen'] = metrics.get('reader_listen', config['reader_metrics_listen']).strip()
+                    
+                    if parser.has_section('performance'):
+                        performance = parser['performance']
+                        config['blocklist_refresh_interval'] = max(1, performance.getint('blocklist_refresh_interval', config['blocklist_refresh_interval']))
+                        config['whitelist_refresh_interval'] = max(1, performance.getint('whitelist_refresh_interval', config['whitelist_refresh_interval']))
+                        config['writer_queue_size'] = max(1, performance.getint('writer_queue_size', config['writer_queue_size']))
+                        config['writer_batch_size'] = max(1, performance.getint('writer_batch_size', config['writer_batch_size']))
+                        config['writer_flush_interval'] = max(0.05, performance.getfloat('writer_flush_interval', config['writer_flush_interval']))
+                        config['request_coalesce_window'] = max(0.0, performance.getfloat('request_coalesce_window', config['request_coalesce_window']))
+                        config['request_coalesce_max_pending'] = max(1, performance.getint('request_coalesce_max_pending', config['request_coalesce_max_pending']))
+                        config['db_pool_size'] = max(1, performance.getint('db_pool_size', config['db_pool_size']))
+                        config['db_pool_write_size'] = max(1, performance.getint('db_pool_write_size', config['db_pool_write_size']))
+                        config['db_pool_timeout'] = max(0.0, performance.getfloat('db_pool_timeout', config['db_pool_timeout']))
+                        config['db_ping_interval'] = max(0.0, performance.getfloat('db_ping_interval', config['db_ping_interval']))
+                        config['db_idle_timeout'] = max(0, performance.getint('db_idle_timeout', config['db_idle_timeout']))
+                        config['db_retry_attempts'] = max(0, performance.getint('db_retry_attempts', config['db_retry_attempts']))
+                        config['db_retry_backoff'] = max(0.0, performance.getfloat('db_retry_backoff', config['db_retry_backoff']))
+                        config['reader_batch_max'] = max(1, performance.getint('reader_batch_max', config['reader_batch_max']))
+                        config['reader_commit_target'] = max(0.01, performance.getfloat('reader_commit_target', config['reader_commit_target']))
+                        config['reader_duplicate_window'] = max(0.0, performance.getfloat('reader_duplicate_window', config['reader_duplicate_window']))
+                        config['reader_count_flush_interval'] = max(0.1, performance.getfloat('reader_count_flush_interval', config['reader_count_flush_interval']))
+                        config['attribution_socket'] = performance.get('attribution_socket', config['attribution_socket']).strip()
+                        config['reader_attribution_size'] = max(1, performance.getint('reader_attribution_size', config['reader_attribution_size']))
+                        config['reader_attribution_ttl'] = max(1, performance.getint('reader_attribution_ttl', config['reader_attribution_ttl']))
+                        config['reader_cursor_file'] = performance.get('reader_cursor_file', config['reader_cursor_file']).strip()
+                        config['reader_catchup_batch'] = max(1, performance.getint('reader_catchup_batch', config['reader_catchup_batch']))
+                        config['reader_catchup_workers'] = max(0, performance.getint('reader_catchup_workers', config['reader_catchup_workers']))
+                        config['reader_catchup_lag'] = max(0.0, performance.getfloat('reader_catchup_lag', config['reader_catchup_lag']))
+                        config['reader_catchup_max_age'] = max(0, performance.getint('reader_catchup_max_age', config['reader_catchup_max_age']))
+                        config['capture_workers'] = max(0, performance.getint('capture_workers', config['capture_workers']))
+                        config['capture_processes'] = max(1, performance.getint('capture_processes', config['capture_processes']))
+                        config['capture_queue_size'] = max(1, performance.getint('capture_queue_size', config['capture_queue_size']))
+                        config['capture_stats_interval'] = max(1, performance.getint('capture_stats_interval', config['capture_stats_interval']))
+                        config['firewall_batch_interval'] = max(0.01, performance.getfloat('firewall_batch_interval', config['firewall_batch_interval']))
+                        config['decision_cache_ttl'] = max(0.0, performance.getfloat('decision_cache_ttl', config['decision_cache_ttl']))
+                        config['decision_cache_negative_ttl'] = max(0.0, performance.getfloat('decision_cache_negative_ttl', config['decision_cache_negative_ttl']))
+                        config['decision_cache_size'] = max(0, performance.getint('decision_cache_size', config['decision_cache_size']))
+                        config['flow_table_ttl'] = max(0.5, performance.getfloat('flow_table_ttl', config['flow_table_ttl']))
+                        config['flow_table_byte_budget'] = max(1 << 16, performance.getint('flow_table_byte_budget', config['flow_table_byte_budget']))
+                        config['flow_table_max_flows'] = max(1, performance.getint('flow_table_max_flows', config['flow_table_max_flows']))
+                        config['flow_state_ttl'] = max(1.0, performance.getfloat('flow_state_ttl', config['flow_state_ttl']))
+                        config['flow_state_max_flows'] = max(0, performance.getint('flow_state_max_flows', config['flow_state_max_flows']))
+                        config['dns_cache_size'] = max(0, performance.getint('dns_cache_size', config['dns_cache_size']))
+                        config['dns_cache_min_ttl'] = max(0, performance.getint('dns_cache_min_ttl', config['dns_cache_min_ttl']))
+                        config['dns_cache_max_ttl'] = max(config['dns_cache_min_ttl'], performance.getint('dns_cache_max_ttl', config['dns_cache_max_ttl']))
+                        # id_cache_<table> = <entries>, e.g. id_cache_user_agents = 2048
+                        config['id_cache_sizes'] = {
+                            key[len('id_cache_'):]: max(0, performance.getint(key))
+                            for key in performance if key.startswith('id_cache_')
+                        }
+                    
                     return config
                 else:
                     # JSON format - legacy
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Leveled, buffered logging for the ZopLog services.
+
+The level is resolved once at startup by configure() (log_level in
+zoplog.conf; ALL is an alias for DEBUG). Statements below the level return
+after one comparison and messages take %-style arguments, so a disabled
+debug() costs a function call and nothing is formatted. Hot paths that
+would build expensive arguments can test debug_enabled first.
+
+Enabled lines are queued and written by a background thread every flush
+interval (errors wake it at once), so packet handling never waits on a slow
+journald. When the queue is full new lines are dropped and the number of
+dropped lines is reported with the next write. limited() lets through one
+message per key and interval and counts the repeats it suppressed.
+
+Usage:
+    import zoplog_log as log
+    log.configure(settings.get("log_level"))
+    log.debug("HTTP host %s is whitelisted", host)
+"""
+
+import atexit
+import sys
+import threading
+import time
+from collections import deque
+from typing import Dict, Hashable, List, Optional
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+LEVELS = {"ALL": DEBUG, "DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "WARN": WARNING, "ERROR": ERROR}
+_PREFIX = {DEBUG: "DEBUG: ", INFO: "", WARNING: "Warning: ", ERROR: "ERROR: "}
+
+# Keys remembered by limited() before the table is reset
+MAX_LIMIT_KEYS = 4096
+
+_level = INFO
+debug_enabled = False
+_queue: deque = deque()
+_queue_size = 10000
+_flush_interval = 0.2
+_dropped = 0
+_dropped_reported = 0
+_wake = threading.Event()
+_write_lock = threading.Lock()
+_start_lock = threading.Lock()
+_thread: Optional[threading.Thread] = None
+# key -> [next allowed time, suppressed count]
+_limits: Dict[Hashable, List[float]] = {}
+
+
+def parse_level(name) -> int:
+    """Numeric level for a log_level setting; unknown values mean INFO."""
+    if isinstance(name, int):
+        return name
+    return LEVELS.get(str(name or "INFO").strip().upper(), INFO)
+
+
+def configure(level="INFO", queue_size: int = 10000, flush_interval: float = 0.2):
+    """Set the level and output buffering; called once at startup."""
+    global _level, debug_enabled, _queue_size, _flush_interval
+    _level = parse_level(level)
+    debug_enabled = _level <= DEBUG
+    _queue_size = max(1, int(queue_size))
+    _flush_interval = max(0.01, float(flush_interval))
+
+
+def enabled(level: int) -> bool:
+    return _level <= level
+
+
+def _start():
+    global _thread
+    with _start_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name="log-writer", daemon=True)
+            _thread.start()
+
+
+def _emit(level: int, fmt: str, args: tuple):
+    global _dropped
+    if len(_queue) >= _queue_size:
+        _dropped += 1
+        return
+    _queue.append((level, fmt, args))
+    if _thread is None:
+        _start()
+    if level >= ERROR:
+        _wake.set()
+
+
+def _format(level: int, fmt: str, args: tuple) -> str:
+    try:
+        message = fmt % args if args else fmt
+    except Exception as e:
+        message = f"{fmt!r} % {args!r} ({e})"
+    return _PREFIX.get(level, "") + message
+
+
+def _drain():
+    """Format and write everything queued; errors go to stderr, the rest to stdout."""
+    global _dropped_reported
+    with _write_lock:
+        out: List[str] = []
+        err: List[str] = []
+        queue = _queue
+        while queue:
+            level, fmt, args = queue.popleft()
+            (err if level >= ERROR else out).append(_format(level, fmt, args))
+        dropped = _dropped
+        if dropped != _dropped_reported:
+            out.append(f"Warning: {dropped - _dropped_reported} log lines dropped (log queue full)")
+            _dropped_reported = dropped
+        for stream, lines in ((sys.stdout, out), (sys.stderr, err)):
+            if not lines:
+                continue
+            try:
+                stream.write("\n".join(lines) + "\n")
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+
+def _run():
+    while True:
+        _wake.wait(_flush_interval)
+        _wake.clear()
+        _drain()
+
+
+def flush():
+    """Write queued lines now (also run at interpreter exit)."""
+    _drain()
+
+
+atexit.register(flush)
+
+
+def debug(fmt: str, *args):
+    if _level <= DEBUG:
+        _emit(DEBUG, fmt, args)
+
+
+def info(fmt: str, *args):
+    if _level <= INFO:
+        _emit(INFO, fmt, args)
+
+
+def warning(fmt: str, *args):
+    if _level <= WARNING:
+        _emit(WARNING, fmt, args)
+
+
+def error(fmt: str, *args):
+    if _level <= ERROR:
+        _emit(ERROR, fmt, args)
+
+
+def limited(level: int, key: Hashable, fmt: str, *args, interval: float = 60.0):
+    """Log at most once per interval for key; repeats are counted and reported."""
+    if _level > level:
+        return
+    now = time.monotonic()
+    state = _limits.get(key)
+    if state is not None and now < state[0]:
+        state[1] += 1
+        return
+    if len(_limits) >= MAX_LIMIT_KEYS:
+        _limits.clear()
+    suppressed = int(state[1]) if state is not None else 0
+    _limits[key] = [now + interval, 0]
+    if suppressed:
+        fmt, args = fmt + " (%d similar messages suppressed)", args + (suppressed,)
+    _emit(level, fmt, args)
+
+
+def stats() -> Dict[str, int]:
+    return {"queued": len(_queue), "dropped": _dropped, "limited_keys": len(_limits)}
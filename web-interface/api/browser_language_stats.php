@@ -4,11 +4,9 @@ require_once __DIR__ . '/../zoplog_config.php';
 
 // Browser stats - detailed categorization
 $uaRes = $mysqli->query("
-    SELECT ua.user_agent, COUNT(*) as cnt
-    FROM packet_logs p
-    JOIN user_agents ua ON p.user_agent_id = ua.id
-    WHERE ua.user_agent IS NOT NULL
-    GROUP BY ua.user_agent
+    SELECT user_agent, requests as cnt
+    FROM user_agent_request_counts
+    WHERE user_agent IS NOT NULL
     ORDER BY cnt DESC
 ");
 
@@ -69,7 +67,7 @@ if ($otherBrowsersCount > 0) {
 
 // Language stats
 $langRes = $mysqli->query("
-    SELECT al.accept_language
+    SELECT al.accept_language, p.hit_count
     FROM packet_logs p
     JOIN accept_languages al ON p.accept_language_id = al.id
     WHERE al.accept_language IS NOT NULL
@@ -80,7 +78,7 @@ while ($row = $langRes->fetch_assoc()) {
     $lang = substr($row["accept_language"], 0, 2);
     if (!$lang) continue;
     if (!isset($langs[$lang])) $langs[$lang] = 0;
-    $langs[$lang]++;
+    $langs[$lang] += (int)$row["hit_count"];
 }
 arsort($langs);
 $langs = array_slice($langs, 0, 10, true);
@@ -148,7 +148,8 @@ function getSystemMetrics() {
 }
 
 // Get all summary statistics
-$allowedRes = $mysqli->query("SELECT COUNT(*) AS cnt FROM packet_logs");
+// Totals come from the per-minute rollup maintained by the logger
+$allowedRes = $mysqli->query("SELECT COALESCE(SUM(requests), 0) AS cnt FROM packet_log_minutes");
 $allowedRequests = $allowedRes->fetch_assoc()["cnt"];
 
 $blockedRes = $mysqli->query("
@@ -167,11 +168,8 @@ $uniqueIPs = $uniqueRes->fetch_assoc()["cnt"];
 
 // Top hosts (last 5)
 $topHostsRes = $mysqli->query("
-    SELECT d.domain, COUNT(*) AS cnt 
-    FROM packet_logs p
-    LEFT JOIN domains d ON p.domain_id = d.id
-    WHERE d.domain IS NOT NULL
-    GROUP BY d.domain
+    SELECT domain, requests AS cnt
+    FROM domain_request_counts
     ORDER BY cnt DESC
     LIMIT 5
 ");
@@ -180,11 +178,11 @@ while ($row = $topHostsRes->fetch_assoc()) {
     $topHosts[] = $row;
 }
 
-// Get allowed requests from packet_logs (last 10 minutes, per minute - minute-aligned)
+// Get allowed requests from packet_log_minutes (last 10 minutes, per minute - minute-aligned)
 $allowedTimelineRes = $mysqli->query("
-    SELECT DATE_FORMAT(packet_timestamp, '%H:%i') AS minute, COUNT(*) AS cnt
-    FROM packet_logs
-    WHERE packet_timestamp >= DATE_SUB(DATE_SUB(NOW(), INTERVAL MINUTE(NOW()) MINUTE), INTERVAL 10 MINUTE)
+    SELECT DATE_FORMAT(minute, '%H:%i') AS minute, SUM(requests) AS cnt
+    FROM packet_log_minutes
+    WHERE minute >= DATE_SUB(DATE_SUB(NOW(), INTERVAL MINUTE(NOW()) MINUTE), INTERVAL 10 MINUTE)
     GROUP BY minute
     ORDER BY minute ASC
 ");
@@ -193,15 +191,11 @@ while ($row = $allowedTimelineRes->fetch_assoc()) {
     $allowedTimeline[$row['minute']] = $row['cnt'];
 }
 
-// Get blocked requests from blocked_events (normalized - group similar requests within 30-second windows)
+// Get blocked requests from blocked_event_minutes (normalized - one per WAN IP per 30-second window)
 $blockedTimelineRes = $mysqli->query("
-    SELECT DATE_FORMAT(event_time, '%H:%i') AS minute, 
-           COUNT(DISTINCT CONCAT(
-                wan_ip_id, '-',
-               FLOOR(UNIX_TIMESTAMP(event_time) / 30) -- 30-second dedup window
-           )) AS cnt
-    FROM blocked_events
-    WHERE event_time >= DATE_SUB(DATE_SUB(NOW(), INTERVAL MINUTE(NOW()) MINUTE), INTERVAL 10 MINUTE)
+    SELECT DATE_FORMAT(minute, '%H:%i') AS minute, SUM(targets) AS cnt
+    FROM blocked_event_minutes
+    WHERE minute >= DATE_SUB(DATE_SUB(NOW(), INTERVAL MINUTE(NOW()) MINUTE), INTERVAL 10 MINUTE)
     GROUP BY minute
     ORDER BY minute ASC
 ");
@@ -4,21 +4,17 @@ require_once __DIR__ . '/../zoplog_config.php';
 
 // Timeline data (last 10 minutes)
 $allowedTimelineRes = $mysqli->query("
-    SELECT DATE_FORMAT(packet_timestamp, '%H:%i') AS minute, COUNT(*) AS cnt
-    FROM packet_logs
-    WHERE packet_timestamp >= DATE_SUB(DATE_SUB(NOW(), INTERVAL MINUTE(NOW()) MINUTE), INTERVAL 10 MINUTE)
+    SELECT DATE_FORMAT(minute, '%H:%i') AS minute, SUM(requests) AS cnt
+    FROM packet_log_minutes
+    WHERE minute >= DATE_SUB(DATE_SUB(NOW(), INTERVAL MINUTE(NOW()) MINUTE), INTERVAL 10 MINUTE)
     GROUP BY minute
     ORDER BY minute ASC
 ");
 
 $blockedTimelineRes = $mysqli->query("
-    SELECT DATE_FORMAT(event_time, '%H:%i') AS minute,
-           COUNT(DISTINCT CONCAT(
-               wan_ip_id, '-',
-               FLOOR(UNIX_TIMESTAMP(event_time) / 30)
-           )) AS cnt
-    FROM blocked_events
-    WHERE event_time >= DATE_SUB(DATE_SUB(NOW(), INTERVAL MINUTE(NOW()) MINUTE), INTERVAL 10 MINUTE)
+    SELECT DATE_FORMAT(minute, '%H:%i') AS minute, SUM(targets) AS cnt
+    FROM blocked_event_minutes
+    WHERE minute >= DATE_SUB(DATE_SUB(NOW(), INTERVAL MINUTE(NOW()) MINUTE), INTERVAL 10 MINUTE)
     GROUP BY minute
     ORDER BY minute ASC
 ");
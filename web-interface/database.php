@@ -61,7 +61,7 @@ function getDatabaseInfo() {
         // Get recent activity (last 24 hours)
         $result = $mysqli->query("
             SELECT
-                COUNT(*) as total_packets_24h,
+                COALESCE(SUM(pl.hit_count), 0) as total_packets_24h,
                 COUNT(DISTINCT ip.ip_address) as unique_ips_24h
             FROM packet_logs pl
             LEFT JOIN ip_addresses ip ON pl.src_ip_id = ip.id
@@ -79,7 +79,7 @@ if ($since) {
 
 // Build query
 $sql = "
-SELECT p.packet_timestamp, p.src_port, p.dst_port, p.method, p.type,
+SELECT p.packet_timestamp, p.last_timestamp, p.hit_count, p.src_port, p.dst_port, p.method, p.type,
        src_ip.ip_address AS src_ip, dst_ip.ip_address AS dst_ip,
        src_mac.mac_address AS src_mac, dst_mac.mac_address AS dst_mac,
        d.domain, path.path
@@ -10,7 +10,7 @@ require_once __DIR__ . '/zoplog_config.php';
 header('X-ZopLog-Server: ZopLog Server');
 
 // Total requests (allowed + blocked normalized)
-$allowedRes = $mysqli->query("SELECT COUNT(*) AS cnt FROM packet_logs");
+$allowedRes = $mysqli->query("SELECT COALESCE(SUM(requests), 0) AS cnt FROM packet_log_minutes");
 $allowedRequests = $allowedRes->fetch_assoc()["cnt"];
 
 $blockedRes = $mysqli->query("
@@ -64,6 +64,7 @@
         <option value="OPTIONS">OPTIONS</option>
         <option value="PATCH">PATCH</option>
         <option value="TLS_CLIENTHELLO">TLS_CLIENTHELLO</option>
+        <option value="QUIC">QUIC</option>
         <option value="N/A">N/A</option>
       </select>
 